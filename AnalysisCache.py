@@ -0,0 +1,319 @@
+####
+# Copyright (C) 2012, 2020 Angelo Cano
+#
+# This file is part of Qvmdis.
+#
+# Qvmdis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Qvmdis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Qvmdis.  If not, see <https://www.gnu.org/licenses/>.
+####
+
+# on-disk cache of analysis results
+#
+# Entry file format (little endian):
+#
+#   magic             4 bytes  "QVMA"
+#   formatVersion     uint32
+#   intCount          uint32
+#   stringsLength     uint32
+#   ints              int32 * intCount
+#   strings           utf-8, '\n' separated
+#
+# What the ints mean is up to the caller, IntWriter and IntReader help
+# with storing dictionaries and lists of ints.
+
+from PythonCompat import xarray_frombytes, xarray_tobytes
+import array, hashlib, os, struct, sys, tempfile, time
+
+CACHE_MAGIC = b"QVMA"
+CACHE_FORMAT_VERSION = 1
+CACHE_FILE_EXTENSION = ".qvma"
+CACHE_HEADER_SIZE = 16
+
+DEFAULT_MAX_SIZE = 64 * 1024 * 1024
+
+# temporary files are <name>.<random>.tmp next to the file they replace
+TEMP_FILE_EXTENSION = ".tmp"
+# temporary files older than this were left by a process that was killed
+# while writing, evict_cache_files() deletes them
+STALE_TEMP_FILE_AGE = 24 * 60 * 60
+
+class CacheFormatError(Exception):
+    pass
+
+class IntWriter:
+    def __init__ (self):
+        self.ints = array.array('i')
+
+    def write (self, value):
+        self.ints.append(value)
+
+    def write_list (self, values):
+        self.ints.append(len(values))
+        self.ints.extend(values)
+
+    # d:{} key:int -> value:int
+    def write_int_dict (self, d):
+        self.ints.append(len(d))
+        for k in d:
+            self.ints.append(k)
+            self.ints.append(d[k])
+
+    # d:{} key:int -> value:int, values are signed 64-bit
+    def write_int64_dict (self, d):
+        self.ints.append(len(d))
+        for k in d:
+            self.ints.append(k)
+            self.ints.append(d[k] >> 32)
+            lo = d[k] & 0xffffffff
+            if lo > 0x7fffffff:
+                lo -= 0x100000000
+            self.ints.append(lo)
+
+    # d:{} key:int -> [ v1:int, v2:int, ... ]
+    def write_list_dict (self, d):
+        self.ints.append(len(d))
+        for k in d:
+            self.ints.append(k)
+            self.write_list(d[k])
+
+    # d:{} key:int -> [ [v1:int, ...], [v2:int, ...], ... ], all inner lists
+    # need to have the same length
+    def write_nested_list_dict (self, d):
+        self.ints.append(len(d))
+        for k in d:
+            self.ints.append(k)
+            self.ints.append(len(d[k]))
+            for l in d[k]:
+                self.ints.extend(l)
+
+class IntReader:
+    def __init__ (self, ints):
+        self.ints = ints
+        self.pos = 0
+
+    def read (self):
+        if self.pos >= len(self.ints):
+            raise CacheFormatError("read past end of data")
+        v = self.ints[self.pos]
+        self.pos += 1
+        return v
+
+    def read_list (self):
+        n = self.read()
+        if n < 0  or  self.pos + n > len(self.ints):
+            raise CacheFormatError("invalid list length %d" % n)
+        l = self.ints[self.pos : self.pos + n].tolist()
+        self.pos += n
+        return l
+
+    def read_int_dict (self):
+        d = {}
+        for i in range(self.read()):
+            k = self.read()
+            d[k] = self.read()
+        return d
+
+    def read_int64_dict (self):
+        d = {}
+        for i in range(self.read()):
+            k = self.read()
+            hi = self.read()
+            d[k] = (hi << 32) | (self.read() & 0xffffffff)
+        return d
+
+    def read_list_dict (self):
+        d = {}
+        for i in range(self.read()):
+            k = self.read()
+            d[k] = self.read_list()
+        return d
+
+    def read_nested_list_dict (self, width):
+        d = {}
+        for i in range(self.read()):
+            k = self.read()
+            l = []
+            for j in range(self.read()):
+                l.append([self.read() for w in range(width)])
+            d[k] = l
+        return d
+
+    def at_end (self):
+        return self.pos == len(self.ints)
+
+# chunks:[] byte strings or buffers
+def content_digest (chunks):
+    h = hashlib.sha1()
+    for c in chunks:
+        h.update(c)
+    return h.hexdigest()
+
+# returns (fd:int, tmpName:str) of a new temporary file in the directory
+# of fname
+def new_temp_file (fname):
+    return tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(fname)), prefix=os.path.basename(fname) + ".", suffix=TEMP_FILE_EXTENSION)
+
+# renames the temporary file tmpName to fname, other processes see either
+# the old or the new file.  mode is masked with the umask like open() does,
+# mkstemp() files are only readable by the owner.  tmpName is removed if it
+# fails.
+def replace_file (tmpName, fname, mode=0o666):
+    try:
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmpName, mode & ~umask)
+        try:
+            os.rename(tmpName, fname)
+        except OSError:
+            # windows won't replace an existing file
+            os.remove(fname)
+            os.rename(tmpName, fname)
+    except BaseException:
+        try:
+            os.remove(tmpName)
+        except OSError:
+            pass
+        raise
+
+# writes data:bytes to fname through a temporary file so other processes
+# never see a partial file
+def atomic_write (fname, data, mode=0o666):
+    (fd, tmpName) = new_temp_file(fname)
+    try:
+        f = os.fdopen(fd, "wb")
+        try:
+            f.write(data)
+        finally:
+            f.close()
+    except BaseException:
+        try:
+            os.remove(tmpName)
+        except OSError:
+            pass
+        raise
+    replace_file(tmpName, fname, mode)
+
+# deletes the least recently used files in cacheDir whose names start with
+# prefix and end with one of extensions until their total size is below
+# maxSize, except keep:str.  Writing a file or updating its mtime counts as
+# using it.  Stale temporary files with the prefix are deleted too.
+def evict_cache_files (cacheDir, prefix, extensions, maxSize, keep=None):
+    entries = []
+    totalSize = 0
+    staleTime = time.time() - STALE_TEMP_FILE_AGE
+    for n in os.listdir(cacheDir):
+        if not n.startswith(prefix):
+            continue
+        isTemp = n.endswith(TEMP_FILE_EXTENSION)
+        if not isTemp  and  not n.endswith(extensions):
+            continue
+        fname = os.path.join(cacheDir, n)
+        try:
+            st = os.stat(fname)
+        except OSError:
+            continue
+        if isTemp:
+            if st.st_mtime < staleTime:
+                try:
+                    os.remove(fname)
+                except OSError:
+                    pass
+            continue
+        entries.append([st.st_mtime, st.st_size, fname])
+        totalSize += st.st_size
+
+    entries.sort()
+    for (mtime, size, fname) in entries:
+        if totalSize <= maxSize:
+            break
+        if fname == keep:
+            continue
+        try:
+            os.remove(fname)
+        except OSError:
+            continue
+        totalSize -= size
+
+class AnalysisCache:
+    def __init__ (self, cacheDir, maxSize=DEFAULT_MAX_SIZE):
+        self.cacheDir = cacheDir
+        self.maxSize = maxSize
+
+    def entry_file_name (self, key):
+        return os.path.join(self.cacheDir, key + CACHE_FILE_EXTENSION)
+
+    # returns (ints:array('i'), strings:[str, ...]) or None if there isn't a
+    # valid entry
+    def load (self, key):
+        fname = self.entry_file_name(key)
+        try:
+            f = open(fname, "rb")
+            data = f.read()
+            f.close()
+        except (IOError, OSError):
+            return None
+
+        try:
+            if len(data) < CACHE_HEADER_SIZE  or  data[:4] != CACHE_MAGIC:
+                raise CacheFormatError("bad header")
+            (formatVersion, intCount, stringsLength) = struct.unpack("<LLL", data[4:CACHE_HEADER_SIZE])
+            if formatVersion != CACHE_FORMAT_VERSION:
+                raise CacheFormatError("format version %d" % formatVersion)
+            if CACHE_HEADER_SIZE + intCount * 4 + stringsLength != len(data):
+                raise CacheFormatError("bad length")
+
+            ints = array.array('i')
+            pos = CACHE_HEADER_SIZE
+            xarray_frombytes(ints, data[pos : pos + intCount * 4])
+            if sys.byteorder != "little":
+                ints.byteswap()
+            pos += intCount * 4
+
+            s = data[pos:].decode("utf-8")
+            if len(s) > 0:
+                strings = s.split("\n")
+            else:
+                strings = []
+        except (CacheFormatError, struct.error, UnicodeDecodeError):
+            # stale or damaged, it will be replaced
+            return None
+
+        # least recently used entries are evicted first
+        try:
+            os.utime(fname, None)
+        except OSError:
+            pass
+
+        return (ints, strings)
+
+    # ints:array('i'), strings:[str, ...] without '\n'
+    def store (self, key, ints, strings=[]):
+        if not os.path.isdir(self.cacheDir):
+            os.makedirs(self.cacheDir)
+
+        if sys.byteorder != "little":
+            ints = array.array('i', ints)
+            ints.byteswap()
+        intBytes = xarray_tobytes(ints)
+        stringBytes = "\n".join(strings).encode("utf-8")
+
+        # other processes never see a partial entry
+        header = CACHE_MAGIC + struct.pack("<LLL", CACHE_FORMAT_VERSION, len(ints), len(stringBytes))
+        atomic_write(self.entry_file_name(key), header + intBytes + stringBytes)
+
+        self.evict()
+
+    # delete least recently used entries until the total size is below
+    # maxSize
+    def evict (self):
+        evict_cache_files(self.cacheDir, "", (CACHE_FILE_EXTENSION,), self.maxSize)
@@ -0,0 +1,255 @@
+####
+# Copyright (C) 2012, 2020 Angelo Cano
+#
+# This file is part of Qvmdis.
+#
+# Qvmdis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Qvmdis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Qvmdis.  If not, see <https://www.gnu.org/licenses/>.
+####
+
+# memory mapped index of known function hashes
+#
+# Index file format (little endian):
+#
+#   magic             4 bytes  "QVMH"
+#   formatVersion     uint32
+#   hashBits          uint32  32 or 64
+#   entryCount        uint32
+#   stringsLength     uint32
+#   hashes            int32 or int64 * entryCount, sorted
+#   nameOffsets       uint32 * (entryCount + 1), name n is
+#                     strings[nameOffsets[n] : nameOffsets[n + 1]]
+#   strings           utf-8 function names
+#
+# Entries with the same hash keep the order they were added in so that
+# matches are listed like they are in the .hmap files.  Lookups only touch
+# the pages they need, so opening an index is about as fast for millions of
+# functions as it is for baseq3.
+
+from PythonCompat import atoi
+from AnalysisCache import atomic_write
+import bisect, mmap, os, struct
+
+INDEX_MAGIC = b"QVMH"
+INDEX_FORMAT_VERSION = 2
+INDEX_FILE_EXTENSION = ".hidx"
+INDEX_HEADER_SIZE = 20
+
+# hashBits:int -> struct format
+HASH_FORMATS = { 32 : "<i", 64 : "<q" }
+
+class HashIndexFormatError(Exception):
+    pass
+
+# function names are native strings
+def _decode_name (b):
+    if str is bytes:
+        return b
+    return b.decode("utf-8")
+
+def _encode_name (n):
+    if isinstance(n, bytes):
+        return n
+    return n.encode("utf-8")
+
+# read only sequence of packed little endian ints in a buffer, allows using
+# bisect without unpacking the whole array
+class PackedInts:
+    def __init__ (self, data, offset, count, fmt):
+        self.data = data
+        self.offset = offset
+        self.count = count
+        self.fmt = fmt
+        self.itemSize = struct.calcsize(fmt)
+
+    def __len__ (self):
+        return self.count
+
+    def __getitem__ (self, n):
+        if n < 0  or  n >= self.count:
+            raise IndexError("packed int index out of range")
+        return struct.unpack_from(self.fmt, self.data, self.offset + n * self.itemSize)[0]
+
+# returns [ [hash:int, funcName:str], ... ] in file order
+#
+# .hmap line:  0x1223 CG_DrawAttacker -6b3cb275
+def read_hmap (fname):
+    f = open(fname)
+    lines = f.readlines()
+    f.close()
+
+    entries = []
+    lineCount = 0
+    for line in lines:
+        words = line.split()
+        if len(words) > 2:
+            try:
+                # hex value without leading '0x':  2ad89a6d
+                h = atoi(words[2], 16)
+            except ValueError:
+                raise HashIndexFormatError("couldn't parse hash value in line %d of %s: %s" % (lineCount + 1, fname, line))
+            entries.append([h, words[1]])
+        lineCount += 1
+
+    return entries
+
+class FunctionHashIndex:
+    def __init__ (self, fname):
+        self.fname = fname
+
+        f = open(fname, "rb")
+        try:
+            if os.fstat(f.fileno()).st_size < INDEX_HEADER_SIZE:
+                raise HashIndexFormatError("%s is too small to be a function hash index" % fname)
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            f.close()
+
+        if self.data[:4] != INDEX_MAGIC:
+            raise HashIndexFormatError("%s isn't a function hash index" % fname)
+        (formatVersion, hashBits, entryCount, stringsLength) = struct.unpack_from("<LLLL", self.data, 4)
+        if formatVersion != INDEX_FORMAT_VERSION:
+            raise HashIndexFormatError("%s has unsupported format version %d" % (fname, formatVersion))
+        if hashBits not in HASH_FORMATS:
+            raise HashIndexFormatError("%s has unsupported hash size %d" % (fname, hashBits))
+        self.hashBits = hashBits
+
+        hashesOffset = INDEX_HEADER_SIZE
+        nameOffsetsOffset = hashesOffset + entryCount * (hashBits // 8)
+        self.stringsOffset = nameOffsetsOffset + (entryCount + 1) * 4
+        if self.stringsOffset + stringsLength != len(self.data):
+            raise HashIndexFormatError("%s has invalid length" % fname)
+
+        self.hashes = PackedInts(self.data, hashesOffset, entryCount, HASH_FORMATS[hashBits])
+        self.nameOffsets = PackedInts(self.data, nameOffsetsOffset, entryCount + 1, "<L")
+
+    def __len__ (self):
+        return len(self.hashes)
+
+    def name (self, n):
+        start = self.stringsOffset + self.nameOffsets[n]
+        end = self.stringsOffset + self.nameOffsets[n + 1]
+        return _decode_name(self.data[start:end])
+
+    def __contains__ (self, h):
+        n = bisect.bisect_left(self.hashes, h)
+        return n < len(self.hashes)  and  self.hashes[n] == h
+
+    # returns [ funcName1, funcName2, ... ]
+    def __getitem__ (self, h):
+        names = self.get(h)
+        if names == None:
+            raise KeyError(h)
+        return names
+
+    def get (self, h, default=None):
+        n = bisect.bisect_left(self.hashes, h)
+        names = []
+        while n < len(self.hashes)  and  self.hashes[n] == h:
+            names.append(self.name(n))
+            n += 1
+        if len(names) == 0:
+            return default
+        return names
+
+    # yields [hash:int, funcName:str] in index order
+    def entries (self):
+        for n in range(len(self.hashes)):
+            yield [self.hashes[n], self.name(n)]
+
+    def close (self):
+        self.data.close()
+
+# merges .hmap files and other indexes
+class HashIndexBuilder:
+    def __init__ (self, hashBits=32):
+        if hashBits not in HASH_FORMATS:
+            raise HashIndexFormatError("unsupported hash size %d" % hashBits)
+        self.hashBits = hashBits
+        self.entries = []  # [ [hash:int, funcName:str], ... ]
+        self.entrySet = set()
+
+    # returns True if it wasn't already added
+    def add (self, h, funcName):
+        limit = 1 << (self.hashBits - 1)
+        if h < -limit  or  h >= limit:
+            raise HashIndexFormatError("hash value %d of %s isn't %d-bit" % (h, funcName, self.hashBits))
+        if (h, funcName) in self.entrySet:
+            return False
+        self.entrySet.add((h, funcName))
+        self.entries.append([h, funcName])
+        return True
+
+    # prefix is prepended to the function names, ex: "cpma:"
+    def add_hmap (self, fname, prefix=""):
+        count = 0
+        for (h, funcName) in read_hmap(fname):
+            if self.add(h, prefix + funcName):
+                count += 1
+        return count
+
+    def add_index (self, fname, prefix=""):
+        index = FunctionHashIndex(fname)
+        count = 0
+        try:
+            if index.hashBits != self.hashBits:
+                raise HashIndexFormatError("%s has %d-bit hashes instead of %d-bit" % (fname, index.hashBits, self.hashBits))
+            for (h, funcName) in index.entries():
+                if self.add(h, prefix + funcName):
+                    count += 1
+        finally:
+            index.close()
+        return count
+
+    def write (self, fname):
+        # stable, names with the same hash stay in the order they were added
+        entries = sorted(self.entries, key=lambda e: e[0])
+
+        hashFormat = HASH_FORMATS[self.hashBits]
+        hashBytes = b"".join(struct.pack(hashFormat, h) for (h, funcName) in entries)
+        names = [_encode_name(funcName) for (h, funcName) in entries]
+        nameOffsets = [0]
+        for n in names:
+            nameOffsets.append(nameOffsets[-1] + len(n))
+        stringBytes = b"".join(names)
+
+        # a reader never maps a partial index
+        atomic_write(fname, b"".join([
+            INDEX_MAGIC,
+            struct.pack("<LLLL", INDEX_FORMAT_VERSION, self.hashBits, len(entries), len(stringBytes)),
+            hashBytes,
+            struct.pack("<%dL" % len(nameOffsets), *nameOffsets),
+            stringBytes]))
+
+# several hash sources searched in order, the names from all of them are
+# returned
+#
+# sources:[]  dicts { hash:int -> [ funcName1, ... ] } or FunctionHashIndex
+class FunctionHashLookup:
+    def __init__ (self, sources):
+        self.sources = sources
+
+    def __contains__ (self, h):
+        for s in self.sources:
+            if h in s:
+                return True
+        return False
+
+    def __getitem__ (self, h):
+        names = []
+        for s in self.sources:
+            if h in s:
+                names.extend(s[h])
+        if len(names) == 0:
+            raise KeyError(h)
+        return names
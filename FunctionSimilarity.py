@@ -0,0 +1,238 @@
+####
+# Copyright (C) 2012, 2020 Angelo Cano
+#
+# This file is part of Qvmdis.
+#
+# Qvmdis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Qvmdis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Qvmdis.  If not, see <https://www.gnu.org/licenses/>.
+####
+
+# finds known functions that are similar to a function that doesn't have an
+# exact hash match
+#
+# A function is the set of hashes of its opcode n-grams (shingles).  The
+# MinHash signature keeps the smallest value of each of the permutation
+# functions over that set, and the fraction of equal signature values
+# estimates the Jaccard similarity of two functions.  Signatures are split
+# into bands, functions sharing any band end up in the same bucket and only
+# those candidates are compared with a query.
+#
+# Index file format (little endian):
+#
+#   magic             4 bytes  "QVMS"
+#   formatVersion     uint32
+#   permutations      uint32
+#   bands             uint32
+#   shingleSize       uint32
+#   seed              uint32
+#   entryCount        uint32
+#   stringsLength     uint32
+#   signatures        int32 * permutations * entryCount
+#   strings           utf-8 function names, '\n' separated
+
+from PythonCompat import xarray_frombytes, xarray_tobytes
+from AnalysisCache import atomic_write
+import array, os, struct, sys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+INDEX_MAGIC = b"QVMS"
+INDEX_FORMAT_VERSION = 1
+INDEX_FILE_EXTENSION = ".qsim"
+INDEX_HEADER_SIZE = 32
+
+# permutation functions are (a * x + b) % MINHASH_PRIME
+MINHASH_PRIME = 0x7fffffff
+
+DEFAULT_PERMUTATIONS = 64
+DEFAULT_BANDS = 16
+DEFAULT_SHINGLE_SIZE = 4
+DEFAULT_SEED = 0x71766d
+
+# use numpy to compute signatures if it's available
+UseNumpy = True
+
+class SimilarityIndexError(Exception):
+    pass
+
+# returns [ [a, b], ... ], the same for every python version
+def minhash_parameters (count, seed):
+    params = []
+    state = seed
+    for i in range(count):
+        state = (state * 6364136223846793005 + 1442695040888963407) & 0xffffffffffffffff
+        a = (state >> 33) % (MINHASH_PRIME - 1) + 1
+        state = (state * 6364136223846793005 + 1442695040888963407) & 0xffffffffffffffff
+        b = (state >> 33) % MINHASH_PRIME
+        params.append([a, b])
+    return params
+
+# tokens:[int, ...]  returns [shingleHash1:int, ...] without duplicates,
+# functions shorter than shingleSize are a single shingle
+def shingle_hashes (tokens, shingleSize):
+    if len(tokens) == 0:
+        return []
+    count = max(1, len(tokens) - shingleSize + 1)
+    hashes = set()
+    for i in range(count):
+        # fnv-1a
+        h = 0x811c9dc5
+        for t in tokens[i : i + shingleSize]:
+            h = ((h ^ (t & 0xffffffff)) * 16777619) & 0xffffffff
+        hashes.add(h % MINHASH_PRIME)
+    return sorted(hashes)
+
+class SimilarityIndex:
+    def __init__ (self, permutations=DEFAULT_PERMUTATIONS, bands=DEFAULT_BANDS, shingleSize=DEFAULT_SHINGLE_SIZE, seed=DEFAULT_SEED):
+        if bands < 1  or  permutations % bands != 0:
+            raise SimilarityIndexError("%d permutations can't be split into %d bands" % (permutations, bands))
+        self.permutations = permutations
+        self.bands = bands
+        self.rowsPerBand = permutations // bands
+        self.shingleSize = shingleSize
+        self.seed = seed
+        self.params = minhash_parameters(permutations, seed)
+
+        self.names = []  # [ funcName1:str, ... ]
+        self.signatures = []  # [ signature1:tuple, ... ]
+        self.buckets = {}  # (band:int, bandValues:tuple) -> [ entryNum1:int, ... ]
+
+    def parameters (self):
+        return (self.permutations, self.bands, self.shingleSize, self.seed)
+
+    # returns a tuple of permutation minimums or None if there aren't any
+    # tokens
+    def signature (self, tokens):
+        shingles = shingle_hashes(tokens, self.shingleSize)
+        if len(shingles) == 0:
+            return None
+
+        if numpy != None  and  UseNumpy:
+            # a * x + b < 2**62, no overflow
+            x = numpy.array(shingles, dtype=numpy.int64)
+            a = numpy.array([p[0] for p in self.params], dtype=numpy.int64).reshape(-1, 1)
+            b = numpy.array([p[1] for p in self.params], dtype=numpy.int64).reshape(-1, 1)
+            return tuple(int(v) for v in ((a * x + b) % MINHASH_PRIME).min(axis=1))
+
+        return tuple([min([(a * x + b) % MINHASH_PRIME for x in shingles]) for (a, b) in self.params])
+
+    def band_keys (self, signature):
+        r = self.rowsPerBand
+        return [(band, signature[band * r : (band + 1) * r]) for band in range(self.bands)]
+
+    def add (self, funcName, signature):
+        n = len(self.names)
+        self.names.append(funcName)
+        self.signatures.append(signature)
+        for key in self.band_keys(signature):
+            if key in self.buckets:
+                self.buckets[key].append(n)
+            else:
+                self.buckets[key] = [n]
+
+    # returns False if the function doesn't have any tokens
+    def add_tokens (self, funcName, tokens):
+        signature = self.signature(tokens)
+        if signature == None:
+            return False
+        self.add(funcName, signature)
+        return True
+
+    # Returns up to topCount [ [score:float, funcName:str], ... ] with the
+    # highest score first.  Only functions sharing a bucket with the query
+    # are scored, so the time doesn't depend on the size of the index.
+    def query (self, tokens, topCount=3, minScore=0.0):
+        signature = self.signature(tokens)
+        if signature == None:
+            return []
+
+        candidates = set()
+        for key in self.band_keys(signature):
+            if key in self.buckets:
+                candidates.update(self.buckets[key])
+
+        best = {}  # funcName:str -> [score:float, entryNum:int]
+        for n in candidates:
+            other = self.signatures[n]
+            same = 0
+            for i in range(self.permutations):
+                if signature[i] == other[i]:
+                    same += 1
+            score = float(same) / self.permutations
+            if score < minScore:
+                continue
+            name = self.names[n]
+            if name not in best  or  score > best[name][0]:
+                best[name] = [score, n]
+
+        # ties are listed in the order they were added
+        matches = sorted(best.items(), key=lambda item: (-item[1][0], item[1][1]))
+        return [[score, name] for (name, (score, n)) in matches[:topCount]]
+
+    # adds the entries of an index file, the file needs to use the same
+    # parameters
+    def read (self, fname):
+        f = open(fname, "rb")
+        data = f.read()
+        f.close()
+
+        if len(data) < INDEX_HEADER_SIZE  or  data[:4] != INDEX_MAGIC:
+            raise SimilarityIndexError("%s isn't a similarity index" % fname)
+        (formatVersion, permutations, bands, shingleSize, seed, entryCount, stringsLength) = struct.unpack("<LLLLLLL", data[4:INDEX_HEADER_SIZE])
+        if formatVersion != INDEX_FORMAT_VERSION:
+            raise SimilarityIndexError("%s has unsupported format version %d" % (fname, formatVersion))
+        if (permutations, bands, shingleSize, seed) != self.parameters():
+            raise SimilarityIndexError("%s was built with different parameters" % fname)
+        signaturesLength = entryCount * permutations * 4
+        if INDEX_HEADER_SIZE + signaturesLength + stringsLength != len(data):
+            raise SimilarityIndexError("%s has invalid length" % fname)
+
+        values = array.array('i')
+        xarray_frombytes(values, data[INDEX_HEADER_SIZE : INDEX_HEADER_SIZE + signaturesLength])
+        if sys.byteorder != "little":
+            values.byteswap()
+
+        s = data[INDEX_HEADER_SIZE + signaturesLength:].decode("utf-8")
+        if str is bytes:
+            s = s.encode("utf-8")
+        if entryCount > 0:
+            names = s.split("\n")
+        else:
+            names = []
+        if len(names) != entryCount:
+            raise SimilarityIndexError("%s has %d names for %d functions" % (fname, len(names), entryCount))
+
+        for n in range(entryCount):
+            self.add(names[n], tuple(values[n * permutations : (n + 1) * permutations]))
+
+        return entryCount
+
+    def write (self, fname):
+        values = array.array('i')
+        for signature in self.signatures:
+            values.extend(signature)
+        if sys.byteorder != "little":
+            values.byteswap()
+        stringBytes = "\n".join(self.names)
+        if not isinstance(stringBytes, bytes):
+            stringBytes = stringBytes.encode("utf-8")
+
+        # a reader never sees a partial index
+        atomic_write(fname, b"".join([
+            INDEX_MAGIC,
+            struct.pack("<LLLLLLL", INDEX_FORMAT_VERSION, self.permutations, self.bands, self.shingleSize, self.seed, len(self.names), len(stringBytes)),
+            xarray_tobytes(values),
+            stringBytes]))
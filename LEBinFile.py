@@ -19,7 +19,7 @@
 
 from PythonCompat import xord
 # little endian binary file
-import struct
+import mmap, struct
 
 class LEBinFile:
     def __init__ (self, fname):
@@ -45,5 +45,9 @@ class LEBinFile:
     def tell (self):
         return self._file.tell()
 
+    # read only mapping of the whole file, still valid after close()
+    def mmap (self):
+        return mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+
     def close (self):
         self._file.close()
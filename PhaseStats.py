@@ -0,0 +1,125 @@
+####
+# Copyright (C) 2012, 2020 Angelo Cano
+#
+# This file is part of Qvmdis.
+#
+# Qvmdis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Qvmdis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Qvmdis.  If not, see <https://www.gnu.org/licenses/>.
+####
+
+# wall time, cpu time, and optionally peak memory of each phase of a run
+#
+# Phases can be nested, the times of a phase include the ones started inside
+# it.  Peak memory is the most allocated during the phase above what was
+# allocated when it started, it needs tracemalloc.reset_peak() from python
+# 3.9.
+
+import json, time
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+STATS_FORMAT_VERSION = 1
+
+if hasattr(time, "perf_counter"):
+    wall_clock = time.perf_counter
+else:
+    wall_clock = time.time
+
+if hasattr(time, "process_time"):
+    cpu_clock = time.process_time
+else:
+    # python 2, processor time on unix
+    cpu_clock = time.clock
+
+def can_trace_memory ():
+    return tracemalloc != None  and  hasattr(tracemalloc, "reset_peak")
+
+class Phase:
+    def __init__ (self, name, depth):
+        self.name = name
+        self.depth = depth
+        self.wallTime = 0.0
+        self.cpuTime = 0.0
+        self.peakMemory = None
+
+        self.startWall = 0.0
+        self.startCpu = 0.0
+        self.startMemory = 0
+        self.maxMemory = 0
+
+class PhaseStats:
+    def __init__ (self, traceMemory=False):
+        self.traceMemory = traceMemory  and  can_trace_memory()
+        self.phases = []  # [ phase1:Phase, ... ] in the order they started
+        self.stack = []  # [ outerPhase:Phase, ..., innerPhase:Phase ]
+        self.startedTracing = False
+
+    # the peak since the last reset counts for all the running phases
+    def update_peak (self):
+        peak = tracemalloc.get_traced_memory()[1]
+        for p in self.stack:
+            p.maxMemory = max(p.maxMemory, peak)
+        tracemalloc.reset_peak()
+
+    def begin (self, name):
+        p = Phase(name, len(self.stack))
+        if self.traceMemory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+                self.startedTracing = True
+            self.update_peak()
+            p.startMemory = tracemalloc.get_traced_memory()[0]
+            p.maxMemory = p.startMemory
+        self.phases.append(p)
+        self.stack.append(p)
+        p.startWall = wall_clock()
+        p.startCpu = cpu_clock()
+
+    def end (self):
+        p = self.stack[-1]
+        p.wallTime = wall_clock() - p.startWall
+        p.cpuTime = cpu_clock() - p.startCpu
+        if self.traceMemory:
+            self.update_peak()
+            p.peakMemory = p.maxMemory - p.startMemory
+        self.stack.pop()
+        if self.startedTracing  and  len(self.stack) == 0:
+            tracemalloc.stop()
+            self.startedTracing = False
+
+    # counts:{} name:str -> count:int
+    def write_report (self, out, counts={}):
+        out.write(";; stats\n")
+        for p in self.phases:
+            name = "  " * p.depth + p.name
+            if p.peakMemory != None:
+                mem = "  %10.1f KiB" % (p.peakMemory / 1024.0)
+            else:
+                mem = ""
+            out.write("%-40s %9.4fs wall %9.4fs cpu%s\n" % (name, p.wallTime, p.cpuTime, mem))
+        out.write("\n")
+        for name in sorted(counts.keys()):
+            out.write("%-40s %9d\n" % (name, counts[name]))
+
+    def write_json (self, out, counts={}):
+        phases = []
+        for p in self.phases:
+            d = { "name" : p.name, "depth" : p.depth, "wallTime" : p.wallTime, "cpuTime" : p.cpuTime }
+            if p.peakMemory != None:
+                d["peakMemory"] = p.peakMemory
+            phases.append(d)
+        json.dump({ "version" : STATS_FORMAT_VERSION, "phases" : phases, "counts" : counts }, out, indent=1, sort_keys=True)
+        out.write("\n")
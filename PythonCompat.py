@@ -46,3 +46,38 @@ def xchr (i):
     else:
         return chr(i)
 
+
+# ascii byte string to the native str type
+def xascii (b):
+    if isinstance(b, str):
+        return b
+    else:
+        return b.decode("ascii")
+
+
+# zero-copy slice of a buffer, python 2 mmap objects don't support
+# memoryview() so fall back to buffer()
+def xmemoryview (obj, offset, length):
+    try:
+        return memoryview(obj)[offset : offset + length]
+    except TypeError:
+        return buffer(obj, offset, length)  # pylint: disable=undefined-variable
+
+# array.fromstring() and tostring() were renamed in python 3
+def xarray_frombytes (a, s):
+    if hasattr(a, "frombytes"):
+        a.frombytes(s)
+    else:
+        a.fromstring(s)
+
+def xarray_tobytes (a):
+    if hasattr(a, "tobytes"):
+        return a.tobytes()
+    else:
+        return a.tostring()
+
+# in-memory text stream that accepts the native str type
+try:
+    from cStringIO import StringIO as xStringIO
+except ImportError:
+    from io import StringIO as xStringIO
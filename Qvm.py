@@ -17,34 +17,81 @@
 # along with Qvmdis.  If not, see <https://www.gnu.org/licenses/>.
 ####
 
-import os.path, re, struct, sys
+import array, atexit, bisect, hashlib, marshal, multiprocessing, os.path, re, struct, sys, zlib
+from AnalysisCache import AnalysisCache, IntReader, IntWriter, CacheFormatError, content_digest, atomic_write
 from DecompileStack import DecompileStack
+from FunctionSimilarity import SimilarityIndex, SimilarityIndexError
+from FunctionHashIndex import FunctionHashIndex, FunctionHashLookup, HashIndexFormatError, INDEX_FILE_EXTENSION, read_hmap
 from LEBinFile import LEBinFile
-from PythonCompat import atoi, xord, xchr
+from PythonCompat import atoi, xord, xchr, xascii, xmemoryview, xStringIO
+
+# optional, used for faster instruction decoding
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 # python hash() builtin gives different values for 32-bit and 64-bit implementations
 # http://effbot.org/zone/python-hash.htm
+#
+# Function hashes are the python 2 string hash of the decimal opcodes and
+# some of the parameters.  FunctionHasher updates it for each value instead of
+# building the string first.  With 64 bits it's the hash 64-bit python
+# builds use, which has fewer collisions in large collections of functions.
+
+FUNCTION_HASH_MULTIPLIER = 1000003
 
-def c_mul(a, b):
-    #v = eval(hex((long(a) * b) & 0xFFFFFFFFL)[:-1])
-    # 32-bit signed
-    v = a * b
-    v = v & 0xffffffff
-
-    if v > 0x7fffffff:
-        v = -(0x100000000 - v)
-    return v
-
-def hash32BitSigned (str):
-    if not str:
-        return 0  # empty
-    value = ord(str[0]) << 7
-    for char in str:
-        value = c_mul(1000003, value) ^ ord(char)
-    value = value ^ len(str)
-    if value == -1:
-        value = -2
-    return value
+# opcode:int -> decimal digits as character codes
+OPCODE_CHAR_CODES = [bytearray(("%d" % opc).encode("ascii")) for opc in range(256)]
+
+class FunctionHasher:
+    def __init__ (self, bits=32):
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        self.reset()
+
+    def reset (self):
+        self.value = None
+        self.length = 0
+
+    # codes:[int, ...] character codes
+    def update_codes (self, codes):
+        if len(codes) == 0:
+            return
+        value = self.value
+        if value == None:
+            value = codes[0] << 7
+        mask = self.mask
+        for c in codes:
+            value = ((value * FUNCTION_HASH_MULTIPLIER) & mask) ^ c
+        self.value = value
+        self.length += len(codes)
+
+    def update_opcode (self, opc):
+        self.update_codes(OPCODE_CHAR_CODES[opc])
+
+    # decimal digits of n
+    def update_int (self, n):
+        self.update_codes(bytearray(("%d" % n).encode("ascii")))
+
+    def update_string (self, s):
+        self.update_codes([ord(c) for c in s])
+
+    # signed value
+    def digest (self):
+        if self.value == None:
+            return 0  # empty
+        value = (self.value ^ self.length) & self.mask
+        if value > (self.mask >> 1):
+            value -= self.mask + 1
+        if value == -1:
+            value = -2
+        return value
+
+def hash32BitSigned (s):
+    hasher = FunctionHasher()
+    hasher.update_string(s)
+    return hasher.digest()
 
 # detect hex or base 10, also explicitly require 0[xX] hex notation to make
 # it easier to check if something is a number or a symbol.  Ex: c.isdigit()
@@ -87,21 +134,67 @@ COMMENTS_FILE = "comments.dat"
 TEMPLATES_DEFAULT_FILE = "templates-default.dat"
 TEMPLATES_FILE = "templates.dat"
 
+# parsed templates are cached next to the template file, ex:
+# templates-default.dat.cache
+TEMPLATES_CACHE_EXTENSION = ".cache"
+TEMPLATES_CACHE_MAGIC = b"QVMT"
+TEMPLATES_CACHE_VERSION = 1
+
 QVM_MAGIC_VER1 = 0x12721444
 QVM_MAGIC_VER2 = 0x12721445
 
+# output is collected and written in chunks of about this many characters
+OUTPUT_SINK_CHUNK_SIZE = 1024 * 1024
+
+# Buffered destination for disassembly output.
+#
+# stream:  file, pipe or in-memory (ex: xStringIO) object with a write()
+#          method, None for the current sys.stdout
+class OutputSink:
+    def __init__ (self, stream=None, chunkSize=OUTPUT_SINK_CHUNK_SIZE):
+        self.stream = stream
+        self.chunkSize = chunkSize
+        self.stringList = []
+        self.size = 0
+
+    def write (self, s):
+        self.stringList.append(s)
+        self.size += len(s)
+        if self.size >= self.chunkSize:
+            self.flush()
+
+    def flush (self):
+        if len(self.stringList) == 0:
+            return
+        stream = self.stream
+        if stream == None:
+            stream = sys.stdout
+        stream.write("".join(self.stringList))
+        self.stringList = []
+        self.size = 0
+
+# where output(), warnings, and print_*() methods write by default
+Output = OutputSink()
+
 def output (msg):
-    sys.stdout.write(msg)
+    Output.write(msg)
+
+def flush_output ():
+    Output.flush()
+
+atexit.register(flush_output)
 
 class OutputBuffer:
-    def __init__ (self):
+    # out:OutputSink
+    def __init__ (self, out):
+        self.out = out
         self.clear()
 
     def write (self, s):
         self.stringList.append(s)
 
     def flush (self):
-        output("".join(self.stringList))
+        self.out.write("".join(self.stringList))
         self.clear()
 
     def clear (self):
@@ -109,21 +202,48 @@ class OutputBuffer:
 
 SuppressWarnings = False
 
+# use the numpy instruction decoder if numpy is available
+UseNumpyDecoder = True
+
+# use and update the parsed templates cache files
+UseTemplateCache = True
+
+# directory for cached function analysis results, None to disable
+AnalysisCacheDir = None
+AnalysisCacheMaxSize = 64 * 1024 * 1024
+
+# 32 or 64, the stock .hmap files only have 32-bit hashes
+FunctionHashBits = 32
+
+# additional function hash index files (.hidx) searched after the baseq3 hashes
+FunctionHashIndexFiles = []
+
+# similarity index files (.qsim) used to suggest names for functions without
+# a hash match
+SimilarityIndexFiles = []
+SimilarityTopCount = 3
+SimilarityMinScore = 0.5
+
+# increase when compute_function_info() results change so that old cache
+# entries aren't used
+ANALYSIS_VERSION = 1
+
 def warning_msg (msg):
     global SuppressWarnings
     if SuppressWarnings:
         return
-    # send to both stdout and stderr since output is usually redirected to file
-    sys.stdout.write("; warning : %s\n" % msg)
+    # send to both output and stderr since output is usually redirected to file
+    output("; warning : %s\n" % msg)
     sys.stderr.write("warning: %s\n" % msg)
 
 def error_msg (msg):
-    # send to both stdout and stderr since output is usually redirected to file
-    sys.stdout.write("---- error occurred : %s\n" % msg)
+    # send to both output and stderr since output is usually redirected to file
+    output("---- error occurred : %s\n" % msg)
     sys.stderr.write("ERROR: %s\n" % msg)
 
 def error_exit (msg, exitValue = 1):
     error_msg(msg)
+    flush_output()
     sys.exit(exitValue)
 
 OPCODE_NAME = 0
@@ -304,7 +424,7 @@ class RangeException(Exception):
     pass
 
 class RangeElement:
-    def __init__ (self, size=0, symbolName="", symbolType=SYMBOL_RANGE, isPointer=False, pointerType="", pointerDepth=0, isArray=False, arrayLevels=[], arrayTemplate="", arrayElementSize=0):
+    def __init__ (self, size=0, symbolName="", symbolType=SYMBOL_RANGE, isPointer=False, pointerType="", pointerDepth=0, isArray=False, arrayLevels=[], arrayTemplate="", arrayElementSize=0, template=""):
         self.size = size;
         self.symbolName = symbolName
 
@@ -327,7 +447,171 @@ class RangeElement:
         if isArray:
             self.symbolType = SYMBOL_RANGE
 
+        # template instance, members are looked up through the template
+        self.template = template
+
+# sorted lookup of the intervals that start at or contain an address
+#
+# Containing intervals are found, closest start first, with a max segment
+# tree over interval end addresses sorted by start address.
+class IntervalIndex:
+    # entries:[ [start:int, extent:int], ... ]
+    def __init__ (self, entries):
+        # stable, entries starting at the same address keep their order
+        self.order = sorted(range(len(entries)), key=lambda i: entries[i][0])
+        self.starts = [entries[i][0] for i in self.order]
+
+        # leaves start at treeSize, padding leaves are never visited
+        self.treeSize = 1
+        while self.treeSize < len(entries):
+            self.treeSize *= 2
+        self.maxEnds = [0] * (2 * self.treeSize)
+        self.maxEnds[self.treeSize : self.treeSize + len(entries)] = [entries[i][0] + entries[i][1] for i in self.order]
+        for i in range(self.treeSize - 1, 0, -1):
+            self.maxEnds[i] = max(self.maxEnds[2 * i], self.maxEnds[2 * i + 1])
+
+    # returns the sorted position of the last interval, before position n,
+    # that ends after addr or -1
+    def last_containing (self, n, addr):
+        if n <= 0:
+            return -1
+
+        maxEnds = self.maxEnds
+        i = self.treeSize + n - 1
+        while True:
+            if maxEnds[i] > addr:
+                # descend, preferring the right side
+                while i < self.treeSize:
+                    i *= 2
+                    if maxEnds[i + 1] > addr:
+                        i += 1
+                return i - self.treeSize
+
+            # move to the subtree just to the left
+            while (i & 1) == 0:
+                i >>= 1
+            if i == 1:
+                return -1
+            i -= 1
+
+    # returns [ entryNum1:int, entryNum2:int, ... ] in entries order
+    def stab (self, addr):
+        lo = bisect.bisect_left(self.starts, addr)
+        hi = bisect.bisect_right(self.starts, addr)
+        found = self.order[lo:hi]
+        i = self.last_containing(lo, addr)
+        while i >= 0:
+            found.append(self.order[i])
+            i = self.last_containing(i, addr)
+        found.sort()
+        return found
+
+class RangeLookup:
+    def __init__ (self, addr):
+        self.addr = addr
+        self.exactMatches = []  # [ sym1:str, sym2:str, ... ]
+        self.exactRanges = []  # [ range1:RangeElement or TemplateMember, ... ]
+        self.match = None
+        self.matchSym = ""
+        self.matchDiff = 0
+        self.matchRangeSize = 0
+
+    # same rules as scanning all ranges in declaration order:  exact matches
+    # are all kept, otherwise the containing range with the closest start
+    # wins and the smallest if several start at the same address
+    def add (self, sym, rangeAddr, size, r):
+        addr = self.addr
+        if addr == rangeAddr:
+            self.exactMatches.append(sym)
+            self.exactRanges.append(r)
+        elif addr > rangeAddr  and  addr < (rangeAddr + size):
+            if self.match == None  or  rangeAddr > self.match  or  (rangeAddr == self.match  and  size < self.matchRangeSize):
+                self.match = rangeAddr
+                self.matchSym = sym
+                self.matchDiff = addr - rangeAddr
+                self.matchRangeSize = size
+
+# symbol ranges with template members resolved when they are looked up
+# instead of being copied for every symbol
+class SymbolRangeIndex:
+    # ranges:[ [addr:int, range:RangeElement], ... ] in declaration order
+    # templates:{} name:str -> template:Template
+    def __init__ (self, ranges, templates={}):
+        self.ranges = ranges
+        self.templates = templates
+
+        entries = []
+        for (addr, r) in ranges:
+            extent = r.size
+            if r.template in templates:
+                extent = max(extent, templates[r.template].member_extent())
+            entries.append([addr, extent])
+        self.index = IntervalIndex(entries)
+
+    # count:  only check the first count declared ranges
+    def lookup (self, addr, count=None):
+        result = RangeLookup(addr)
+        for i in self.index.stab(addr):
+            if count != None  and  i >= count:
+                break
+            (rangeAddr, r) = self.ranges[i]
+            result.add(r.symbolName, rangeAddr, r.size, r)
+            if r.template:
+                self.lookup_template(result, r.symbolName, rangeAddr, r.template)
+            self.lookup_array(result, r.symbolName, rangeAddr, r)
+        return result
+
+    def lookup_template (self, result, sym, templateAddr, templateName):
+        if templateName not in self.templates:
+            return
+        template = self.templates[templateName]
+        members = template.members
+        for i in template.member_index().stab(result.addr - templateAddr):
+            m = members[i]
+            msym = "%s.%s" % (sym, m.name)
+            maddr = templateAddr + m.offset
+            result.add(msym, maddr, m.size, m)
+            self.lookup_array(result, msym, maddr, m)
+
+    # descend into the element of template arrays, ex: ents[3].pos
+    def lookup_array (self, result, sym, arrayAddr, r):
+        if not r.isArray  or  r.arrayTemplate not in self.templates  or  r.arrayElementSize <= 0:
+            return
+        addr = result.addr
+        if addr < arrayAddr  or  addr >= arrayAddr + r.size:
+            return
+
+        elementNum = (addr - arrayAddr) // r.arrayElementSize
+        indexStr = ""
+        n = elementNum
+        for a in reversed(r.arrayLevels):
+            indexStr = "[%d]" % (n % a.value) + indexStr
+            n //= a.value
+
+        esym = sym + indexStr
+        eaddr = arrayAddr + elementNum * r.arrayElementSize
+        result.add(esym, eaddr, r.arrayElementSize, RangeElement(size=r.arrayElementSize, symbolName=esym, template=r.arrayTemplate))
+        self.lookup_template(result, esym, eaddr, r.arrayTemplate)
+
+    # returns (match:int or None, matchSym:str, matchDiff:int, exactMatches:[str, ...])
+    def find (self, addr):
+        result = self.lookup(addr)
+        return (result.match, result.matchSym, result.matchDiff, result.exactMatches)
+
+    # returns [ range1:RangeElement, range2:RangeElement, ... ] starting at addr
+    def ranges_at (self, addr):
+        result = self.lookup(addr)
+        ranges = []
+        for (sym, r) in zip(result.exactMatches, result.exactRanges):
+            if isinstance(r, TemplateMember):
+                r = RangeElement(size=r.size, symbolType=r.symbolType, symbolName=sym, isPointer=r.isPointer, pointerType=r.pointerType, pointerDepth=r.pointerDepth, isArray=r.isArray, arrayLevels=r.arrayLevels, arrayTemplate=r.arrayTemplate, arrayElementSize=r.arrayElementSize)
+            ranges.append(r)
+        return ranges
+
 class TemplateMember:
+    # order of values in to_tuple() and from_tuple()
+    FIELDS = ("offset", "size", "name", "symbolType", "isPointer", "pointerType", "pointerDepth", "parentTemplatesInfo", "isArray", "arrayLevels", "arrayTemplate", "arrayElementSize", "aliasUsed", "origName")
+
     def __init__ (self, offset=0, size=0, name="", symbolType=SYMBOL_RANGE, isPointer=False, pointerType="", pointerDepth=0, parentTemplatesInfo=[], isArray=False, arrayLevels=[], arrayTemplate="", arrayElementSize=0, aliasUsed=False, origName=""):
         self.offset = offset
         self.size = size
@@ -349,6 +633,25 @@ class TemplateMember:
         # info with respect to parent templates
         self.parentTemplatesInfo = parentTemplatesInfo  # [ [parentTemplate1:str, name1:str, offset1:int, isTemplateRange1:bool, ourTemplate1:str], [parentTemplate2:str, name2:str, offset2:int, isTemplateRange2:bool, ourTemplate2:str], ... ]
 
+    # basic types only, for the templates cache
+    def to_tuple (self):
+        values = []
+        for f in TemplateMember.FIELDS:
+            if f == "arrayLevels":
+                values.append([(a.value, a.name) for a in self.arrayLevels])
+            else:
+                values.append(getattr(self, f))
+        return tuple(values)
+
+    @staticmethod
+    def from_tuple (values):
+        m = TemplateMember()
+        for (f, v) in zip(TemplateMember.FIELDS, values):
+            if f == "arrayLevels":
+                v = [ArraySize(a[0], name=a[1]) for a in v]
+            setattr(m, f, v)
+        return m
+
 class AliasInfo:
     def __init__ (self, name, declaration, expansion):
         self.name = name
@@ -363,11 +666,40 @@ class ForwardDeclaration:
         self.line = line
 
 class Template:
-    def __init__ (self, size, paddingSize, paddingUsed, members=[]):
+    # membersData:  compressed and marshaled member tuples from the templates
+    #               cache, members are only created if they're used
+    def __init__ (self, size, paddingSize, paddingUsed, members=[], membersData=None):
         self.size = size
         self.paddingSize = paddingSize
         self.paddingUsed = paddingUsed
-        self.members = members  # [ member1:TemplateMember, member2:TemplateMember, ... ]
+        if membersData is not None:
+            self.membersData = membersData
+        else:
+            self.members = members  # [ member1:TemplateMember, member2:TemplateMember, ... ]
+        self.membersIndex = None
+        self.membersExtent = None
+
+    def __getattr__ (self, name):
+        if name != "members"  or  "membersData" not in self.__dict__:
+            raise AttributeError(name)
+        self.members = [TemplateMember.from_tuple(t) for t in marshal.loads(zlib.decompress(self.membersData))]
+        del self.membersData
+        return self.members
+
+    # members are sorted by offset the first time a symbol address is
+    # resolved into one of them
+    def member_index (self):
+        if self.membersIndex is None:
+            self.membersIndex = IntervalIndex([[m.offset, m.size] for m in self.members])
+        return self.membersIndex
+
+    # includes members past the declared size
+    def member_extent (self):
+        if self.membersExtent is None:
+            self.membersExtent = self.size
+            for m in self.members:
+                self.membersExtent = max(self.membersExtent, m.offset + max(m.size, 1))
+        return self.membersExtent
 
 class TemplateManager:
     def __init__ (self):
@@ -375,6 +707,7 @@ class TemplateManager:
         self.arrayConstants = {}  # name:str -> value:int
         self.templateAliases = {}  # name:str -> sub:AliasInfo
         self.forwardDeclarations = []  # [ declaration1:ForwardDeclaration ... ]
+        self.loadWarnings = []  # [ msg1:str, msg2:str, ... ]  replayed when loaded from cache
 
     def pad_up (self, offset, paddingSize):
         if paddingSize < 0:
@@ -593,7 +926,9 @@ class TemplateManager:
         def ferror_exit (msg):
             error_exit("%s in line %d of %s: %s" % (msg, lineCount + 1, fname, line))
         def fwarning_msg (msg):
-            warning_msg("%s in line %d of %s: %s" % (msg, lineCount + 1, fname, line))
+            m = "%s in line %d of %s: %s" % (msg, lineCount + 1, fname, line)
+            self.loadWarnings.append(m)
+            warning_msg(m)
 
         f = open(fname)
         lines = f.readlines()
@@ -842,17 +1177,101 @@ class TemplateManager:
 
     def load_default_templates (self):
         fname = TEMPLATES_DEFAULT_FILE
+        if not os.path.exists(fname):
+            # no override of default one
+            fname = os.path.join(BASE_DIR, TEMPLATES_DEFAULT_FILE)
         if os.path.exists(fname):
-            # override default one
-            self.load_symbol_templates_file(fname, allowOverride=False)
+            defaultSources = [fname]
         else:
-            fname = os.path.join(BASE_DIR, TEMPLATES_DEFAULT_FILE)
-            if os.path.exists(fname):
-                self.load_symbol_templates_file(fname, allowOverride=False)
+            defaultSources = []
+
+        sources = defaultSources[:]
+        if os.path.exists(TEMPLATES_FILE):
+            sources.append(TEMPLATES_FILE)
+            # cache has the result of both files
+            if self.load_templates_cache(sources):
+                return
+
+        if len(defaultSources) > 0:
+            if not self.load_templates_cache(defaultSources):
+                self.load_symbol_templates_file(defaultSources[0], allowOverride=False)
+                self.save_templates_cache(defaultSources)
+
+        if len(sources) > len(defaultSources):
+            self.load_symbol_templates_file(TEMPLATES_FILE, allowOverride=True)
+            self.save_templates_cache(sources)
+
+    # Cache files are stored next to the last source file and are only valid
+    # for the same source files, modification times, and contents.
+    def templates_cache_key (self, sources):
+        key = [TEMPLATES_CACHE_VERSION, tuple(sys.version_info[:2])]
+        for fname in sources:
+            f = open(fname, "rb")
+            data = f.read()
+            f.close()
+            key.append((os.path.abspath(fname), os.path.getmtime(fname), hashlib.sha1(data).hexdigest()))
+        return tuple(key)
 
-        fname = TEMPLATES_FILE
-        if os.path.exists(fname):
-            self.load_symbol_templates_file(fname, allowOverride=True)
+    def load_templates_cache (self, sources):
+        global UseTemplateCache
+        if not UseTemplateCache:
+            return False
+
+        cacheName = sources[-1] + TEMPLATES_CACHE_EXTENSION
+        if not os.path.exists(cacheName):
+            return False
+
+        try:
+            f = open(cacheName, "rb")
+            try:
+                if f.read(len(TEMPLATES_CACHE_MAGIC)) != TEMPLATES_CACHE_MAGIC:
+                    return False
+                if marshal.load(f) != self.templates_cache_key(sources):
+                    return False
+                (templates, arrayConstants, aliases, loadWarnings) = marshal.load(f)
+            finally:
+                f.close()
+        except (IOError, OSError, EOFError, ValueError, TypeError, zlib.error):
+            # unreadable or written by another python version
+            return False
+
+        self.symbolTemplates = {}
+        for name in templates:
+            (size, paddingSize, paddingUsed, membersData) = templates[name]
+            self.symbolTemplates[name] = Template(size=size, paddingSize=paddingSize, paddingUsed=paddingUsed, membersData=membersData)
+        self.arrayConstants = arrayConstants
+        self.templateAliases = {}
+        for name in aliases:
+            (declaration, expansion) = aliases[name]
+            self.templateAliases[name] = AliasInfo(name=name, declaration=declaration, expansion=expansion)
+        self.forwardDeclarations = []
+        self.loadWarnings = loadWarnings
+        for msg in loadWarnings:
+            warning_msg(msg)
+        return True
+
+    def save_templates_cache (self, sources):
+        global UseTemplateCache
+        if not UseTemplateCache:
+            return
+
+        templates = {}
+        for name in self.symbolTemplates:
+            t = self.symbolTemplates[name]
+            membersData = zlib.compress(marshal.dumps([m.to_tuple() for m in t.members]))
+            templates[name] = (t.size, t.paddingSize, t.paddingUsed, membersData)
+        aliases = {}
+        for name in self.templateAliases:
+            a = self.templateAliases[name]
+            aliases[name] = (a.declaration, a.expansion)
+
+        cacheName = sources[-1] + TEMPLATES_CACHE_EXTENSION
+        try:
+            # other processes might be reading it, replace it all at once
+            atomic_write(cacheName, TEMPLATES_CACHE_MAGIC + marshal.dumps(self.templates_cache_key(sources)) + marshal.dumps((templates, self.arrayConstants, aliases, self.loadWarnings)))
+        except (IOError, OSError):
+            # ex: installation directory isn't writable, just parse every time
+            pass
 
 
 class InvalidQvm(Exception):
@@ -860,10 +1279,407 @@ class InvalidQvm(Exception):
 
 ReplaceDecompiled = False
 
+def read_syscalls (qvmType):
+
+    def ferror_exit (msg):
+        error_exit("%s in line %d of %s: %s" % (msg, lineCount + 1, fname, line))
+
+    syscalls = {}  # num:int -> name:str
+
+    if qvmType not in ("cgame", "game", "ui"):
+        return syscalls
+
+    if qvmType == "cgame":
+        fname = CGAME_SYSCALLS_ASM_FILE
+    elif qvmType == "game":
+        fname = GAME_SYSCALLS_ASM_FILE
+    elif qvmType == "ui":
+        fname = UI_SYSCALLS_ASM_FILE
+
+    if os.path.exists(fname):
+        f = open(fname)
+    else:
+        f = open(os.path.join(BASE_DIR, fname))
+
+    lines = f.readlines()
+    f.close()
+
+    lineCount = 0
+    for line in lines:
+        words = line.split()
+        if len(words) == 3:
+            try:
+                syscalls[parse_int(words[2])] = words[1]
+            except ValueError:
+                ferror_exit("couldn't parse system call number")
+        lineCount += 1
+
+    return syscalls
+
+# returns { hash:int -> [ funcName1, funcName2, ... ] } or an object with the
+# same lookups if index files are used
+def read_baseq3_function_hashes (qvmType):
+    baseQ3FunctionRevHashes = {}  # hash:int -> [ funcName1, funcName2, ... ]
+
+    # the stock .hmap files only have 32-bit hashes
+    if qvmType in ("cgame", "game", "ui")  and  FunctionHashBits == 32:
+        if qvmType == "cgame":
+            fname = BASEQ3_CGAME_FUNCTIONS_FILE
+        elif qvmType == "game":
+            fname = BASEQ3_GAME_FUNCTIONS_FILE
+        elif qvmType == "ui":
+            fname = BASEQ3_UI_FUNCTIONS_FILE
+
+        if not os.path.exists(fname):
+            fname = os.path.join(BASE_DIR, fname)
+
+        # use an index built from the .hmap file if it's up to date
+        #   ex: tools/build-hash-index baseq3-cgame-functions.hidx baseq3-cgame-functions.hmap
+        indexName = os.path.splitext(fname)[0] + INDEX_FILE_EXTENSION
+        if os.path.exists(indexName)  and  os.path.getmtime(indexName) >= os.path.getmtime(fname):
+            baseQ3FunctionRevHashes = open_function_hash_index(indexName)
+        else:
+            try:
+                entries = read_hmap(fname)
+            except HashIndexFormatError as ex:
+                error_exit(str(ex))
+            for (h, n) in entries:
+                if h in baseQ3FunctionRevHashes:
+                    baseQ3FunctionRevHashes[h].append(n)
+                else:
+                    baseQ3FunctionRevHashes[h] = [n]
+
+    if len(FunctionHashIndexFiles) > 0:
+        sources = [baseQ3FunctionRevHashes]
+        for indexName in FunctionHashIndexFiles:
+            sources.append(open_function_hash_index(indexName))
+        return FunctionHashLookup(sources)
+
+    return baseQ3FunctionRevHashes
+
+def open_function_hash_index (fname):
+    try:
+        index = FunctionHashIndex(fname)
+    except (IOError, OSError, ValueError) as ex:
+        error_exit("couldn't open function hash index %s: %s" % (fname, ex))
+    except HashIndexFormatError as ex:
+        error_exit(str(ex))
+    if index.hashBits != FunctionHashBits:
+        error_exit("function hash index %s has %d-bit hashes instead of %d-bit" % (fname, index.hashBits, FunctionHashBits))
+    return index
+
+# returns SimilarityIndex with the entries of all SimilarityIndexFiles, or
+# None if there aren't any
+def read_similarity_index ():
+    if len(SimilarityIndexFiles) == 0:
+        return None
+
+    index = SimilarityIndex()
+    for fname in SimilarityIndexFiles:
+        try:
+            index.read(fname)
+        except (IOError, OSError) as ex:
+            error_exit("couldn't open similarity index %s: %s" % (fname, ex))
+        except SimilarityIndexError as ex:
+            error_exit(str(ex))
+    return index
+
+# print_code_disassembly() splits the code into about this many chunks for
+# each process
+PARALLEL_CHUNKS_PER_JOB = 8
+
+# Qvm being rendered by the forked print_code_disassembly() workers
+ParallelQvm = None
+
+# the workers need to inherit the analyzed Qvm instead of having it pickled
+def can_fork ():
+    return hasattr(os, "fork")
+
+def fork_pool (processes):
+    if hasattr(multiprocessing, "get_context"):
+        return multiprocessing.get_context("fork").Pool(processes)
+    return multiprocessing.Pool(processes)
+
+# chunk:(start:int, end:int, flushPending:bool)
+# returns (text:str, exitValue:int or None)
+def render_code_chunk (chunk):
+    global Output
+
+    (start, end, flushPending) = chunk
+    # warnings and errors end up in the same place as with serial output
+    Output = OutputSink(xStringIO())
+    exitValue = None
+    try:
+        ParallelQvm.print_code_range(Output, start, end, flushPending)
+    except SystemExit as ex:
+        exitValue = ex.code
+    Output.flush()
+    return (Output.stream.getvalue(), exitValue)
+
+# how a basic block ends, ControlFlowGraph.blockExits
+BLOCK_FALLTHROUGH = 0  # next instruction is a jump target
+BLOCK_BRANCH = 1  # conditional branch, jump target and next block
+BLOCK_JUMP = 2  # const followed by jump
+BLOCK_SWITCH = 3  # q3asm switch jump through a table in the data segment
+BLOCK_COMPUTED_JUMP = 4  # any jump point or jump table target in the function
+BLOCK_RETURN = 5  # leave
+
+LIT_UNPRINTABLE = re.compile(b"[^\x20-\x7e]")
+LIT_ESCAPES = { 0x07 : "\\a", 0x08 : "\\b", 0x09 : "\\t", 0x0a : "\\n", 0x0b : "\\v", 0x0c : "\\f", 0x0d : "\\r" }
+
+# s:bytes without the terminating zero
+# returns quoted printable runs with the rest escaped, ex: "Score:" \t "%d" \n
+def escape_lit_string (s):
+    if len(s) == 0:
+        return "\"\""  # empty string
+    if LIT_UNPRINTABLE.search(s) == None:
+        return "\"" + xascii(s) + "\""
+
+    stringList = []
+    lastCharPrintable = False
+    i = 0
+    for c in bytearray(s):
+        # close previous quote if non-printable, or add quote if starting new printable sequence
+        if c > 31  and  c < 127:
+            if not lastCharPrintable:
+                if i != 0:  # no space if this starts everything
+                    stringList.append(" ")
+                stringList.append("\"")
+            lastCharPrintable = True
+            stringList.append(xchr(c))
+        else:  # not printable
+            if lastCharPrintable:
+                stringList.append("\" ")
+            lastCharPrintable = False
+            if c in LIT_ESCAPES:
+                stringList.append(LIT_ESCAPES[c])
+            else:
+                stringList.append("\\x%02x" % c)
+        i += 1
+
+    if lastCharPrintable:
+        stringList.append("\"")  # close quote
+
+    return "".join(stringList)
+
+# a zero terminated string in the lit segment, Qvm.litStrings
+class LitString:
+    def __init__ (self, addr, value):
+        self.addr = addr  # lit segment offset + data segment length, as used by code
+        self.length = len(value)  # without the terminating zero
+        self.value = value  # bytes
+        self.text = escape_lit_string(value)
+        self.references = []  # [ [ins:int, addr:int], ... ]  const instructions pointing into the string
+
+# what is annotated at an instruction, Qvm.instructionFlags
+INS_COMMENT_BEFORE = 0x001
+INS_COMMENT_INLINE = 0x002
+INS_COMMENT_AFTER = 0x004
+INS_JUMP_POINT = 0x008
+INS_SWITCH_JUMP_POINT = 0x010
+INS_JUMP_TABLE_TARGET = 0x020
+INS_SWITCH_START = 0x040
+INS_SWITCH_JUMP = 0x080
+INS_CONSTANT = 0x100
+INS_POINTER_DEREFERENCE = 0x200
+
+# Basic blocks of all the functions and the edges between them, in CSR
+# (compressed sparse row) arrays:  the successors of block n are
+# succBlocks[succOffsets[n] : succOffsets[n + 1]] and the same for the
+# predecessors.  Blocks are numbered in address order, block n is the
+# instructions [blockStarts[n], blockStarts[n + 1]), and the blocks of
+# function f are [functionBlocks[f], functionBlocks[f + 1]).  Edges don't
+# leave a function.
+class ControlFlowGraph:
+    # ops, parms:  decoded instructions
+    # functionStarts:[ addr1:int, ... ] sorted
+    # jumpTargets:[ addr1:int, ... ] sorted, addresses reachable by computed
+    #             jumps:  jump points, switch cases, and jump table targets
+    # switchTargets:{} jumpIns:int -> [ caseAddr1:int, ... ]
+    def __init__ (self, ops, parms, functionStarts, jumpTargets, switchTargets):
+        if hasattr(ops, "tolist"):
+            # numpy arrays are slow to index one element at a time
+            ops = ops.tolist()
+            parms = parms.tolist()
+        instructionCount = len(ops)
+        if len(functionStarts) == 0  or  functionStarts[0] != 0:
+            # code before the first function is its own function
+            functionStarts = [0] + list(functionStarts)
+        self.functionStarts = array.array('i', functionStarts)
+
+        leaders = bytearray(instructionCount + 1)
+        for addr in functionStarts:
+            leaders[addr] = 1
+        for addr in jumpTargets:
+            if addr >= 0  and  addr < instructionCount:
+                leaders[addr] = 1
+        for ins in range(instructionCount):
+            opc = ops[ins]
+            if opcodes[opc][OPCODE_JUMP_PARM]:
+                parm = parms[ins]
+                if parm >= 0  and  parm < instructionCount:
+                    leaders[parm] = 1
+                leaders[ins + 1] = 1
+            elif opc == OP_JUMP  or  opc == OP_LEAVE:
+                leaders[ins + 1] = 1
+
+        starts = [ins for ins in range(instructionCount) if leaders[ins]]
+        blockCount = len(starts)
+        starts.append(instructionCount)
+        self.blockStarts = array.array('i', starts)
+
+        self.functionBlocks = array.array('i', [0] * (len(functionStarts) + 1))
+        for f in range(len(functionStarts)):
+            self.functionBlocks[f] = bisect.bisect_left(starts, functionStarts[f])
+        self.functionBlocks[len(functionStarts)] = blockCount
+
+        self.blockExits = bytearray(blockCount)
+        succOffsets = [0]
+        succBlocks = []
+        for f in range(len(functionStarts)):
+            first = self.functionBlocks[f]
+            end = self.functionBlocks[f + 1]
+            firstIns = starts[first]
+            endIns = starts[end]
+            # computed jumps can go to any of these
+            lo = bisect.bisect_left(jumpTargets, firstIns)
+            hi = bisect.bisect_left(jumpTargets, endIns)
+            functionTargets = jumpTargets[lo:hi]
+
+            for n in range(first, end):
+                last = starts[n + 1] - 1
+                opc = ops[last]
+                targets = []
+                if opcodes[opc][OPCODE_JUMP_PARM]:
+                    self.blockExits[n] = BLOCK_BRANCH
+                    targets.append(parms[last])
+                    targets.append(last + 1)
+                elif opc == OP_JUMP:
+                    if last > starts[n]  and  ops[last - 1] == OP_CONST:
+                        self.blockExits[n] = BLOCK_JUMP
+                        targets.append(parms[last - 1])
+                    elif last in switchTargets:
+                        self.blockExits[n] = BLOCK_SWITCH
+                        targets.extend(switchTargets[last])
+                    else:
+                        self.blockExits[n] = BLOCK_COMPUTED_JUMP
+                        targets.extend(functionTargets)
+                elif opc == OP_LEAVE:
+                    self.blockExits[n] = BLOCK_RETURN
+                else:
+                    self.blockExits[n] = BLOCK_FALLTHROUGH
+                    targets.append(last + 1)
+
+                succ = set()
+                for t in targets:
+                    if t >= firstIns  and  t < endIns:
+                        succ.add(bisect.bisect_right(starts, t) - 1)
+                succBlocks.extend(sorted(succ))
+                succOffsets.append(len(succBlocks))
+        self.succOffsets = array.array('i', succOffsets)
+        self.succBlocks = array.array('i', succBlocks)
+
+        # predecessors, counting sort of the edges by destination
+        predOffsets = [0] * (blockCount + 1)
+        for s in succBlocks:
+            predOffsets[s + 1] += 1
+        for n in range(blockCount):
+            predOffsets[n + 1] += predOffsets[n]
+        fill = predOffsets[:]
+        predBlocks = [0] * len(succBlocks)
+        for n in range(blockCount):
+            for i in range(succOffsets[n], succOffsets[n + 1]):
+                s = succBlocks[i]
+                predBlocks[fill[s]] = n
+                fill[s] += 1
+        self.predOffsets = array.array('i', predOffsets)
+        self.predBlocks = array.array('i', predBlocks)
+
+    # number of blocks
+    def __len__ (self):
+        return len(self.blockStarts) - 1
+
+    # returns the number of the block containing instruction ins
+    def block_at (self, ins):
+        return bisect.bisect_right(self.blockStarts, ins) - 1
+
+    # returns (start:int, end:int) instruction range of block n
+    def block_range (self, n):
+        return (self.blockStarts[n], self.blockStarts[n + 1])
+
+    def successors (self, n):
+        return self.succBlocks[self.succOffsets[n] : self.succOffsets[n + 1]]
+
+    def predecessors (self, n):
+        return self.predBlocks[self.predOffsets[n] : self.predOffsets[n + 1]]
+
+    # returns (firstBlock:int, endBlock:int) of the function starting at addr
+    def function_blocks (self, addr):
+        f = bisect.bisect_left(self.functionStarts, addr)
+        if f >= len(self.functionStarts)  or  self.functionStarts[f] != addr:
+            raise ValueError("no function at 0x%x" % addr)
+        return (self.functionBlocks[f], self.functionBlocks[f + 1])
+
+# wraps a Qvm method so it's recorded as a phase when stats are enabled
+def stats_phase (method):
+    name = method.__name__
+    def timed (self, *args, **kwargs):
+        if self.stats == None:
+            return method(self, *args, **kwargs)
+        self.stats.begin(name)
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            self.stats.end()
+    timed.__name__ = name
+    return timed
+
+# Qvm attributes that are computed on first access
+#   name:str -> method that sets it:str
+QVM_LAZY_ATTRIBUTES = {}
+
+for (_loader, _names) in (
+        ("load_syscalls", ("syscalls",)),
+        ("load_baseq3_function_hashes", ("baseQ3FunctionRevHashes",)),
+        ("load_templates", ("templateManager",)),
+        ("load_similarity_index", ("similarityIndex",)),
+        ("load_address_info", ("functions", "functionsArgRangeLabels", "functionsLocalLabels", "functionsLocalRangeLabels", "symbols", "symbolsRange", "constants", "commentsInline", "commentsBefore", "commentsBeforeSpacing", "commentsAfter", "commentsAfterSpacing", "dataCommentsInline", "dataCommentsBefore", "dataCommentsBeforeSpacing", "dataCommentsAfter", "dataCommentsAfterSpacing", "symbolsRangeDeclarations", "symbolsRangeIndex", "functionsLocalRangeDeclarations", "functionsLocalRangeIndex")),
+        ("parse_jump_table", ("jumpTableTargets",)),
+        ("decode_instructions", ("insOpcodes", "insParms", "insOffsets")),
+        ("compute_function_info", ("functionHashes", "functionRevHashes", "functionSizes", "functionMaxArgsCalled", "functionParmNum", "jumpPoints", "switchStartStatements", "switchJumpStatements", "switchJumpPoints", "switchDataTable", "callPoints", "pointerDereference", "functionInfoWarnings")),
+        ("compute_similar_functions", ("similarFunctions",)),
+        ("compute_control_flow_graph", ("controlFlowGraph",)),
+        ("compute_instruction_flags", ("instructionFlags",)),
+        ("compute_lit_strings", ("litStrings", "litStringAddrs", "litStringsByValue"))
+    ):
+    for _name in _names:
+        QVM_LAZY_ATTRIBUTES[_name] = _loader
+del _loader, _names, _name
+
 class Qvm:
 
     # qvmType:("cgame", "game", "ui", None)
-    def __init__ (self, qvmFileName, qvmType=None):
+    # useMmap:  map the file and use zero-copy views for the segments instead
+    #           of reading them into memory
+    # stats:  PhaseStats that records the time taken by loading, analysis,
+    #         and printing
+    def __init__ (self, qvmFileName, qvmType=None, useMmap=False, stats=None):
+        self.stats = stats
+        self.stats_begin("load")
+        try:
+            self.read_qvm_file(qvmFileName, useMmap)
+        finally:
+            self.stats_end()
+
+        # analysis results are computed the first time they are accessed, see
+        # __getattr__() and QVM_LAZY_ATTRIBUTES
+        self.qvmType = qvmType
+
+        # printed in the code disassembly, see set_execution_counts()
+        self.executionCounts = None
+        self.functionExecutionCounts = {}
+
+    def read_qvm_file (self, qvmFileName, useMmap):
         qvmFile = LEBinFile(qvmFileName)
 
         self.magic = qvmFile.read_int()
@@ -915,179 +1731,150 @@ class Qvm:
             qvmFile.close()
             raise InvalidQvm("bad header: jumpTableLength %d" % self.jumpTableLength)
 
-        qvmFile.seek(self.codeSegOffset)
-        self.codeData = qvmFile.read(self.codeSegLength)
-        self.codeData = self.codeData + b"\x00\x00\x00\x00\x00"  # for look ahead
-        qvmFile.seek(self.dataSegOffset)
-        self.dataData = qvmFile.read(self.dataSegLength)
-        self.dataData = self.dataData + b"\x00\x00\x00\x00"  # for look ahead
-
-        qvmFile.seek(self.litSegOffset)
-        self.litData = qvmFile.read(self.litSegLength)
-        self.litData = self.litData + b"\x00\x00\x00\x00"  # for look ahead
-
-        if self.magic != QVM_MAGIC_VER1:
-            self.jumpTableData = qvmFile.read(self.jumpTableLength)
+        # segment data isn't padded, look ahead reads past the end need to use
+        # code_byte(), data_byte(), data_word(), etc.
+        if useMmap:
+            # only the pages that are accessed get read from disk
+            self.mmapData = qvmFile.mmap()
+            self.codeData = xmemoryview(self.mmapData, self.codeSegOffset, self.codeSegLength)
+            self.dataData = xmemoryview(self.mmapData, self.dataSegOffset, self.dataSegLength)
+            self.litData = xmemoryview(self.mmapData, self.litSegOffset, self.litSegLength)
+            if self.magic != QVM_MAGIC_VER1:
+                self.jumpTableData = xmemoryview(self.mmapData, self.jumpTableOffset, self.jumpTableLength)
+            else:
+                self.jumpTableData = b""
         else:
-            self.jumpTableData = b""
-
-        qvmFile.close()
-
-        self.syscalls = {}  # num:int -> name:str
-        self.functions = {}  # addr:int -> name:str
-
-        # user labels
-
-        # ArgRangeLabels could just be part of LocalRangeLabels but local
-        # address isn't known when the function is defined
-        self.functionsArgRangeLabels = {}  # addr:int -> { argX:str -> range:RangeElement }
-
-        self.functionsLocalLabels = {}  # addr:int -> { localAddr:int -> sym:str }
-        self.functionsLocalRangeLabels = {}  # addr:int -> { localAddr:int -> [ range1:RangeElement, range2:RangeElement, ... ] }
-
-        self.functionHashes = {}  # addr:int -> hash:int
-        self.functionRevHashes = {}  # hash:int -> [funcAddr1:int, funcAddr2:int, ...]
-        self.functionSizes = {}  # addr:int -> instructionCount:int
-        self.functionMaxArgsCalled = {}  # addr:int -> maxArgs:int
-        self.functionParmNum = {}  # addr:int -> num:int
+            self.mmapData = None
+            qvmFile.seek(self.codeSegOffset)
+            self.codeData = qvmFile.read(self.codeSegLength)
+            qvmFile.seek(self.dataSegOffset)
+            self.dataData = qvmFile.read(self.dataSegLength)
 
-        self.baseQ3FunctionRevHashes = {}  # hash:int -> [ funcName1, funcName2, ... ]
+            qvmFile.seek(self.litSegOffset)
+            self.litData = qvmFile.read(self.litSegLength)
 
-        self.symbols = {}  # addr:int -> sym:str
-        self.symbolsRange = {}  # addr:int -> [ range1:RangeElement, range2:RangeElement, ... ]
-
-        self.templateManager = TemplateManager()
-
-        self.constants = {}  # codeAddr:int -> [ name:str, value:int ]
-
-        # code segment comments
-        self.commentsInline = {}  # addr:int -> comment:str
-        self.commentsBefore = {}  # addr:int -> [ line1:str, line2:str, ... ]
-        self.commentsBeforeSpacing = {}  # addr:int -> [ spaceBefore:int, spaceAfter:int ]
-        self.commentsAfter = {}  # addr:int -> [ line1:str, line2:str, ... ]
-        self.commentsAfterSpacing = {}  # addr:int -> [ spaceBefore:int, spaceAfter: int ]
-
-        # data segment comments
-        self.dataCommentsInline = {}  # addr:int -> comment:str
-        self.dataCommentsBefore = {}  # addr:int -> [ line1:str, line2:str, ... ]
-        self.dataCommentsBeforeSpacing = {}  # addr:int -> [ spaceBefore:int, spaceAfter:int ]
-        self.dataCommentsAfter = {}  # addr:int -> [ line1:str, line2:str, ... ]
-        self.dataCommentsAfterSpacing = {}  # addr:int -> [ spaceBefore:int, spaceAfter: int ]
-
-        self.jumpPoints = {}  # targetAddr:int -> [ jumpPointAddr1:int, jumpPointAddr2:int, ... ]
-        self.switchStartStatements = []  # [ addr1:int, addr2:int, ... ]
-        self.switchJumpStatements = {}  # addr:int -> [ minValue:int, maxValue:int, switchJumpTableAddress:int ]
-        self.switchJumpPoints = {}  # targetAddr:int -> [ [ jumpPointAddr1:int, caseValue:int ], [ jumpPointAddr2:int, caseValue:int ],  ... ]
-        self.switchDataTable = {}  # addr:int -> [ switchCodeAddr1:int, switchCodeAddr2:int, ... ]
-        self.callPoints = {}  # targetAddr:int -> [ callerAddr1:int, callerAddr2:int, ... ]
-
-        self.jumpTableTargets = []  # [ targetAddr1:int, targetAddr2:int, targetAddr3:int, ... ]
-
-        self.pointerDereference = {}  # addr:int -> [ local:bool, pointerAddr:int, offset:int ]
+            if self.magic != QVM_MAGIC_VER1:
+                self.jumpTableData = qvmFile.read(self.jumpTableLength)
+            else:
+                self.jumpTableData = b""
 
-        self.set_qvm_type(qvmType)
-        self.load_address_info()
-        self.parse_jump_table()
-        self.compute_function_info()
+        qvmFile.close()
 
+    # bounds checked segment access, reads past the end return zero
+    # (uses the actual length in case the file was truncated)
+
+    def _segment_byte (self, segData, pos):
+        if pos < 0  or  pos >= len(segData):
+            return 0
+        return xord(segData[pos])
+
+    # unsigned 32-bit little endian
+    def _segment_word (self, segData, pos):
+        if pos >= 0  and  pos + 4 <= len(segData):
+            return struct.unpack("<L", segData[pos : pos + 4])[0]
+        w = 0
+        for i in range(4):
+            w |= self._segment_byte(segData, pos + i) << (i * 8)
+        return w
+
+    def code_byte (self, pos):
+        return self._segment_byte(self.codeData, pos)
+
+    def data_byte (self, addr):
+        return self._segment_byte(self.dataData, addr)
+
+    def data_word (self, addr):
+        return self._segment_word(self.dataData, addr)
+
+    # offset is relative to the start of the lit segment
+    def lit_byte (self, offset):
+        return self._segment_byte(self.litData, offset)
+
+    def jump_table_byte (self, pos):
+        return self._segment_byte(self.jumpTableData, pos)
+
+    def jump_table_word (self, pos):
+        return self._segment_word(self.jumpTableData, pos)
+
+    # only called for attributes that haven't been set yet
+    def __getattr__ (self, name):
+        if name not in QVM_LAZY_ATTRIBUTES:
+            raise AttributeError(name)
+        loader = QVM_LAZY_ATTRIBUTES[name]
+        self.stats_begin(loader)
+        try:
+            getattr(self, loader)()
+        finally:
+            self.stats_end()
+        return self.__dict__[name]
+
+    # phases are only recorded when a PhaseStats was given to the constructor
+
+    def stats_begin (self, name):
+        if self.stats != None:
+            self.stats.begin(name)
+
+    def stats_end (self):
+        if self.stats != None:
+            self.stats.end()
+
+    # sizes of the tables computed so far, nothing is loaded for this
+    #
+    # returns { name:str -> count:int }
+    def stats_counts (self):
+        counts = { "instructions" : self.instructionCount }
+        for name in QVM_LAZY_ATTRIBUTES:
+            if name in self.__dict__  and  hasattr(self.__dict__[name], "__len__"):
+                counts[name] = len(self.__dict__[name])
+        if "functionHashes" in self.__dict__:
+            counts["functions"] = len(self.functionHashes)
+        if "templateManager" in self.__dict__:
+            counts["symbolTemplates"] = len(self.templateManager.symbolTemplates)
+        return counts
+
+    # Compute everything now instead of on first use.  Warnings from the .dat
+    # files and function analysis are printed in the same order as before
+    # any other output.
+    def analyze (self):
+        self.syscalls
+        self.baseQ3FunctionRevHashes
+        self.templateManager
+        self.symbols
+        self.jumpTableTargets
+        self.functionHashes
+        self.similarFunctions
+        self.instructionFlags
+        self.litStrings
+
+    @stats_phase
     def set_qvm_type (self, qvmType):
-
-        def ferror_exit (msg):
-            error_exit("%s in line %d of %s: %s" % (msg, lineCount + 1, fname, line))
-
         self.qvmType = qvmType
 
-        if qvmType not in ("cgame", "game", "ui"):
-            return
+        # reloaded on next access
+        for name in ("syscalls", "baseQ3FunctionRevHashes", "similarFunctions"):
+            if name in self.__dict__:
+                del self.__dict__[name]
 
-        if qvmType == "cgame":
-            fname = CGAME_SYSCALLS_ASM_FILE
-        elif qvmType == "game":
-            fname = GAME_SYSCALLS_ASM_FILE
-        elif qvmType == "ui":
-            fname = UI_SYSCALLS_ASM_FILE
+    # insCounts:[ count:int, ... ] times each instruction was executed
+    # functionCounts:{} funcAddr:int -> [calls:int, exclusive:int, inclusive:int]
+    def set_execution_counts (self, insCounts, functionCounts={}):
+        self.executionCounts = insCounts
+        self.functionExecutionCounts = functionCounts
 
-        if os.path.exists(fname):
-            f = open(fname)
-        else:
-            f = open(os.path.join(BASE_DIR, fname))
+    def load_syscalls (self):
+        self.syscalls = read_syscalls(self.qvmType)
 
-        lines = f.readlines()
-        f.close()
-
-        lineCount = 0
-        for line in lines:
-            words = line.split()
-            if len(words) == 3:
-                try:
-                    self.syscalls[parse_int(words[2])] = words[1]
-                except ValueError:
-                    ferror_exit("couldn't parse system call number")
-            lineCount += 1
-
-        if qvmType == "cgame":
-            fname = BASEQ3_CGAME_FUNCTIONS_FILE
-        elif qvmType == "game":
-            fname = BASEQ3_GAME_FUNCTIONS_FILE
-        elif qvmType == "ui":
-            fname = BASEQ3_UI_FUNCTIONS_FILE
-
-        if os.path.exists(fname):
-            f = open(fname)
-        else:
-            f = open(os.path.join(BASE_DIR, fname))
+    def load_baseq3_function_hashes (self):
+        self.baseQ3FunctionRevHashes = read_baseq3_function_hashes(self.qvmType)
 
-        lines = f.readlines()
-        f.close()
-        lineCount = 0
-        for line in lines:
-            words = line.split()
-            if len(words) > 2:
-                n = words[1]
-                try:
-                    # hex value without leading '0x':  2ad89a6d
-                    h = atoi(words[2], 16)
-                except ValueError:
-                    ferror_exit("couldn't parse hash value")
-                if h in self.baseQ3FunctionRevHashes:
-                    self.baseQ3FunctionRevHashes[h].append(n)
-                else:
-                    self.baseQ3FunctionRevHashes[h] = [n]
-            lineCount += 1
+    def load_templates (self):
+        self.templateManager = TemplateManager()
+        self.stats_begin("load_default_templates")
+        self.templateManager.load_default_templates()
+        self.stats_end()
 
-    # addr:int, symbolsRange:{} addr:int -> [ range1:RangeElement, range2:RangeElement, ... ]
-    def find_in_symbol_range (self, addr, symbolsRange):
-        exactMatches = []  #FIXME sorted
-        match = None
-        matchDiff = 0
-        matchSym = ""
-        matchRangeSize = 0
-        for rangeAddr in symbolsRange:
-            for r in symbolsRange[rangeAddr]:
-                size = r.size
-                sym = r.symbolName
-                if addr == rangeAddr:
-                    exactMatches.append(sym)
-                elif addr >= rangeAddr  and  addr < (rangeAddr + size):
-                    if match == None:
-                        match = rangeAddr
-                        matchSym = sym
-                        matchDiff = addr - rangeAddr
-                        matchRangeSize = size
-                    elif (addr - rangeAddr) < matchDiff:
-                        match = rangeAddr
-                        matchSym = sym
-                        matchDiff = addr - rangeAddr
-                        matchRangeSize = size
-                    elif (addr - rangeAddr) == matchDiff:  # multiple ranges beginning at same address
-                        # pick smallest
-                        if size < matchRangeSize:
-                            match = rangeAddr
-                            matchSym = sym
-                            matchDiff = addr - rangeAddr
-                            matchRangeSize = size
-
-        return (match, matchSym, matchDiff, exactMatches)
+    def load_similarity_index (self):
+        self.similarityIndex = read_similarity_index()
 
     def substitute_variables (self, line):
         # ex: x = @f{0x89}("testing", 0x68, @d{0xcba94 could be clientNum});
@@ -1107,7 +1894,7 @@ class Qvm:
                 if addr in self.symbols:
                     return self.symbols[addr]
                 else:  # check symbol ranges
-                    (matchAddr, matchSym, matchDiff, exactMatches) = self.find_in_symbol_range(addr, self.symbolsRange)
+                    (matchAddr, matchSym, matchDiff, exactMatches) = self.symbolsRangeIndex.find(addr)
                     if len(exactMatches) > 0:
                         return ":".join(exactMatches)
                     else:
@@ -1125,16 +1912,62 @@ class Qvm:
         return r
 
     def load_address_info (self):
+        # templates are loaded when self.templateManager is first used
+
+        self.functions = {}  # addr:int -> name:str
+
+        # user labels
+
+        # ArgRangeLabels could just be part of LocalRangeLabels but local
+        # address isn't known when the function is defined
+        self.functionsArgRangeLabels = {}  # addr:int -> { argX:str -> range:RangeElement }
+
+        self.functionsLocalLabels = {}  # addr:int -> { localAddr:int -> sym:str }
+        self.functionsLocalRangeLabels = {}  # addr:int -> { localAddr:int -> [ range1:RangeElement, range2:RangeElement, ... ] }
+        self.functionsLocalRangeDeclarations = {}  # addr:int -> [ [localAddr1:int, range1:RangeElement], ... ]
+        self.functionsLocalRangeIndex = {}  # addr:int -> SymbolRangeIndex
 
+        self.symbols = {}  # addr:int -> sym:str
+        # template members aren't added as ranges, they are resolved through
+        # the index
+        self.symbolsRange = {}  # addr:int -> [ range1:RangeElement, range2:RangeElement, ... ]
+        self.symbolsRangeDeclarations = []  # [ [addr1:int, range1:RangeElement], ... ]
+
+        self.constants = {}  # codeAddr:int -> [ name:str, value:int ]
+
+        # code segment comments
+        self.commentsInline = {}  # addr:int -> comment:str
+        self.commentsBefore = {}  # addr:int -> [ line1:str, line2:str, ... ]
+        self.commentsBeforeSpacing = {}  # addr:int -> [ spaceBefore:int, spaceAfter:int ]
+        self.commentsAfter = {}  # addr:int -> [ line1:str, line2:str, ... ]
+        self.commentsAfterSpacing = {}  # addr:int -> [ spaceBefore:int, spaceAfter: int ]
+
+        # data segment comments
+        self.dataCommentsInline = {}  # addr:int -> comment:str
+        self.dataCommentsBefore = {}  # addr:int -> [ line1:str, line2:str, ... ]
+        self.dataCommentsBeforeSpacing = {}  # addr:int -> [ spaceBefore:int, spaceAfter:int ]
+        self.dataCommentsAfter = {}  # addr:int -> [ line1:str, line2:str, ... ]
+        self.dataCommentsAfterSpacing = {}  # addr:int -> [ spaceBefore:int, spaceAfter: int ]
+
+        for (fname, loader) in (
+                (SYMBOLS_FILE, self.load_symbols_file),
+                (FUNCTIONS_FILE, self.load_functions_file),
+                (CONSTANTS_FILE, self.load_constants_file),
+                # load after functions and symbols files to allow variable substitutions
+                (COMMENTS_FILE, self.load_comments_file)
+            ):
+            self.stats_begin(fname)
+            try:
+                loader()
+            finally:
+                self.stats_end()
+
+    def load_symbols_file (self):
         def ferror_exit (msg):
             error_exit("%s in line %d of %s: %s" % (msg, lineCount + 1, fname, line))
         def fwarning_msg (msg):
             warning_msg("%s in line %d of %s: %s" % (msg, lineCount + 1, fname, line))
 
-        # symbol templates
-        self.templateManager.load_default_templates()
-
-        # symbols
         fname = SYMBOLS_FILE
         if os.path.exists(fname):
             f = open(fname)
@@ -1142,6 +1975,9 @@ class Qvm:
             f.close()
             prevAddr = -1
             lineCount = 0
+            # simple symbols that might be at a template member address
+            #   [ [addr:int, rangeCount:int, lineCount:int, line:str], ... ]
+            memberOverrideChecks = []
             for line in lines:
                 # strip comments
                 line = line.split(";")[0]
@@ -1173,6 +2009,8 @@ class Qvm:
                     # check if it would override previously declared range
                     if addr in self.symbolsRange:
                         fwarning_msg("simple symbol overrides range")
+                    else:
+                        memberOverrideChecks.append([addr, len(self.symbolsRangeDeclarations), lineCount, line])
 
                 elif len(words) == 3:
                     try:
@@ -1195,26 +2033,22 @@ class Qvm:
                         if not addr in self.symbolsRange:
                             self.symbolsRange[addr] = []
                         templateSize = self.templateManager.symbolTemplates[template].size
-                        members = self.templateManager.symbolTemplates[template].members
-                        # add template itself
-                        self.symbolsRange[addr].append(RangeElement(size=templateSize, symbolName=sym))
+                        # add template itself, members are looked up through it
+                        r = RangeElement(size=templateSize, symbolName=sym, template=template)
+                        self.symbolsRange[addr].append(r)
+                        self.symbolsRangeDeclarations.append([addr, r])
                         # check if it matches previously declared simple symbol
                         if addr in self.symbols:
                             fwarning_msg("template range would be overriden by simple symbol")
-
-                        for m in members:
-                            maddr = addr + m.offset
-                            if not maddr in self.symbolsRange:
-                                self.symbolsRange[maddr] = []
-                            self.symbolsRange[maddr].append(RangeElement(size=m.size, symbolType=m.symbolType, symbolName="%s.%s" % (sym, m.name), isPointer=m.isPointer, pointerType=m.pointerType, pointerDepth=m.pointerDepth, isArray=m.isArray, arrayLevels=m.arrayLevels, arrayTemplate=m.arrayTemplate, arrayElementSize=m.arrayElementSize))
-                            # check if it matches previously declared simple symbol
-                            if addr in self.symbols:
+                            for m in self.templateManager.symbolTemplates[template].members:
                                 fwarning_msg("member template range would be overriden by simple symbol")
 
                     else:  # basic type, range, pointer, or array
                         if not addr in self.symbolsRange:
                             self.symbolsRange[addr] = []
-                        self.symbolsRange[addr].append(RangeElement(size=size, symbolType=symbolType, symbolName=sym, isPointer=isPointer, pointerType=pointerType, pointerDepth=pointerDepth, isArray=isArray, arrayLevels=arrayLevels, arrayTemplate=template, arrayElementSize=arrayElementSize))
+                        r = RangeElement(size=size, symbolType=symbolType, symbolName=sym, isPointer=isPointer, pointerType=pointerType, pointerDepth=pointerDepth, isArray=isArray, arrayLevels=arrayLevels, arrayTemplate=template, arrayElementSize=arrayElementSize)
+                        self.symbolsRange[addr].append(r)
+                        self.symbolsRangeDeclarations.append([addr, r])
                         # check if it would be overriden by previously declared simple symbol
                         if addr in self.symbols:
                             fwarning_msg("range would be overriden by simple symbol")
@@ -1224,7 +2058,19 @@ class Qvm:
 
                 lineCount += 1
 
-        # functions
+        self.symbolsRangeIndex = SymbolRangeIndex(self.symbolsRangeDeclarations, self.templateManager.symbolTemplates)
+
+        if os.path.exists(fname):
+            for (addr, rangeCount, lineCount, line) in memberOverrideChecks:
+                if len(self.symbolsRangeIndex.lookup(addr, count=rangeCount).exactMatches) > 0:
+                    fwarning_msg("simple symbol overrides range")
+
+    def load_functions_file (self):
+        def ferror_exit (msg):
+            error_exit("%s in line %d of %s: %s" % (msg, lineCount + 1, fname, line))
+        def fwarning_msg (msg):
+            warning_msg("%s in line %d of %s: %s" % (msg, lineCount + 1, fname, line))
+
         fname = FUNCTIONS_FILE
         if os.path.exists(fname):
             f = open(fname)
@@ -1235,6 +2081,9 @@ class Qvm:
             currentFuncAddr = None
             lastArgNum = -1
             lastLocalAddr = -1
+            # local simple symbols that might be at a template member address
+            #   [ [funcAddr:int, localAddr:int, rangeCount:int, lineCount:int, line:str], ... ]
+            memberOverrideChecks = []
             while lineCount < len(lines):
                 line = lines[lineCount]
                 # strip comments
@@ -1318,30 +2167,31 @@ class Qvm:
                                     self.functionsLocalRangeLabels[currentFuncAddr] = {}
                                 if not localAddr in self.functionsLocalRangeLabels[currentFuncAddr]:
                                     self.functionsLocalRangeLabels[currentFuncAddr][localAddr] = []
+                                if not currentFuncAddr in self.functionsLocalRangeDeclarations:
+                                    self.functionsLocalRangeDeclarations[currentFuncAddr] = []
                                 templateSize = self.templateManager.symbolTemplates[template].size
-                                members = self.templateManager.symbolTemplates[template].members
-                                # add template itself
-                                self.functionsLocalRangeLabels[currentFuncAddr][localAddr].append(RangeElement(size=templateSize, symbolName=sym))
+                                # add template itself, members are looked up through it
+                                r = RangeElement(size=templateSize, symbolName=sym, template=template)
+                                self.functionsLocalRangeLabels[currentFuncAddr][localAddr].append(r)
+                                self.functionsLocalRangeDeclarations[currentFuncAddr].append([localAddr, r])
                                 # check if it is overriden by previously declared simple symbol
                                 if currentFuncAddr in self.functionsLocalLabels:
                                     if localAddr in self.functionsLocalLabels[currentFuncAddr]:
                                         fwarning_msg("local template range would be overriden by local simple symbol")
 
-                                for m in members:
-                                    maddr = localAddr + m.offset
-                                    if not maddr in self.functionsLocalRangeLabels[currentFuncAddr]:
-                                        self.functionsLocalRangeLabels[currentFuncAddr][maddr] = []
-                                    self.functionsLocalRangeLabels[currentFuncAddr][maddr].append(RangeElement(size=m.size, symbolType=m.symbolType, symbolName="%s.%s" % (sym, m.name), isPointer=m.isPointer, pointerType=m.pointerType, isArray=m.isArray, arrayLevels=m.arrayLevels, arrayTemplate=m.arrayTemplate, arrayElementSize=m.arrayElementSize))
-                                    # check if it matches previously declared simple symbol
-                                    if currentFuncAddr in self.functionsLocalLabels:
-                                        if maddr in self.functionsLocalLabels[currentFuncAddr]:
+                                    for m in self.templateManager.symbolTemplates[template].members:
+                                        if localAddr + m.offset in self.functionsLocalLabels[currentFuncAddr]:
                                             fwarning_msg("local member template range would be override by simple symbol")
                             else:  # basic type, range, pointer, or array
                                 if not currentFuncAddr in self.functionsLocalRangeLabels:
                                     self.functionsLocalRangeLabels[currentFuncAddr] = {}
                                 if not localAddr in self.functionsLocalRangeLabels[currentFuncAddr]:
                                     self.functionsLocalRangeLabels[currentFuncAddr][localAddr] = []
-                                self.functionsLocalRangeLabels[currentFuncAddr][localAddr].append(RangeElement(size=size, symbolType=symbolType, symbolName=sym, isPointer=isPointer, pointerType=pointerType, pointerDepth=pointerDepth, isArray=isArray, arrayLevels=arrayLevels, arrayTemplate=template, arrayElementSize=arrayElementSize))
+                                if not currentFuncAddr in self.functionsLocalRangeDeclarations:
+                                    self.functionsLocalRangeDeclarations[currentFuncAddr] = []
+                                r = RangeElement(size=size, symbolType=symbolType, symbolName=sym, isPointer=isPointer, pointerType=pointerType, pointerDepth=pointerDepth, isArray=isArray, arrayLevels=arrayLevels, arrayTemplate=template, arrayElementSize=arrayElementSize)
+                                self.functionsLocalRangeLabels[currentFuncAddr][localAddr].append(r)
+                                self.functionsLocalRangeDeclarations[currentFuncAddr].append([localAddr, r])
                                 # check if it matches previously declared simple symbol
                                 if currentFuncAddr in self.functionsLocalLabels:
                                     if localAddr in self.functionsLocalLabels[currentFuncAddr]:
@@ -1368,6 +2218,8 @@ class Qvm:
                             if currentFuncAddr in self.functionsLocalRangeLabels:
                                 if laddr in self.functionsLocalRangeLabels[currentFuncAddr]:
                                     fwarning_msg("local simple symbol overrides range")
+                                else:
+                                    memberOverrideChecks.append([currentFuncAddr, laddr, len(self.functionsLocalRangeDeclarations[currentFuncAddr]), lineCount, line])
                     else:
                         # function definition
                         try:
@@ -1389,7 +2241,19 @@ class Qvm:
 
                 lineCount += 1
 
-        # constants
+            for funcAddr in self.functionsLocalRangeDeclarations:
+                self.functionsLocalRangeIndex[funcAddr] = SymbolRangeIndex(self.functionsLocalRangeDeclarations[funcAddr], self.templateManager.symbolTemplates)
+
+            for (funcAddr, laddr, rangeCount, lineCount, line) in memberOverrideChecks:
+                if len(self.functionsLocalRangeIndex[funcAddr].lookup(laddr, count=rangeCount).exactMatches) > 0:
+                    fwarning_msg("local simple symbol overrides range")
+
+    def load_constants_file (self):
+        def ferror_exit (msg):
+            error_exit("%s in line %d of %s: %s" % (msg, lineCount + 1, fname, line))
+        def fwarning_msg (msg):
+            warning_msg("%s in line %d of %s: %s" % (msg, lineCount + 1, fname, line))
+
         fname = CONSTANTS_FILE
         if os.path.exists(fname):
             f = open(fname)
@@ -1430,8 +2294,12 @@ class Qvm:
 
                 lineCount += 1
 
-        # comments
-        # load after functions and symbols files to allow variable substitutions
+    def load_comments_file (self):
+        def ferror_exit (msg):
+            error_exit("%s in line %d of %s: %s" % (msg, lineCount + 1, fname, line))
+        def fwarning_msg (msg):
+            warning_msg("%s in line %d of %s: %s" % (msg, lineCount + 1, fname, line))
+
         fname = COMMENTS_FILE
         if os.path.exists(fname):
             f = open(fname)
@@ -1569,52 +2437,160 @@ class Qvm:
                 lineCount += 1
 
     def parse_jump_table (self):
+        self.jumpTableTargets = []  # [ targetAddr1:int, targetAddr2:int, targetAddr3:int, ... ]
+
         if self.magic == QVM_MAGIC_VER1:
             return  # no jump table data
         count = 0
         while count < self.jumpTableLength:
-            addr = struct.unpack("<L", self.jumpTableData[count:count+4])[0]
+            addr = self.jump_table_word(count)
             self.jumpTableTargets.append(addr)
             count += 4
 
-    def print_header (self):
-        output("; magic 0x%x\n" % self.magic)
-        output("; instruction count: 0x%x\n" % self.instructionCount)
-        output("; CODE seg offset: 0x%08x  length: 0x%x\n" % (self.codeSegOffset, self.codeSegLength))
-        output("; DATA seg offset: 0x%08x  length: 0x%x\n" % (self.dataSegOffset, self.dataSegLength))
-        output("; LIT  seg offset: 0x%08x  length: 0x%x\n" % (self.litSegOffset, self.litSegLength))
-        output("; BSS  seg offset: 0x%08x  length: 0x%x\n" % (self.bssSegOffset, self.bssSegLength))
-        if self.magic != QVM_MAGIC_VER1:
-            output("; jump table length: 0x%x\n" % (self.jumpTableLength))
+    # everything qvmdis prints for a qvm
+    @stats_phase
+    def print_disassembly (self, out=None, jobs=1):
+        if out == None:
+            out = Output
+
+        # get all the warnings out of the way before anything else is printed
+        self.analyze()
+
+        out.write(";; header\n")
+        self.print_header(out)
+        out.write("\n")
+
+        out.write(";; function hashes\n")
+        self.print_function_hashes(out)
+        out.write("\n")
+
+        out.write(";; code segment\n")
+        self.print_code_disassembly(out, jobs=jobs)
+        out.write("\n")
+
+        out.write(";; data segment\n")
+        self.print_data_disassembly(out)
+        out.write("\n")
+
+        out.write(";; lit segment\n")
+        self.print_lit_disassembly(out)
 
-    def print_code_disassembly (self):
+        if self.magic != QVM_MAGIC_VER1:
+            out.write("\n;; jump table\n")
+            self.print_jump_table(out)
+
+        out.flush()
+
+    @stats_phase
+    def print_header (self, out=None):
+        if out == None:
+            out = Output
+
+        out.write("; magic 0x%x\n" % self.magic)
+        out.write("; instruction count: 0x%x\n" % self.instructionCount)
+        out.write("; CODE seg offset: 0x%08x  length: 0x%x\n" % (self.codeSegOffset, self.codeSegLength))
+        out.write("; DATA seg offset: 0x%08x  length: 0x%x\n" % (self.dataSegOffset, self.dataSegLength))
+        out.write("; LIT  seg offset: 0x%08x  length: 0x%x\n" % (self.litSegOffset, self.litSegLength))
+        out.write("; BSS  seg offset: 0x%08x  length: 0x%x\n" % (self.bssSegOffset, self.bssSegLength))
+        if self.magic != QVM_MAGIC_VER1:
+            out.write("; jump table length: 0x%x\n" % (self.jumpTableLength))
+        out.flush()
+
+    # jobs:  number of processes used to render functions in parallel, the
+    #        output is the same as with a single one
+    @stats_phase
+    def print_code_disassembly (self, out=None, jobs=1):
+        if out == None:
+            out = Output
+
+        if jobs > 1  and  can_fork():
+            chunks = self.code_disassembly_chunks(jobs * PARALLEL_CHUNKS_PER_JOB)
+            if len(chunks) > 1:
+                self.print_code_disassembly_parallel(out, jobs, chunks)
+                return
+
+        self.print_code_range(out, 0, self.instructionCount, False)
+        out.flush()
+
+    # Functions are rendered independently, all the state in
+    # print_code_range() is reset by OP_ENTER, so the code segment is split
+    # right before those instructions.
+    #
+    # returns [ [startIns1:int, endIns1:int], [startIns2:int, endIns2:int], ... ]
+    def code_disassembly_chunks (self, maxChunks):
+        functionStarts = [ins for ins in range(1, self.instructionCount) if self.insOpcodes[ins] == OP_ENTER]
+        chunkSize = max(1, self.instructionCount // maxChunks)
+
+        chunks = []
+        start = 0
+        for ins in functionStarts:
+            if ins - start >= chunkSize:
+                chunks.append([start, ins])
+                start = ins
+        if start < self.instructionCount:
+            chunks.append([start, self.instructionCount])
+        return chunks
+
+    def print_code_disassembly_parallel (self, out, jobs, chunks):
+        global ParallelQvm
+
+        # analysis results are shared with the forked workers
+        self.analyze()
+        out.flush()
+        flush_output()
+
+        ParallelQvm = self
+        pool = fork_pool(jobs)
+        try:
+            work = [(start, end, n < len(chunks) - 1) for (n, (start, end)) in enumerate(chunks)]
+            for (text, exitValue) in pool.imap(render_code_chunk, work):
+                out.write(text)
+                if exitValue != None:
+                    out.flush()
+                    flush_output()
+                    sys.exit(exitValue)
+        finally:
+            ParallelQvm = None
+            pool.terminate()
+            pool.join()
+
+        out.flush()
+
+    # renders instructions [start, end), the text pending after the last one
+    # is only written if flushPending is True
+    def print_code_range (self, out, start, end, flushPending):
         global ReplaceDecompiled
+
         decStack = DecompileStack()
-        outputBuffer = OutputBuffer()
-        outputBufferDecompile = OutputBuffer()
+        outputBuffer = OutputBuffer(out)
+        outputBufferDecompile = OutputBuffer(out)
 
         def outputb (msg):
             outputBuffer.write(msg)
         def outputdb (msg):
             outputBufferDecompile.write(msg)
 
-        pos = 0
+        insOpcodes = self.insOpcodes
+        insParms = self.insParms
+        insFlags = self.instructionFlags
+        executionCounts = self.executionCounts
+        blockStarts = self.controlFlowGraph.blockStarts
+        nextBlock = self.controlFlowGraph.block_at(start)
 
-        count = -1
+        count = start - 1
         currentFuncAddr = None
-        while count < self.instructionCount - 1:
+        while count < end - 1:
             count += 1
 
             comment = None
             decStr = None
 
-            opcStr = self.codeData[pos]
-            opc = xord(opcStr)
-            pos += 1
+            opc = insOpcodes[count]
+            flags = insFlags[count]
             name = opcodes[opc][OPCODE_NAME]
             psize = opcodes[opc][OPCODE_PARM_SIZE]
 
-            if opc != OP_ENTER  and  count in self.commentsBefore:
+            if opc != OP_ENTER  and  flags & INS_COMMENT_BEFORE:
                 if count in self.commentsBeforeSpacing:
                     for i in range(self.commentsBeforeSpacing[count][0]):
                         outputb("\n")
@@ -1630,19 +2606,11 @@ class Qvm:
 
             if psize == 0:
                 parm = None
-            elif psize == 1:
-                parmStr = self.codeData[pos]
-                parm = xord(parmStr)
-                pos += 1
-            elif psize == 4:
-                parmStr = self.codeData[pos : pos + psize]
-                parm = struct.unpack("<l", parmStr)[0]
-                pos += 4
             else:
-                error_exit("FIXME bad opcode size")
+                parm = insParms[count]
 
-            if count in self.jumpPoints:
-                if count in self.jumpTableTargets:
+            if flags & INS_JUMP_POINT:
+                if flags & INS_JUMP_TABLE_TARGET:
                     outputb("\n;----------------------------------- *from ")
                 else:
                     outputb("\n;----------------------------------- from ")
@@ -1650,19 +2618,23 @@ class Qvm:
                 for jp in self.jumpPoints[count]:
                     outputb(" 0x%x" % jp)
                 outputb("\n")
-                decStack.markInvalid()
-            elif count in self.jumpTableTargets  and  count not in self.switchJumpPoints:
+            elif flags & INS_JUMP_TABLE_TARGET  and  not flags & INS_SWITCH_JUMP_POINT:
                 outputb("\n;----------------------------------- table jump\n")
 
-            if count in self.switchJumpPoints:
-                if count in self.jumpTableTargets:
+            if flags & INS_SWITCH_JUMP_POINT:
+                if flags & INS_JUMP_TABLE_TARGET:
                     outputb("\n;----------------------------------- case *from ")
                 else:
                     outputb("\n;----------------------------------- case from ")
                 for jp in self.switchJumpPoints[count]:
                     outputb(" 0x%x(0x%x)" % (jp[0], jp[1]))
                 outputb("\n")
+
+            # the stack can't be followed into a block, it may have been
+            # entered from somewhere else
+            if count == blockStarts[nextBlock]:
                 decStack.markInvalid()
+                nextBlock += 1
 
             if opc == OP_ENTER:
                 addr = count
@@ -1688,6 +2660,11 @@ class Qvm:
                     for n in self.baseQ3FunctionRevHashes[self.functionHashes[addr]]:
                         outputb(" ?%s()" % n)
                     outputb("\n")
+                elif addr in self.similarFunctions:
+                    outputb("; similar to")
+                    for (score, n) in self.similarFunctions[addr]:
+                        outputb(" ?%s() %.2f" % (n, score))
+                    outputb("\n")
                 if addr in self.functionParmNum:
                     outputb(";")
                     p = self.functionParmNum[addr]
@@ -1700,9 +2677,11 @@ class Qvm:
                     outputb(" args\n")
 
                 outputb("; max local arg 0x%x\n" % self.functionMaxArgsCalled[addr])
+                if addr in self.functionExecutionCounts:
+                    outputb("; executed: %d calls, %d instructions, %d inclusive\n" % tuple(self.functionExecutionCounts[addr]))
                 outputb("; ========================\n")
 
-                if count in self.commentsBefore:
+                if flags & INS_COMMENT_BEFORE:
                     if count in self.commentsBeforeSpacing:
                         for i in range(self.commentsBeforeSpacing[count][0]):
                             outputb("\n")
@@ -1713,7 +2692,7 @@ class Qvm:
                             outputb("\n")
                 decStack.clear()
             elif opc == OP_LOCAL:
-                if count in self.switchStartStatements:
+                if flags & INS_SWITCH_START:
                     outputb("; possible switch start\n")
 
                 localDecStr = "&local%x" % parm
@@ -1733,7 +2712,7 @@ class Qvm:
                             comment = self.functionsLocalLabels[currentFuncAddr][parm]
                             localDecStr = "&" + comment
                     elif currentFuncAddr in self.functionsLocalRangeLabels:
-                        (match, matchSym, matchDiff, exactMatches) = self.find_in_symbol_range(parm, self.functionsLocalRangeLabels[currentFuncAddr])
+                        (match, matchSym, matchDiff, exactMatches) = self.functionsLocalRangeIndex[currentFuncAddr].find(parm)
 
                         if len(exactMatches) > 0:
                             comment =  ", ".join(exactMatches)
@@ -1746,10 +2725,13 @@ class Qvm:
                                 localDecStr = "(&" + comment + ")"
                 decStack.push(localDecStr)
             elif opc == OP_CONST:
-                nextOp = xord(self.codeData[pos])
+                if count + 1 < self.instructionCount:
+                    nextOp = insOpcodes[count + 1]
+                else:
+                    nextOp = OP_UNDEF
 
                 localDecStr = "0x%x" % parm
-                if count in self.constants:
+                if flags & INS_CONSTANT:
                     if parm != self.constants[count][1]:
                         comment = "FIXME constant val != to code val"
                     else:
@@ -1764,12 +2746,12 @@ class Qvm:
                     outputb("\n")
                     outputdb("\n")
                 elif parm >= 0  and  parm < self.dataSegLength  and  nextOp not in (OP_CALL, OP_JUMP):
-                    b0 = xchr(self.dataData[parm])
-                    b1 = xchr(self.dataData[parm + 1])
-                    b2 = xchr(self.dataData[parm + 2])
-                    b3 = xchr(self.dataData[parm + 3])
+                    b0 = self.data_byte(parm)
+                    b1 = self.data_byte(parm + 1)
+                    b2 = self.data_byte(parm + 2)
+                    b3 = self.data_byte(parm + 3)
 
-                    dataStr = "%02x %02x %02x %02x  (0x%x)\n" % (xord(b0), xord(b1), xord(b2), xord(b3), struct.unpack("<L", self.dataData[parm:parm+4])[0])
+                    dataStr = "%02x %02x %02x %02x  (0x%x)\n" % (b0, b1, b2, b3, self.data_word(parm))
                     outputb("\n  ; %s" % dataStr)
                     outputdb("    ; const 0x%x : %s\n" % (parm, dataStr))
 
@@ -1777,7 +2759,7 @@ class Qvm:
                         comment = self.symbols[parm]
                         localDecStr = "&" + comment
                     else:  # check symbol ranges
-                        (match, matchSym, matchDiff, exactMatches) = self.find_in_symbol_range(parm, self.symbolsRange)
+                        (match, matchSym, matchDiff, exactMatches) = self.symbolsRangeIndex.find(parm)
                         if len(exactMatches) > 0:
                             comment =  ", ".join(exactMatches)
                             # if there's more than one, just use the first
@@ -1807,35 +2789,7 @@ class Qvm:
                         comment = self.symbols[parm]
                         localDecStr = "&" + comment
                     else:  # check symbol ranges
-                        exactMatches = []  #FIXME sorted
-                        match = None
-                        matchDiff = 0
-                        matchSym = ""
-                        matchRangeSize = 0
-                        for rangeAddr in self.symbolsRange:
-                            for r in self.symbolsRange[rangeAddr]:
-                                size = r.size
-                                sym = r.symbolName
-                                if parm == rangeAddr:
-                                    exactMatches.append(sym)
-                                elif parm >= rangeAddr  and  parm < (rangeAddr + size):
-                                    if match == None:
-                                        match = rangeAddr
-                                        matchSym = sym
-                                        matchDiff = parm - rangeAddr
-                                        matchRangeSize = size
-                                    elif (parm - rangeAddr) < matchDiff:
-                                        match = rangeAddr
-                                        matchSym = sym
-                                        matchDiff = parm - rangeAddr
-                                        matchRangeSize = size
-                                    elif (parm - rangeAddr) == matchDiff:  # multiple ranges beginning at same address
-                                        # pick smallest
-                                        if size < matchRangeSize:
-                                            match = rangeAddr
-                                            matchSym = sym
-                                            matchDiff = parm - rangeAddr
-                                            matchRangeSize = size
+                        (match, matchSym, matchDiff, exactMatches) = self.symbolsRangeIndex.find(parm)
                         if len(exactMatches) > 0:
                             comment =  ", ".join(exactMatches)
                             # if there's more than one, just use the first
@@ -1846,14 +2800,14 @@ class Qvm:
                                 localDecStr = "(&" + comment + ")"
                 decStack.push(localDecStr)
             elif opc == OP_JUMP:
-                if count in self.switchJumpStatements:
+                if flags & INS_SWITCH_JUMP:
                     tmin = self.switchJumpStatements[count][0]
                     tmax = self.switchJumpStatements[count][1]
                     taddr = self.switchJumpStatements[count][2]
                     outputb("; possible switch jump: 0x%x (0x%x -> 0x%x)\n" % (taddr, tmin, tmax))
                 decStack.markInvalid()
             elif (opc == OP_LOAD4  or  opc == OP_LOAD2  or  opc == OP_LOAD1):
-                if count in self.pointerDereference:
+                if flags & INS_POINTER_DEREFERENCE:
                     pdr = self.pointerDereference[count]
 
                     # find template or basic type
@@ -1870,37 +2824,35 @@ class Qvm:
                         argNum = rangeAddr - stackAdjust - 0x8
 
                         if argNum >= 0:
-                            # hack to use range check below
                             argstr = "arg%d" % (argNum / 4)
                             if currentFuncAddr in self.functionsArgRangeLabels:
                                 if argstr in self.functionsArgRangeLabels[currentFuncAddr]:
-                                    symbolsRange = { rangeAddr : [self.functionsArgRangeLabels[currentFuncAddr][argstr]] }
+                                    ranges = [self.functionsArgRangeLabels[currentFuncAddr][argstr]]
                                 else:
-                                    symbolsRange = {}
+                                    ranges = []
                             else:
-                                symbolsRange = {}
+                                ranges = []
                         else:
-                            if currentFuncAddr in self.functionsLocalRangeLabels:
-                                symbolsRange = self.functionsLocalRangeLabels[currentFuncAddr]
+                            if currentFuncAddr in self.functionsLocalRangeIndex:
+                                ranges = self.functionsLocalRangeIndex[currentFuncAddr].ranges_at(rangeAddr)
                             else:
-                                symbolsRange = {}
+                                ranges = []
                     else:
-                        symbolsRange = self.symbolsRange
-
-                    if rangeAddr in symbolsRange:
-                        for r in symbolsRange[rangeAddr]:
-                            # use first match
-                            sym = r.symbolName
-                            #FIXME support for higher pointerDepth
-                            if r.size == 0x4  and  r.isPointer  and  r.pointerDepth == 1:
-                                if r.symbolType == SYMBOL_POINTER_TEMPLATE:
-                                    templateName = r.pointerType
-                                    foundTemplate = True
-                                    break
-                                elif r.symbolType == SYMBOL_POINTER_VOID  or  r.symbolType == SYMBOL_POINTER_BASIC:
-                                    btype = r.pointerType
-                                    foundBasicType = True
-                                    break
+                        ranges = self.symbolsRangeIndex.ranges_at(rangeAddr)
+
+                    for r in ranges:
+                        # use first match
+                        sym = r.symbolName
+                        #FIXME support for higher pointerDepth
+                        if r.size == 0x4  and  r.isPointer  and  r.pointerDepth == 1:
+                            if r.symbolType == SYMBOL_POINTER_TEMPLATE:
+                                templateName = r.pointerType
+                                foundTemplate = True
+                                break
+                            elif r.symbolType == SYMBOL_POINTER_VOID  or  r.symbolType == SYMBOL_POINTER_BASIC:
+                                btype = r.pointerType
+                                foundBasicType = True
+                                break
 
                     if foundTemplate:
                         memberName = "?"
@@ -2017,7 +2969,7 @@ class Qvm:
             elif sc > 0:
                 outputb("   %d" % sc)
             else:
-                if parm != None  or  comment  or  count in self.commentsInline:
+                if parm != None  or  comment  or  flags & INS_COMMENT_INLINE  or  (executionCounts != None  and  executionCounts[count] != 0):
                     outputb("    ")
 
             if parm != None:
@@ -2029,11 +2981,14 @@ class Qvm:
             if comment:
                 outputb("  ; %s" % comment)
 
-            if count in self.commentsInline:
+            if flags & INS_COMMENT_INLINE:
                 outputb("  ; %s" % self.commentsInline[count])
 
+            if executionCounts != None  and  executionCounts[count] != 0:
+                outputb("  ; x%d" % executionCounts[count])
+
             # decompile comments, need them since memory references are guesses
-            if comment or count in self.commentsInline:
+            if comment  or  flags & INS_COMMENT_INLINE:
                 outputdb("    ; %08x %s " % (count, name))
                 if parm != None:
                     if parm < 0:
@@ -2042,14 +2997,14 @@ class Qvm:
                         outputdb(" 0x%x" % parm)
                 if comment:
                     outputdb(" ; %s" % comment)
-                if count in self.commentsInline:
+                if flags & INS_COMMENT_INLINE:
                     outputdb(" ; %s" % self.commentsInline[count])
                 outputdb("\n")
 
             # finish printing line
             outputb("\n")
 
-            if count in self.commentsAfter:
+            if flags & INS_COMMENT_AFTER:
                 if count in self.commentsAfterSpacing:
                     for i in range(self.commentsAfterSpacing[count][0]):
                         outputb("\n")
@@ -2080,168 +3035,394 @@ class Qvm:
                 outputBuffer.flush()
                 outputBufferDecompile.clear()
 
-    def print_data_disassembly (self):
+        # the next range starts with OP_ENTER which writes it
+        if flushPending:
+            outputBuffer.flush()
+
+    @stats_phase
+    def print_data_disassembly (self, out=None):
+        if out == None:
+            out = Output
+        write = out.write
+
         count = 0
         while count < self.dataSegLength:
             if count in self.dataCommentsBefore:
                 if count in self.dataCommentsBeforeSpacing:
-                    for i in range(self.dataCommentsBeforeSpacing[count][0]):
-                        output("\n")
+                    write("\n" * self.dataCommentsBeforeSpacing[count][0])
                 for line in self.dataCommentsBefore[count]:
-                    output("; %s\n" % line)
+                    write("; %s\n" % line)
                 if count in self.dataCommentsBeforeSpacing:
-                    for i in range(self.dataCommentsBeforeSpacing[count][1]):
-                        output("\n")
+                    write("\n" * self.dataCommentsBeforeSpacing[count][1])
 
-            output("0x%08x  " % count)
-            b0 = self.dataData[count]
-            b1 = self.dataData[count + 1]
-            b2 = self.dataData[count + 2]
-            b3 = self.dataData[count + 3]
+            b0 = self.data_byte(count)
+            b1 = self.data_byte(count + 1)
+            b2 = self.data_byte(count + 2)
+            b3 = self.data_byte(count + 3)
 
-            output(" %02x %02x %02x %02x    0x%x" % (xord(b0), xord(b1), xord(b2), xord(b3), struct.unpack("<L", self.dataData[count:count+4])[0]))
+            write("0x%08x   %02x %02x %02x %02x    0x%x" % (count, b0, b1, b2, b3, self.data_word(count)))
             if count in self.dataCommentsInline:
-                output("  ; %s" % self.dataCommentsInline[count])
+                write("  ; %s" % self.dataCommentsInline[count])
 
             if count in self.switchDataTable:
-                output("  ; switch table data from")
+                write("  ; switch table data from")
                 for sj in self.switchDataTable[count]:
-                    output(" 0x%x" % sj)
+                    write(" 0x%x" % sj)
 
             # finish printing line
-            output("\n")
+            write("\n")
 
             if count in self.dataCommentsAfter:
                 if count in self.dataCommentsAfterSpacing:
-                    for i in range(self.dataCommentsAfterSpacing[count][0]):
-                        output("\n")
+                    write("\n" * self.dataCommentsAfterSpacing[count][0])
                 for line in self.dataCommentsAfter[count]:
-                    output("; %s\n" % line)
+                    write("; %s\n" % line)
                 if count in self.dataCommentsAfterSpacing:
-                    for i in range(self.dataCommentsAfterSpacing[count][1]):
-                        output("\n")
+                    write("\n" * self.dataCommentsAfterSpacing[count][1])
 
             count += 4
 
-    def print_lit_disassembly (self):
-        pos = self.dataSegLength
-        offset = 0
-        while offset < self.litSegLength:
-            count = offset + pos
+        out.flush()
+
+    @stats_phase
+    def print_lit_disassembly (self, out=None):
+        if out == None:
+            out = Output
+        write = out.write
+
+        for ls in self.litStrings:
+            count = ls.addr
             if count in self.dataCommentsBefore:
                 if count in self.dataCommentsBeforeSpacing:
-                    for i in range(self.dataCommentsBeforeSpacing[count][0]):
-                        output("\n")
+                    write("\n" * self.dataCommentsBeforeSpacing[count][0])
                 for line in self.dataCommentsBefore[count]:
-                    output("; %s\n" % line)
+                    write("; %s\n" % line)
                 if count in self.dataCommentsBeforeSpacing:
-                    for i in range(self.dataCommentsBeforeSpacing[count][1]):
-                        output("\n")
+                    write("\n" * self.dataCommentsBeforeSpacing[count][1])
 
-            output("0x%08x  " % (offset + pos))
-            output(self.get_lit_string(offset + self.dataSegLength))
+            write("0x%08x  %s" % (count, ls.text))
 
             if count in self.dataCommentsInline:
-                output("  ; %s" % self.dataCommentsInline[count])
+                write("  ; %s" % self.dataCommentsInline[count])
 
-            # finish printing line
-            output("\n")
+            if len(ls.references) > 0:
+                write("  ; referenced from")
+                for (ins, addr) in ls.references:
+                    if addr == count:
+                        write(" 0x%x" % ins)
+                    else:
+                        write(" 0x%x(+0x%x)" % (ins, addr - count))
 
-            # skip string data
-            i = 0
-            while 1:
-                c = xord(self.litData[offset + i])
-                if c == xord(b'\0')  or  offset + i >= self.litSegLength:
-                    break
-                i += 1
-            offset += i
+            # finish printing line
+            write("\n")
 
             if count in self.dataCommentsAfter:
                 if count in self.dataCommentsAfterSpacing:
-                    for j in range(self.dataCommentsAfterSpacing[count][0]):
-                        output("\n")
+                    write("\n" * self.dataCommentsAfterSpacing[count][0])
                 for line in self.dataCommentsAfter[count]:
-                    output("; %s\n" % line)
+                    write("; %s\n" % line)
                 if count in self.dataCommentsAfterSpacing:
-                    for j in range(self.dataCommentsAfterSpacing[count][1]):
-                        output("\n")
+                    write("\n" * self.dataCommentsAfterSpacing[count][1])
 
-            offset += 1
+        out.flush()
+
+    @stats_phase
+    def print_jump_table (self, out=None):
+        if out == None:
+            out = Output
+        write = out.write
 
-    def print_jump_table (self):
         count = 0
         while count < self.jumpTableLength:
-            output("0x%08x  " % count)
-            b0 = self.jumpTableData[count]
-            b1 = self.jumpTableData[count + 1]
-            b2 = self.jumpTableData[count + 2]
-            b3 = self.jumpTableData[count + 3]
-
-            output(" %02x %02x %02x %02x    0x%x" % (xord(b0), xord(b1), xord(b2), xord(b3), struct.unpack("<L", self.jumpTableData[count:count+4])[0]))
+            b0 = self.jump_table_byte(count)
+            b1 = self.jump_table_byte(count + 1)
+            b2 = self.jump_table_byte(count + 2)
+            b3 = self.jump_table_byte(count + 3)
 
-            # finish printing line
-            output("\n")
+            write("0x%08x   %02x %02x %02x %02x    0x%x\n" % (count, b0, b1, b2, b3, self.jump_table_word(count)))
             count += 4
 
-    def compute_function_info (self):
+        out.flush()
+
+    # Decode the variable length instruction stream once.  All the analysis
+    # and printing passes use these instead of self.codeData:
+    #
+    #   insOpcodes[ins]  opcode
+    #   insParms[ins]    parameter, 0 if the opcode doesn't have one
+    #   insOffsets[ins]  byte offset in the code segment
+    def decode_instructions (self):
+        global UseNumpyDecoder
+        if UseNumpyDecoder  and  numpy is not None:
+            self.decode_instructions_numpy()
+            return
+
+        self.insOpcodes = array.array('B')
+        self.insParms = array.array('i')
+        self.insOffsets = array.array('I')
+
+        parmSizes = [op[OPCODE_PARM_SIZE] for op in opcodes]
+        numOpcodes = len(parmSizes)
+
+        # temporary copy so that indexing gives an int in both python 2 and 3
+        code = bytearray(self.codeData)
+        codeLength = len(code)
+
+        insOpcodesAppend = self.insOpcodes.append
+        insParmsAppend = self.insParms.append
+        insOffsetsAppend = self.insOffsets.append
+        unpack_from = struct.unpack_from
+
         pos = 0
+        for ins in range(self.instructionCount):
+            if pos >= codeLength:
+                raise InvalidQvm("code segment ends before instruction 0x%x" % ins)
+            opc = code[pos]
+            if opc >= numOpcodes:
+                raise InvalidQvm("invalid opcode 0x%x at instruction 0x%x" % (opc, ins))
+            psize = parmSizes[opc]
+            if pos + psize >= codeLength:
+                raise InvalidQvm("code segment ends before parameter of instruction 0x%x" % ins)
+            insOpcodesAppend(opc)
+            insOffsetsAppend(pos)
+            if psize == 4:
+                insParmsAppend(unpack_from("<l", code, pos + 1)[0])
+            elif psize == 1:
+                insParmsAppend(code[pos + 1])
+            else:
+                insParmsAppend(0)
+            pos += 1 + psize
+
+    # Same output as decode_instructions() but vectorized with numpy.
+    #
+    # Instruction boundaries depend on the previous instruction, so they are
+    # found by pointer doubling:  nextPos[p] is the position of the instruction
+    # following one that starts at p, and squaring that table each round lets
+    # the start of instruction 'ins' be found in log2(instructionCount) steps
+    # for all instructions at once.
+    def decode_instructions_numpy (self):
+        parmSizes = numpy.array([op[OPCODE_PARM_SIZE] for op in opcodes], dtype=numpy.int64)
+        numOpcodes = len(parmSizes)
+
+        code = numpy.frombuffer(bytes(self.codeData), dtype=numpy.uint8)
+        codeLength = len(code)
+        count = self.instructionCount
+
+        # invalid opcodes are given size 0 here and reported below
+        sizes = numpy.zeros(256, dtype=numpy.int64)
+        sizes[:numOpcodes] = parmSizes + 1
+
+        # position codeLength is a sentinel that maps to itself
+        nextPos = numpy.empty(codeLength + 1, dtype=numpy.int64)
+        nextPos[:codeLength] = numpy.arange(codeLength, dtype=numpy.int64) + sizes[code]
+        nextPos[codeLength] = codeLength
+        numpy.minimum(nextPos, codeLength, out=nextPos)
+
+        insNums = numpy.arange(count, dtype=numpy.int64)
+        starts = numpy.zeros(count, dtype=numpy.int64)
+        bit = 0
+        while (1 << bit) < count:
+            mask = ((insNums >> bit) & 1).astype(bool)
+            starts[mask] = nextPos[starts[mask]]
+            nextPos = nextPos[nextPos]
+            bit += 1
+
+        # validate, report the first problem the same way the python decoder does
+        truncated = starts >= codeLength
+        safeStarts = numpy.minimum(starts, max(codeLength - 1, 0))
+        if codeLength > 0:
+            opcs = code[safeStarts].astype(numpy.int64)
+        else:
+            opcs = numpy.zeros(count, dtype=numpy.int64)
+        invalid = opcs >= numOpcodes
+        psizes = parmSizes[numpy.minimum(opcs, numOpcodes - 1)]
+        parmTruncated = (starts + psizes) >= codeLength
+        bad = truncated | invalid | parmTruncated
+        if bad.any():
+            ins = int(numpy.argmax(bad))
+            if truncated[ins]:
+                raise InvalidQvm("code segment ends before instruction 0x%x" % ins)
+            if invalid[ins]:
+                raise InvalidQvm("invalid opcode 0x%x at instruction 0x%x" % (opcs[ins], ins))
+            raise InvalidQvm("code segment ends before parameter of instruction 0x%x" % ins)
+
+        # gather parameters, padded so 4 byte reads at the end stay in range
+        padded = numpy.zeros(codeLength + 5, dtype=numpy.int64)
+        padded[:codeLength] = code
+        parms = numpy.zeros(count, dtype=numpy.int64)
+        sel = psizes == 1
+        parms[sel] = padded[starts[sel] + 1]
+        sel = psizes == 4
+        p = starts[sel] + 1
+        parms[sel] = padded[p] | (padded[p + 1] << 8) | (padded[p + 2] << 16) | (padded[p + 3] << 24)
+
+        self.insOpcodes = array.array('B', opcs.astype(numpy.uint8).tobytes())
+        self.insParms = array.array('i', parms.astype(numpy.uint32).view(numpy.int32).tobytes())
+        self.insOffsets = array.array('I', starts.astype(numpy.uint32).tobytes())
+
+    def analysis_cache_key (self):
+        header = ("qvm analysis %d %d %d\n" % (ANALYSIS_VERSION, self.instructionCount, FunctionHashBits)).encode("ascii")
+        return content_digest([header, self.codeData, self.dataData, self.litData])
+
+    # uses the analysis cache if AnalysisCacheDir is set
+    def compute_function_info (self):
+        global AnalysisCacheDir, AnalysisCacheMaxSize
+
+        if AnalysisCacheDir is None:
+            self.analyze_functions()
+            return
+
+        cache = AnalysisCache(AnalysisCacheDir, AnalysisCacheMaxSize)
+        key = self.analysis_cache_key()
+        entry = cache.load(key)
+        if entry is not None:
+            try:
+                self.decode_function_info(entry[0])
+            except CacheFormatError:
+                entry = None
+        if entry is not None:
+            self.functionInfoWarnings = entry[1]
+            for msg in self.functionInfoWarnings:
+                warning_msg(msg)
+            return
+
+        self.analyze_functions()
+        try:
+            cache.store(key, self.encode_function_info(), self.functionInfoWarnings)
+        except (IOError, OSError) as ex:
+            warning_msg("couldn't store analysis cache entry: %s" % ex)
+
+    def encode_function_info (self):
+        w = IntWriter()
+        if FunctionHashBits > 32:
+            w.write_int64_dict(self.functionHashes)
+        else:
+            w.write_int_dict(self.functionHashes)
+        w.write_int_dict(self.functionSizes)
+        w.write_int_dict(self.functionMaxArgsCalled)
+        w.write_int_dict(self.functionParmNum)
+        w.write_list_dict(self.jumpPoints)
+        w.write_list(self.switchStartStatements)
+        w.write_list_dict(self.switchJumpStatements)
+        w.write_nested_list_dict(self.switchJumpPoints)
+        w.write_list_dict(self.switchDataTable)
+        w.write_list_dict(self.callPoints)
+        w.write(len(self.pointerDereference))
+        for addr in self.pointerDereference:
+            pdr = self.pointerDereference[addr]
+            w.write(addr)
+            w.write(int(pdr[0]))
+            w.write(pdr[1])
+            w.write(pdr[2])
+        return w.ints
+
+    def decode_function_info (self, ints):
+        r = IntReader(ints)
+        if FunctionHashBits > 32:
+            functionHashes = r.read_int64_dict()
+        else:
+            functionHashes = r.read_int_dict()
+        functionSizes = r.read_int_dict()
+        functionMaxArgsCalled = r.read_int_dict()
+        functionParmNum = r.read_int_dict()
+        jumpPoints = r.read_list_dict()
+        switchStartStatements = r.read_list()
+        switchJumpStatements = r.read_list_dict()
+        switchJumpPoints = r.read_nested_list_dict(2)
+        switchDataTable = r.read_list_dict()
+        callPoints = r.read_list_dict()
+        pointerDereference = {}
+        for i in range(r.read()):
+            addr = r.read()
+            pointerDereference[addr] = [bool(r.read()), r.read(), r.read()]
+        if not r.at_end():
+            raise CacheFormatError("extra data")
+
+        self.functionHashes = functionHashes
+        self.functionRevHashes = {}
+        for addr in functionHashes:
+            h = functionHashes[addr]
+            if h in self.functionRevHashes:
+                self.functionRevHashes[h].append(addr)
+            else:
+                self.functionRevHashes[h] = [addr]
+        self.functionSizes = functionSizes
+        self.functionMaxArgsCalled = functionMaxArgsCalled
+        self.functionParmNum = functionParmNum
+        self.jumpPoints = jumpPoints
+        self.switchStartStatements = switchStartStatements
+        self.switchJumpStatements = switchJumpStatements
+        self.switchJumpPoints = switchJumpPoints
+        self.switchDataTable = switchDataTable
+        self.callPoints = callPoints
+        self.pointerDereference = pointerDereference
+
+    def analyze_functions (self):
+        self.functionHashes = {}  # addr:int -> hash:int
+        self.functionRevHashes = {}  # hash:int -> [funcAddr1:int, funcAddr2:int, ...]
+        self.functionSizes = {}  # addr:int -> instructionCount:int
+        self.functionMaxArgsCalled = {}  # addr:int -> maxArgs:int
+        self.functionParmNum = {}  # addr:int -> num:int
+
+        self.jumpPoints = {}  # targetAddr:int -> [ jumpPointAddr1:int, jumpPointAddr2:int, ... ]
+        self.switchStartStatements = []  # [ addr1:int, addr2:int, ... ]
+        self.switchJumpStatements = {}  # addr:int -> [ minValue:int, maxValue:int, switchJumpTableAddress:int ]
+        self.switchJumpPoints = {}  # targetAddr:int -> [ [ jumpPointAddr1:int, caseValue:int ], [ jumpPointAddr2:int, caseValue:int ],  ... ]
+        self.switchDataTable = {}  # addr:int -> [ switchCodeAddr1:int, switchCodeAddr2:int, ... ]
+        self.callPoints = {}  # targetAddr:int -> [ callerAddr1:int, callerAddr2:int, ... ]
+
+        self.pointerDereference = {}  # addr:int -> [ local:bool, pointerAddr:int, offset:int ]
+
+        # kept to be replayed when results are loaded from the analysis cache
+        self.functionInfoWarnings = []
+
+        def analysis_warning_msg (msg):
+            self.functionInfoWarnings.append(msg)
+            warning_msg(msg)
+
         funcStartInsNum = -1
         funcInsCount = 0
         funcOffset = 0
-        funcHashSum = ""
+        hasher = FunctionHasher(FunctionHashBits)
         maxArgs = 0x8
         lastArg = 0x0
 
-        opcStr = "\x00"
         opc = 0
-        parmStr = "\x00"
         parm = 0
 
-        prevOpcStr = "\x00"
         prevOpc = 0
-        prevOpcParmStr = "\x00"
-        prevOpcParm = 0
+        prevParm = 0
 
-        # list of [opcodes, parameters] in this function
-        funcOps = []
+        # opcodes and parameters of this function are checked with
+        # ops[ins - n] and parms[ins - n], funcOpsLen is the number of
+        # instructions since 'enter'
+        ops = self.insOpcodes
+        parms = self.insParms
 
         ins = -1
         while ins < self.instructionCount - 1:
             ins += 1
 
-            prevOpcStr = opcStr
             prevOpc = opc
-            prevParmStr = parmStr
             prevParm = parm
 
-            opcStr = xchr(self.codeData[pos])
-            opc = xord(opcStr)
+            opc = ops[ins]
             funcInsCount += 1
-            funcHashSum += "%d" % opc
-            pos += 1
+            hasher.update_opcode(opc)
             psize = opcodes[opc][OPCODE_PARM_SIZE]
             if psize:
-                parmStr = self.codeData[pos : pos + psize]
-                if psize == 1:
-                    parm = xord(parmStr)
-                elif psize == 4:
-                    parm = struct.unpack("<l", parmStr)[0]
-                else:
-                    parm = None
+                parm = parms[ins]
             else:
-                parmStr = None
                 parm = None
-            pos += psize
 
-            funcOps.append([opc, parm])
+            funcOpsLen = ins - funcStartInsNum
 
             if opc == OP_CONST:
                 if parm < 0:
-                    funcHashSum += "%d" % parm
+                    hasher.update_int(parm)
             elif opc == OP_POP:
                 lastArg = 0
             elif opc == OP_LOCAL:
-                funcHashSum += "%d" % parm
+                hasher.update_int(parm)
             elif opc == OP_ARG:
                 if parm > maxArgs:
                     maxArgs = parm
@@ -2279,35 +3460,35 @@ class Qvm:
 
                 #FIXME global var write
 
-                if len(funcOps) > 4:
+                if funcOpsLen > 4:
                     if (
-                            funcOps[-5][0] == OP_CONST  and
-                            funcOps[-4][0] == OP_LOAD4  and
-                            funcOps[-3][0] == OP_CONST  and
-                            funcOps[-2][0] == OP_ADD
+                            ops[ins - 4] == OP_CONST  and
+                            ops[ins - 3] == OP_LOAD4  and
+                            ops[ins - 2] == OP_CONST  and
+                            ops[ins - 1] == OP_ADD
                     ):  # explicit global var read
-                        pointerAddr = funcOps[-5][1]
-                        offset = funcOps[-3][1]
+                        pointerAddr = parms[ins - 4]
+                        offset = parms[ins - 2]
                         local = False
 
                         #FIXME pointer to pointer to pointer ...
                         self.pointerDereference[ins] = [local, pointerAddr, offset]
                     elif (
-                            funcOps[-5][0] == OP_LOCAL  and
-                            funcOps[-4][0] == OP_LOAD4  and
-                            funcOps[-3][0] == OP_CONST  and
-                            funcOps[-2][0] == OP_ADD
+                            ops[ins - 4] == OP_LOCAL  and
+                            ops[ins - 3] == OP_LOAD4  and
+                            ops[ins - 2] == OP_CONST  and
+                            ops[ins - 1] == OP_ADD
                     ):  # explicit local var read
-                        pointerAddr = funcOps[-5][1]
-                        offset = funcOps[-3][1]
+                        pointerAddr = parms[ins - 4]
+                        offset = parms[ins - 2]
                         local = True
 
                         #FIXME pointer to pointer to pointer ...
                         self.pointerDereference[ins] = [local, pointerAddr, offset]
             elif opc == OP_ENTER:
-                if pos > 5:   # else it's first function of file  vmMain()
+                if ins > 0:   # else it's first function of file  vmMain()
                     self.functionSizes[funcStartInsNum] = funcInsCount
-                    h = hash32BitSigned(funcHashSum)
+                    h = hasher.digest()
                     self.functionHashes[funcStartInsNum] = h
                     if h in self.functionRevHashes:
                         self.functionRevHashes[h].append(funcStartInsNum)
@@ -2315,12 +3496,11 @@ class Qvm:
                         self.functionRevHashes[h] = [funcStartInsNum]
                     self.functionMaxArgsCalled[funcStartInsNum] = maxArgs
                 funcStartInsNum = ins
-                funcOffset = pos - psize - 1
+                funcOffset = self.insOffsets[ins]
                 funcInsCount = 1
-                funcHashSum = ""
+                hasher.reset()
                 maxArgs = 0x8
                 lastArg = 0
-                funcOps = []
             elif opc == OP_JUMP:
                 if prevOpc == OP_CONST:
                     if prevParm in self.jumpPoints:
@@ -2352,48 +3532,48 @@ class Qvm:
                     # add
                     # load4
                     # jump
-                    if len(funcOps) >= 16:
+                    if funcOpsLen >= 16:
                         if (
-                            funcOps[-16][0] == OP_LOCAL and
-                            funcOps[-15][0] == OP_LOAD4 and
-                            funcOps[-14][0] == OP_CONST and
-                            funcOps[-13][0] == OP_LTI and
-                            funcOps[-12][0] == OP_LOCAL and
-                            funcOps[-11][0] == OP_LOAD4 and
-                            funcOps[-10][0] == OP_CONST and
-                            funcOps[-9][0] == OP_GTI and
-                            funcOps[-8][0] == OP_LOCAL and
-                            funcOps[-7][0] == OP_LOAD4 and
-                            funcOps[-6][0] == OP_CONST and
-                            funcOps[-5][0] == OP_LSH and
-                            funcOps[-4][0] == OP_CONST and
-                            funcOps[-3][0] == OP_ADD and
-                            funcOps[-2][0] == OP_LOAD4
+                            ops[ins - 15] == OP_LOCAL and
+                            ops[ins - 14] == OP_LOAD4 and
+                            ops[ins - 13] == OP_CONST and
+                            ops[ins - 12] == OP_LTI and
+                            ops[ins - 11] == OP_LOCAL and
+                            ops[ins - 10] == OP_LOAD4 and
+                            ops[ins - 9] == OP_CONST and
+                            ops[ins - 8] == OP_GTI and
+                            ops[ins - 7] == OP_LOCAL and
+                            ops[ins - 6] == OP_LOAD4 and
+                            ops[ins - 5] == OP_CONST and
+                            ops[ins - 4] == OP_LSH and
+                            ops[ins - 3] == OP_CONST and
+                            ops[ins - 2] == OP_ADD and
+                            ops[ins - 1] == OP_LOAD4
                         ):
-                            tmin = funcOps[-14][1]
-                            tmax = funcOps[-10][1]
-                            taddr = funcOps[-4][1]
+                            tmin = parms[ins - 13]
+                            tmax = parms[ins - 9]
+                            taddr = parms[ins - 3]
 
                             validValues = True
                             # validate values
                             if tmin < 0:
-                                warning_msg("invalid min value for switch at 0x%x: %d" % (ins, tmin))
+                                analysis_warning_msg("invalid min value for switch at 0x%x: %d" % (ins, tmin))
                                 validValues = False
                             if tmax < 0:
-                                warning_msg("invalid max value for switch at 0x%x: %d" % (ins, tmax))
+                                analysis_warning_msg("invalid max value for switch at 0x%x: %d" % (ins, tmax))
                                 validValues = False
                             if tmin > tmax:
-                                warning_msg("min greater than max for switch at 0x%x: %d > %d" % (ins, tmin, tmax))
+                                analysis_warning_msg("min greater than max for switch at 0x%x: %d > %d" % (ins, tmin, tmax))
                                 validValues = False
 
                             minAddr = taddr + (tmin * 4)
-                            if minAddr < 0  or  minAddr >= len(self.dataData):
-                                warning_msg("invalid min switch address at 0x%x: 0x%x" % (ins, minAddr))
+                            if minAddr < 0  or  minAddr >= self.dataSegLength:
+                                analysis_warning_msg("invalid min switch address at 0x%x: 0x%x" % (ins, minAddr))
                                 validValues = False
 
                             maxAddr = taddr + (tmax * 4)
-                            if maxAddr < 0  or  maxAddr >= len(self.dataData):
-                                warning_msg("invalid max switch address at 0x%x: 0x%x" % (ins, maxAddr))
+                            if maxAddr < 0  or  maxAddr >= self.dataSegLength:
+                                analysis_warning_msg("invalid max switch address at 0x%x: 0x%x" % (ins, maxAddr))
                                 validValues = False
 
                             #FIXME could also validate that minAddr and maxAddr fall within current function
@@ -2402,10 +3582,10 @@ class Qvm:
                                 self.switchStartStatements.append(ins - 15)
                                 self.switchJumpStatements[ins] = [tmin, tmax, taddr]
                                 for offset in range(tmin, tmax + 1):
-                                    addr = struct.unpack("<L", self.dataData[taddr + (offset * 4): taddr + (offset * 4) + 4])[0]
+                                    addr = self.data_word(taddr + (offset * 4))
 
-                                    if addr < 0  or  addr >= len(self.codeData):
-                                        warning_msg("invalid switch target address at 0x%x: 0x%x" % (ins, addr))
+                                    if addr < 0  or  addr >= self.codeSegLength:
+                                        analysis_warning_msg("invalid switch target address at 0x%x: 0x%x" % (ins, addr))
                                     else:
                                         dataAddr = taddr + (offset * 4)
                                         if dataAddr in self.switchDataTable:
@@ -2438,7 +3618,7 @@ class Qvm:
                         self.functionParmNum[prevParm] = lastArg
 
         self.functionSizes[funcStartInsNum] = funcInsCount
-        h = hash32BitSigned(funcHashSum)
+        h = hasher.digest()
         self.functionHashes[funcStartInsNum] = h
         if h in self.functionRevHashes:
             self.functionRevHashes[h].append(funcStartInsNum)
@@ -2446,87 +3626,179 @@ class Qvm:
             self.functionRevHashes[h] = [funcStartInsNum]
         self.functionMaxArgsCalled[funcStartInsNum] = maxArgs
 
-    def print_function_hashes (self):
+    # Opcodes of the function starting at addr, with the parameters that are
+    # also part of the function hash:  negative constants (system calls) and
+    # locals.  Jump and call targets are left out since they change when
+    # code is added anywhere else.
+    def function_opcode_tokens (self, addr, end):
+        ops = self.insOpcodes
+        parms = self.insParms
+        tokens = []
+        for ins in range(addr, end):
+            opc = ops[ins]
+            if opc == OP_LOCAL  or  (opc == OP_CONST  and  parms[ins] < 0):
+                tokens.append(((parms[ins] & 0xffffff) << 8) | opc)
+            else:
+                tokens.append(opc)
+        return tokens
+
+    def compute_similar_functions (self):
+        self.similarFunctions = {}  # addr:int -> [ [score:float, funcName:str], ... ]
+
+        if self.similarityIndex == None:
+            return
+
+        starts = sorted(self.functionHashes.keys())
+        for i in range(len(starts)):
+            addr = starts[i]
+            if self.functionHashes[addr] in self.baseQ3FunctionRevHashes:
+                continue
+            if i + 1 < len(starts):
+                end = starts[i + 1]
+            else:
+                end = self.instructionCount
+            matches = self.similarityIndex.query(self.function_opcode_tokens(addr, end), topCount=SimilarityTopCount, minScore=SimilarityMinScore)
+            if len(matches) > 0:
+                self.similarFunctions[addr] = matches
+
+    @stats_phase
+    def print_function_hashes (self, out=None):
+        if out == None:
+            out = Output
+
         ks = sorted(self.functionHashes.keys())
 
         for addr in ks:
-            output("0x%08x  0x%x  %x" % (addr, self.functionSizes[addr], self.functionHashes[addr]))
+            out.write("0x%08x  0x%x  %x" % (addr, self.functionSizes[addr], self.functionHashes[addr]))
             if self.functionHashes[addr] in self.baseQ3FunctionRevHashes:
-                output("\tpossible match to")
+                out.write("\tpossible match to")
                 for n in self.baseQ3FunctionRevHashes[self.functionHashes[addr]]:
-                    output(" %s" % n)
-            output("\n")
-
-    # Test opcode parsing code.  The byte string returned by this should equal
-    # self.codeData[:].
+                    out.write(" %s" % n)
+            elif addr in self.similarFunctions:
+                out.write("\tsimilar to")
+                for (score, n) in self.similarFunctions[addr]:
+                    out.write(" %s %.2f" % (n, score))
+            out.write("\n")
+
+        out.flush()
+
+    def compute_control_flow_graph (self):
+        jumpTargets = set(self.jumpPoints.keys())
+        jumpTargets.update(self.switchJumpPoints.keys())
+        jumpTargets.update(self.jumpTableTargets)
+
+        switchTargets = {}  # jumpIns:int -> [ caseAddr1:int, ... ]
+        for (addr, jumps) in self.switchJumpPoints.items():
+            for (ins, caseValue) in jumps:
+                if ins in switchTargets:
+                    switchTargets[ins].append(addr)
+                else:
+                    switchTargets[ins] = [addr]
+
+        self.controlFlowGraph = ControlFlowGraph(self.insOpcodes, self.insParms, sorted(self.functionHashes.keys()), sorted(jumpTargets), switchTargets)
+
+    # One INS_* bit for each kind of annotation at an instruction, so that
+    # print_code_range() only looks up the ones that are there.
+    # jumpTableTargets and switchStartStatements are lists.
+    def compute_instruction_flags (self):
+        flags = array.array('H', [0]) * self.instructionCount
+
+        for (addrs, flag) in (
+                (self.commentsBefore, INS_COMMENT_BEFORE),
+                (self.commentsInline, INS_COMMENT_INLINE),
+                (self.commentsAfter, INS_COMMENT_AFTER),
+                (self.jumpPoints, INS_JUMP_POINT),
+                (self.switchJumpPoints, INS_SWITCH_JUMP_POINT),
+                (self.jumpTableTargets, INS_JUMP_TABLE_TARGET),
+                (self.switchStartStatements, INS_SWITCH_START),
+                (self.switchJumpStatements, INS_SWITCH_JUMP),
+                (self.constants, INS_CONSTANT),
+                (self.pointerDereference, INS_POINTER_DEREFERENCE)
+            ):
+            for addr in addrs:
+                if addr >= 0  and  addr < self.instructionCount:
+                    flags[addr] |= flag
+
+        self.instructionFlags = flags
+
+    # Test opcode parsing code.  The byte string returned by this is rebuilt
+    # from the decoded instructions and should equal self.codeData[:] without
+    # the alignment padding.
     def get_code (self):
         code = []
         ins = 0
-        pos = 0
         while ins < self.instructionCount:
-            # use a slice so you get a byte string in python 3
-            opcStr = self.codeData[pos:pos + 1]
-            opc = xord(opcStr)
-            ins = ins + 1
-            pos = pos + 1
+            opc = self.insOpcodes[ins]
             psize = opcodes[opc][OPCODE_PARM_SIZE]
-            if psize:
-                parmStr = self.codeData[pos : pos + psize]
-            else:
-                parmStr = None
-            pos = pos + psize
-            code.append(opcStr)
-            if parmStr:
-                code.append(parmStr)
+            code.append(struct.pack("<B", opc))
+            if psize == 1:
+                code.append(struct.pack("<B", self.insParms[ins]))
+            elif psize == 4:
+                code.append(struct.pack("<l", self.insParms[ins]))
+            ins = ins + 1
 
         return b"".join(code)
 
-    def get_lit_string (self, addr):
-        stringList = []
-        offset = addr - self.dataSegLength
-        i = 0
-        lastCharPrintable = False
-        while 1:
-            c = xord(self.litData[offset + i])
-            if c == xord(b'\0')  or  offset + i >= self.litSegLength:
-                break
-
-            # close previous quote if non-printable, or add quote if starting new printable sequence
-            if c > 31  and  c < 127:
-                if not lastCharPrintable:
-                    if i != 0:  # no space if this starts everything
-                        stringList.append(" ")
-                    stringList.append("\"")
-                lastCharPrintable = True
-            else:  # not printable
-                if lastCharPrintable:
-                    stringList.append("\" ")
-                lastCharPrintable = False
-
-            if c > 31  and  c < 127:
-                stringList.append(xchr(c))
-            elif c == xord(b'\a'):
-                stringList.append("\\a")
-            elif c == xord(b'\b'):
-                stringList.append("\\b")
-            elif c == xord(b'\t'):
-                stringList.append("\\t")
-            elif c == xord(b'\n'):
-                stringList.append("\\n")
-            elif c == xord(b'\v'):
-                stringList.append("\\v")
-            elif c == xord(b'\f'):
-                stringList.append("\\f")
-            elif c == xord(b'\r'):
-                stringList.append("\\r")
+    # Every string in the lit segment, split at the zero bytes the same way
+    # as the lit disassembly, and the const instructions that point into
+    # them.  The disassembly also ignores consts used by call and jump.
+    def compute_lit_strings (self):
+        data = bytes(self.litData[:self.litSegLength])
+        # reads past the end of a truncated file are zero
+        data += b"\0" * (self.litSegLength - len(data))
+
+        self.litStrings = []  # [ string1:LitString, ... ] in address order
+        self.litStringAddrs = []  # [ addr1:int, ... ] for bisect
+        self.litStringsByValue = {}  # value:bytes -> [ string1:LitString, ... ]
+        offset = 0
+        while offset < self.litSegLength:
+            end = data.find(b"\0", offset)
+            if end == -1:
+                end = self.litSegLength
+            ls = LitString(self.dataSegLength + offset, data[offset : end])
+            self.litStrings.append(ls)
+            self.litStringAddrs.append(ls.addr)
+            if ls.value in self.litStringsByValue:
+                self.litStringsByValue[ls.value].append(ls)
             else:
-                stringList.append("\\x%02x" % c)
-
-            i += 1
-
-        if i == 0:
-            stringList.append("\"\"")  # empty string
-        elif lastCharPrintable:
-            stringList.append("\"")  # close quote
+                self.litStringsByValue[ls.value] = [ls]
+            offset = end + 1
+
+        litStart = self.dataSegLength
+        litEnd = self.dataSegLength + self.litSegLength
+        ops = self.insOpcodes
+        parms = self.insParms
+        for ins in range(self.instructionCount):
+            if ops[ins] != OP_CONST:
+                continue
+            addr = parms[ins]
+            if addr < litStart  or  addr >= litEnd:
+                continue
+            if ins + 1 < self.instructionCount  and  ops[ins + 1] in (OP_CALL, OP_JUMP):
+                continue
+            self.lit_string_at(addr).references.append([ins, addr])
+
+    # returns the LitString containing addr, or None if it isn't in the lit
+    # segment
+    def lit_string_at (self, addr):
+        n = bisect.bisect_right(self.litStringAddrs, addr) - 1
+        if n < 0  or  addr >= self.dataSegLength + self.litSegLength:
+            return None
+        return self.litStrings[n]
+
+    # value:bytes or str, without the terminating zero
+    # returns [ string1:LitString, ... ] with that value
+    def find_lit_strings (self, value):
+        if not isinstance(value, bytes):
+            value = value.encode("latin-1")
+        return self.litStringsByValue.get(value, [])
+
+    # escaped string starting at addr, which can be in the middle of one
+    def get_lit_string (self, addr):
+        ls = self.lit_string_at(addr)
+        if ls == None:
+            return "\"\""
+        if ls.addr == addr:
+            return ls.text
+        return escape_lit_string(ls.value[addr - ls.addr :])
 
-        return "".join(stringList)
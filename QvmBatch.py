@@ -0,0 +1,215 @@
+####
+# Copyright (C) 2012, 2020 Angelo Cano
+#
+# This file is part of Qvmdis.
+#
+# Qvmdis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Qvmdis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Qvmdis.  If not, see <https://www.gnu.org/licenses/>.
+####
+
+# disassemble many qvms, loading the syscalls, baseq3 function hashes, and
+# templates only once
+#
+# Reference data is loaded before the worker processes are forked so they
+# share it instead of parsing the files again.  Each output file is the same
+# as the one qvmdis would write for that qvm.
+
+import os.path, sys, time, traceback
+import Qvm
+
+# qvm file name -> qvm type, used when the type isn't given
+QVM_TYPE_FILE_NAMES = {
+    "cgame.qvm" : "cgame",
+    "qagame.qvm" : "game",
+    "game.qvm" : "game",
+    "ui.qvm" : "ui",
+    "q3_ui.qvm" : "ui",
+    }
+
+class BatchError(Exception):
+    pass
+
+class BatchItem:
+    def __init__ (self, qvmFile, qvmType, outputFile):
+        self.qvmFile = qvmFile
+        self.qvmType = qvmType
+        self.outputFile = outputFile
+
+class BatchResult:
+    def __init__ (self, qvmFile, outputFile, seconds, error=None):
+        self.qvmFile = qvmFile
+        self.outputFile = outputFile
+        self.seconds = seconds
+        self.error = error  # None if successful
+
+class ReferenceData:
+    def __init__ (self):
+        self.templateManager = None
+        self.syscalls = {}  # qvmType:str -> { num:int -> name:str }
+        self.baseQ3FunctionRevHashes = {}  # qvmType:str -> { hash:int -> [ funcName1, funcName2, ... ] }
+        self.similarityIndex = None
+        self.similarityIndexLoaded = False
+
+    def load (self, qvmTypes):
+        for qvmType in qvmTypes:
+            if qvmType not in self.syscalls:
+                self.syscalls[qvmType] = Qvm.read_syscalls(qvmType)
+                self.baseQ3FunctionRevHashes[qvmType] = Qvm.read_baseq3_function_hashes(qvmType)
+
+        if not self.similarityIndexLoaded:
+            self.similarityIndex = Qvm.read_similarity_index()
+            self.similarityIndexLoaded = True
+
+        if self.templateManager == None:
+            # warnings are replayed in the output of every qvm
+            suppressWarnings = Qvm.SuppressWarnings
+            Qvm.SuppressWarnings = True
+            try:
+                self.templateManager = Qvm.TemplateManager()
+                self.templateManager.load_default_templates()
+            finally:
+                Qvm.SuppressWarnings = suppressWarnings
+
+    # sets the lazily loaded attributes so they aren't read again
+    def apply (self, q):
+        q.syscalls = self.syscalls[q.qvmType]
+        q.baseQ3FunctionRevHashes = self.baseQ3FunctionRevHashes[q.qvmType]
+        q.templateManager = self.templateManager
+        q.similarityIndex = self.similarityIndex
+        for msg in self.templateManager.loadWarnings:
+            Qvm.warning_msg(msg)
+
+# shared with forked workers
+SharedReferenceData = None
+
+def guess_qvm_type (qvmFile):
+    name = os.path.basename(qvmFile).lower()
+    if name in QVM_TYPE_FILE_NAMES:
+        return QVM_TYPE_FILE_NAMES[name]
+    return None
+
+# source:  directory searched recursively for .qvm files, or a text file with
+#          one qvm file name per line
+def find_qvm_files (source):
+    qvmFiles = []
+    if os.path.isdir(source):
+        for (dirPath, dirNames, fileNames) in os.walk(source):
+            dirNames.sort()
+            for n in sorted(fileNames):
+                if n.lower().endswith(".qvm"):
+                    qvmFiles.append(os.path.join(dirPath, n))
+    else:
+        try:
+            f = open(source)
+            lines = f.readlines()
+            f.close()
+        except (IOError, OSError) as ex:
+            raise BatchError("couldn't read qvm list %s: %s" % (source, ex))
+        for line in lines:
+            line = line.strip()
+            if len(line) > 0  and  not line.startswith(";"):
+                qvmFiles.append(line)
+    return qvmFiles
+
+# Output files mirror the qvm paths relative to the directory they have in
+# common.  Ex: mods/a/vm/cgame.qvm -> outDir/a/vm/cgame.dis
+def batch_items (qvmFiles, outDir, qvmType=None, extension=".dis"):
+    if len(qvmFiles) == 0:
+        return []
+
+    dirs = [os.path.dirname(os.path.abspath(f)) for f in qvmFiles]
+    commonDir = os.path.commonprefix(dirs)
+    if not os.path.isdir(commonDir)  or  not all(d == commonDir  or  d.startswith(os.path.join(commonDir, "")) for d in dirs):
+        commonDir = os.path.dirname(commonDir)
+
+    items = []
+    for f in qvmFiles:
+        relName = os.path.relpath(os.path.abspath(f), commonDir)
+        outputFile = os.path.join(outDir, os.path.splitext(relName)[0] + extension)
+        t = qvmType
+        if t == None:
+            t = guess_qvm_type(f)
+        items.append(BatchItem(f, t, outputFile))
+    return items
+
+# item:BatchItem, options:{}  useMmap, onlyPrintFunctionHashes
+def process_item (item, options):
+    startTime = time.time()
+    error = None
+
+    outDir = os.path.dirname(item.outputFile)
+    try:
+        if len(outDir) > 0  and  not os.path.isdir(outDir):
+            os.makedirs(outDir)
+        f = open(item.outputFile, "w")
+    except (IOError, OSError) as ex:
+        return BatchResult(item.qvmFile, item.outputFile, time.time() - startTime, error="couldn't open output file: %s" % ex)
+
+    savedOutput = Qvm.Output
+    Qvm.Output = Qvm.OutputSink(f)
+    try:
+        try:
+            q = Qvm.Qvm(item.qvmFile, item.qvmType, useMmap=options.get("useMmap", False))
+            SharedReferenceData.apply(q)
+            if options.get("onlyPrintFunctionHashes", False):
+                q.print_function_hashes()
+            else:
+                q.print_disassembly()
+        except SystemExit as ex:
+            # error_exit() already wrote the message to the output
+            error = "exited with %s" % ex.code
+        except Exception as ex:
+            Qvm.output(traceback.format_exc())
+            error = "%s: %s" % (ex.__class__.__name__, ex)
+    finally:
+        Qvm.flush_output()
+        Qvm.Output = savedOutput
+        f.close()
+
+    return BatchResult(item.qvmFile, item.outputFile, time.time() - startTime, error=error)
+
+# for the process pool
+def process_item_worker (args):
+    (item, options) = args
+    return process_item(item, options)
+
+# returns [ result1:BatchResult, result2:BatchResult, ... ] in items order
+def run_batch (items, jobs=1, options={}):
+    global SharedReferenceData
+
+    if SharedReferenceData == None:
+        SharedReferenceData = ReferenceData()
+    SharedReferenceData.load(sorted(set(item.qvmType for item in items), key=str))
+    Qvm.flush_output()
+
+    work = [(item, options) for item in items]
+    if jobs <= 1  or  len(items) <= 1  or  not Qvm.can_fork():
+        return [process_item_worker(w) for w in work]
+
+    pool = Qvm.fork_pool(min(jobs, len(items)))
+    try:
+        results = pool.map(process_item_worker, work, chunksize=1)
+    finally:
+        pool.terminate()
+        pool.join()
+    return results
+
+def print_summary (results, totalSeconds, out=sys.stdout):
+    failed = [r for r in results if r.error != None]
+    for r in results:
+        if r.error == None:
+            status = "ok"
+        else:
+            status = "FAILED  %s" % r.error
+        out.write("%8.2fs  %s -> %s  %s\n" % (r.seconds, r.qvmFile, r.outputFile, status))
+    out.write("\n%d qvms, %d failed, %.2fs total, %.2fs wall\n" % (len(results), len(failed), sum(r.seconds for r in results), totalSeconds))
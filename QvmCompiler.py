@@ -0,0 +1,525 @@
+####
+# Copyright (C) 2012, 2020 Angelo Cano
+#
+# This file is part of Qvmdis.
+#
+# Qvmdis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Qvmdis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Qvmdis.  If not, see <https://www.gnu.org/licenses/>.
+####
+
+# translates qvm functions to python functions
+#
+# Each function is split into the basic blocks of Qvm.controlFlowGraph,
+# and the opStack depth at the start of each block is found by following
+# its edges.  The opStack is followed while a block is translated:
+# arithmetic and loads become python expressions and only stores, args,
+# calls, and branches create statements.  Values left on the opStack at the
+# end of a block are kept in local variables s0, s1, ... so a block doesn't
+# need to know where it was entered from.
+#
+#   const  0xcbab0          s0 = I32(image, (ps + 24) & M)[0]
+#   load4                   P32(image, (ps + 16) & M, ...)
+#   local  0x18
+#   load4          ->
+#   ...
+#
+# A generated function takes the interpreter and the caller's program
+# stack and returns the function's result.  Blocks are selected with a
+# binary tree of 'if' statements inside a loop.  Code objects are cached by
+# function hash and instructions, so loading the same qvm again, or a qvm
+# with the same functions, doesn't compile them again.  Functions that can't
+# be translated, ex: the opStack depth differs between the paths reaching a
+# block, are run by the interpreter.
+
+from Qvm import opcodes, OPCODE_NAME, OPCODE_JUMP_PARM, BLOCK_FALLTHROUGH, BLOCK_BRANCH, BLOCK_SWITCH, BLOCK_RETURN, \
+    OP_UNDEF, OP_IGNORE, OP_BREAK, OP_ENTER, OP_LEAVE, OP_CALL, OP_PUSH, OP_POP, OP_CONST, OP_LOCAL, OP_JUMP, \
+    OP_LOAD1, OP_LOAD2, OP_LOAD4, OP_STORE1, OP_STORE2, OP_STORE4, OP_ARG, OP_BLOCK_COPY
+from QvmInterpreter import QvmInterpreter, VmError, PROGRAM_STACK_SIZE, INT32, UINT16, \
+    to_int32, int_bits_to_float, float_to_int_bits, float_divide, int_divide, float_to_int
+import hashlib, struct
+
+# (functionHash, instructions digest) -> code object
+CompiledCodeCache = {}
+
+class CompileError(Exception):
+    pass
+
+def wrap (e):
+    return "((((%s) + 2147483648) & 4294967295) - 2147483648)" % e
+
+# opcode name -> python expression for NIS (a) and TOS (b)
+BINARY_EXPRESSIONS = {
+    "add" : lambda a, b: wrap("%s + %s" % (a, b)),
+    "sub" : lambda a, b: wrap("%s - %s" % (a, b)),
+    "muli" : lambda a, b: wrap("%s * %s" % (a, b)),
+    "mulu" : lambda a, b: wrap("%s * %s" % (a, b)),
+    "divi" : lambda a, b: wrap("idiv(%s, %s)" % (a, b)),
+    "divu" : lambda a, b: wrap("idiv(%s & 4294967295, %s & 4294967295)" % (a, b)),
+    "modi" : lambda a, b: wrap("imod(%s, %s)" % (a, b)),
+    "modu" : lambda a, b: wrap("umod(%s, %s)" % (a, b)),
+    "band" : lambda a, b: "(%s & %s)" % (a, b),
+    "bor" : lambda a, b: "(%s | %s)" % (a, b),
+    "bxor" : lambda a, b: "(%s ^ %s)" % (a, b),
+    "lsh" : lambda a, b: wrap("%s << (%s & 31)" % (a, b)),
+    "rshi" : lambda a, b: "(%s >> (%s & 31))" % (a, b),
+    "rshu" : lambda a, b: wrap("(%s & 4294967295) >> (%s & 31)" % (a, b)),
+    "addf" : lambda a, b: "fb(ff(%s) + ff(%s))" % (a, b),
+    "subf" : lambda a, b: "fb(ff(%s) - ff(%s))" % (a, b),
+    "mulf" : lambda a, b: "fb(ff(%s) * ff(%s))" % (a, b),
+    "divf" : lambda a, b: "fb(fdiv(ff(%s), ff(%s)))" % (a, b),
+    }
+
+# opcode name -> python condition for NIS (a) and TOS (b)
+BRANCH_CONDITIONS = {
+    "eq" : lambda a, b: "%s == %s" % (a, b),
+    "ne" : lambda a, b: "%s != %s" % (a, b),
+    "lti" : lambda a, b: "%s < %s" % (a, b),
+    "lei" : lambda a, b: "%s <= %s" % (a, b),
+    "gti" : lambda a, b: "%s > %s" % (a, b),
+    "gei" : lambda a, b: "%s >= %s" % (a, b),
+    "ltu" : lambda a, b: "(%s & 4294967295) < (%s & 4294967295)" % (a, b),
+    "leu" : lambda a, b: "(%s & 4294967295) <= (%s & 4294967295)" % (a, b),
+    "gtu" : lambda a, b: "(%s & 4294967295) > (%s & 4294967295)" % (a, b),
+    "geu" : lambda a, b: "(%s & 4294967295) >= (%s & 4294967295)" % (a, b),
+    "eqf" : lambda a, b: "ff(%s) == ff(%s)" % (a, b),
+    "nef" : lambda a, b: "ff(%s) != ff(%s)" % (a, b),
+    "ltf" : lambda a, b: "ff(%s) < ff(%s)" % (a, b),
+    "lef" : lambda a, b: "ff(%s) <= ff(%s)" % (a, b),
+    "gtf" : lambda a, b: "ff(%s) > ff(%s)" % (a, b),
+    "gef" : lambda a, b: "ff(%s) >= ff(%s)" % (a, b),
+    }
+
+# opcode name -> python expression for TOS (a)
+UNARY_EXPRESSIONS = {
+    "sex8" : lambda a: "(((%s & 255) ^ 128) - 128)" % a,
+    "sex16" : lambda a: "(((%s & 65535) ^ 32768) - 32768)" % a,
+    "negi" : lambda a: wrap("-%s" % a),
+    "bcom" : lambda a: "(~%s)" % a,
+    "negf" : lambda a: "(%s ^ -2147483648)" % a,
+    "cvif" : lambda a: "fb(float(%s))" % a,
+    "cvfi" : lambda a: "ftoi(ff(%s))" % a,
+    "load1" : lambda a: "image[%s & M]" % a,
+    "load2" : lambda a: "U16(image, %s & M)[0]" % a,
+    "load4" : lambda a: "I32(image, %s & M)[0]" % a,
+    }
+
+def imod (a, b):
+    return a - b * int_divide(a, b)
+
+def umod (a, b):
+    a &= 0xffffffff
+    b &= 0xffffffff
+    if b == 0:
+        raise VmError("integer division by zero")
+    return a % b
+
+# globals of the generated code
+CODE_GLOBALS = {
+    "I32" : INT32.unpack_from,
+    "P32" : INT32.pack_into,
+    "U16" : UINT16.unpack_from,
+    "P16" : UINT16.pack_into,
+    "ff" : int_bits_to_float,
+    "fb" : float_to_int_bits,
+    "fdiv" : float_divide,
+    "idiv" : int_divide,
+    "imod" : imod,
+    "umod" : umod,
+    "ftoi" : float_to_int,
+    "to_int32" : to_int32,
+    "VmError" : VmError,
+    }
+
+# value on the opStack while a block is translated
+class StackEntry:
+    def __init__ (self, expr, pure=True, slots=(), value=None):
+        self.expr = expr
+        self.pure = pure  # doesn't read memory
+        self.slots = frozenset(slots)  # s<n> variables used by expr
+        self.value = value  # int if it's a constant
+
+class FunctionCompiler:
+    # qvm:Qvm  start, end:  instruction range of the function
+    def __init__ (self, qvm, start, end):
+        self.qvm = qvm
+        self.start = start
+        self.end = end
+
+        ops = qvm.insOpcodes
+        parms = qvm.insParms
+        self.ops = [int(ops[i]) for i in range(start, end)]
+        self.parms = [int(parms[i]) for i in range(start, end)]
+
+        self.find_blocks()
+
+    def op (self, ins):
+        return self.ops[ins - self.start]
+
+    def parm (self, ins):
+        return self.parms[ins - self.start]
+
+    # the blocks are the ones of the qvm's control flow graph, numbered from
+    # 0 for the function
+    def find_blocks (self):
+        self.cfg = self.qvm.controlFlowGraph
+        (self.firstBlock, endBlock) = self.cfg.function_blocks(self.start)
+        if self.cfg.blockStarts[endBlock] != self.end:
+            raise CompileError("function 0x%x doesn't end at 0x%x" % (self.start, self.end))
+        self.blockStarts = list(self.cfg.blockStarts[self.firstBlock : endBlock])
+        self.blockNums = {}  # addr:int -> blockNum:int
+        for n in range(len(self.blockStarts)):
+            self.blockNums[self.blockStarts[n]] = n
+
+    # returns the blocks that the computed jump at ins can go to, a switch
+    # only goes to its cases, other jumps to any jump point
+    def computed_jump_blocks (self, ins):
+        return [b - self.firstBlock for b in self.cfg.successors(self.cfg.block_at(ins))]
+
+    # returns the number of the block starting at addr, jumps at ins to
+    # other instructions can't be translated
+    def block_num (self, addr, ins):
+        if addr not in self.blockNums:
+            raise CompileError("jump at 0x%x to 0x%x isn't a block in the function" % (ins, addr))
+        return self.blockNums[addr]
+
+    def block_end (self, n):
+        if n + 1 < len(self.blockStarts):
+            return self.blockStarts[n + 1]
+        return self.end
+
+    # key for the compiled code cache
+    def cache_key (self):
+        h = hashlib.sha1()
+        h.update(struct.pack("<ii", self.start, self.end))
+        h.update(struct.pack("<%di" % len(self.ops), *self.ops))
+        h.update(struct.pack("<%di" % len(self.parms), *self.parms))
+        h.update(struct.pack("<%di" % len(self.blockStarts), *self.blockStarts))
+        # switch tables are in the data segment
+        for n in range(len(self.blockStarts)):
+            if self.cfg.blockExits[self.firstBlock + n] == BLOCK_SWITCH:
+                ins = self.block_end(n) - 1
+                targets = self.computed_jump_blocks(ins)
+                h.update(struct.pack("<%di" % (len(targets) + 1), ins, *targets))
+        return (self.qvm.functionHashes.get(self.start, 0), h.hexdigest())
+
+    # opStack depth at the start of each block, None for blocks that can't
+    # be reached
+    def block_depths (self):
+        if self.op(self.start) != OP_ENTER:
+            raise CompileError("function 0x%x doesn't start with enter" % self.start)
+        if len(self.cfg.predecessors(self.firstBlock)) > 0:
+            raise CompileError("jump to enter at 0x%x" % self.start)
+
+        depths = { 0 : 0 }
+        work = [0]
+        while len(work) > 0:
+            n = work.pop()
+            depth = depths[n]
+            prevConst = None
+            for ins in range(self.blockStarts[n], self.block_end(n)):
+                opc = self.op(ins)
+                name = opcodes[opc][OPCODE_NAME]
+                if opc in (OP_CONST, OP_LOCAL, OP_PUSH):
+                    depth += 1
+                elif opc in (OP_POP, OP_ARG):
+                    depth -= 1
+                elif opc in (OP_STORE1, OP_STORE2, OP_STORE4, OP_BLOCK_COPY):
+                    depth -= 2
+                elif name in BINARY_EXPRESSIONS:
+                    depth -= 1
+                elif opcodes[opc][OPCODE_JUMP_PARM]:
+                    depth -= 2
+                    # the graph has no edges out of the function
+                    if self.parm(ins) not in self.blockNums:
+                        raise CompileError("branch at 0x%x to 0x%x outside of function" % (ins, self.parm(ins)))
+                elif opc == OP_JUMP:
+                    depth -= 1
+                    if prevConst != None  and  prevConst not in self.blockNums:
+                        raise CompileError("jump at 0x%x to 0x%x outside of function" % (ins, prevConst))
+                elif opc == OP_ENTER  and  ins != self.start:
+                    raise CompileError("enter at 0x%x inside of function" % ins)
+                elif opc == OP_CALL  and  depth < 1:
+                    raise CompileError("call at 0x%x without address" % ins)
+                if depth < 0:
+                    raise CompileError("opStack underflow at 0x%x" % ins)
+                if opc == OP_CONST:
+                    prevConst = self.parm(ins)
+                else:
+                    prevConst = None
+
+            blockExit = self.cfg.blockExits[self.firstBlock + n]
+            if blockExit == BLOCK_RETURN:
+                if depth != 1:
+                    raise CompileError("opStack depth %d at leave 0x%x" % (depth, ins))
+            elif blockExit in (BLOCK_FALLTHROUGH, BLOCK_BRANCH)  and  n + 1 == len(self.blockStarts):
+                raise CompileError("function 0x%x doesn't end with leave" % self.start)
+
+            for s in self.cfg.successors(self.firstBlock + n):
+                s -= self.firstBlock
+                if s not in depths:
+                    depths[s] = depth
+                    work.append(s)
+                elif depths[s] != depth:
+                    raise CompileError("opStack depth %d and %d at block 0x%x" % (depths[s], depth, self.blockStarts[s]))
+
+        return [depths.get(n) for n in range(len(self.blockStarts))]
+
+    def compile (self):
+        depths = self.block_depths()
+        self.computedJumps = set()
+        blocks = []
+        for n in range(len(self.blockStarts)):
+            blocks.append(self.compile_block(n, depths[n]))
+
+        lines = []
+        for ins in sorted(self.computedJumps):
+            # instruction -> block
+            targets = ", ".join("%d : %d" % (self.blockStarts[b], b) for b in self.computed_jump_blocks(ins))
+            lines.append("J%d = { %s }" % (ins, targets))
+        lines.append("def f (vm, ps):")
+        lines.append("    image = vm.image")
+        lines.append("    M = vm.dataMask")
+        lines.append("    FN = vm.functionTable")
+        lines.append("    ps -= %d" % self.parm(self.start))
+        lines.append("    if ps <= vm.stackBottom:")
+        lines.append("        raise VmError('program stack overflow')")
+        lines.append("    b = 0")
+        lines.append("    while 1:")
+        self.block_tree(lines, blocks, 0, len(blocks), "        ")
+        return "\n".join(lines) + "\n"
+
+    # selects the block with a binary tree of comparisons
+    def block_tree (self, lines, blocks, lo, hi, indent):
+        if hi - lo == 1:
+            for l in blocks[lo]:
+                lines.append(indent + l)
+            return
+        mid = (lo + hi) // 2
+        lines.append(indent + "if b < %d:" % mid)
+        self.block_tree(lines, blocks, lo, mid, indent + "    ")
+        lines.append(indent + "else:")
+        self.block_tree(lines, blocks, mid, hi, indent + "    ")
+
+    # returns [ line1:str, line2:str, ... ]
+    def compile_block (self, n, depth):
+        lines = ["# 0x%x" % self.blockStarts[n]]
+        if depth == None:
+            lines.append("raise VmError('unreachable instruction 0x%x')" % self.blockStarts[n])
+            return lines
+        stack = [StackEntry("s%d" % i, slots=(i,)) for i in range(depth)]
+
+        # stores stack[i] in s<i>, values below it using s<i> are stored
+        # first
+        def materialize (i):
+            e = stack[i]
+            if e.expr == "s%d" % i:
+                return
+            for j in range(i):
+                if i in stack[j].slots:
+                    materialize(j)
+            lines.append("s%d = %s" % (i, e.expr))
+            stack[i] = StackEntry("s%d" % i, slots=(i,))
+
+        # the memory reads still on the stack need to happen before a write
+        def before_side_effect ():
+            for i in range(len(stack)):
+                if not stack[i].pure:
+                    materialize(i)
+
+        def flush ():
+            for i in range(len(stack)):
+                materialize(i)
+
+        # assigns expr to the next stack slot
+        def push_statement (expr):
+            i = len(stack)
+            for j in range(i):
+                if i in stack[j].slots:
+                    materialize(j)
+            lines.append("s%d = %s" % (i, expr))
+            stack.append(StackEntry("s%d" % i, slots=(i,)))
+
+        def combine (expr, entries, pure=True, value=None):
+            slots = set()
+            for e in entries:
+                slots.update(e.slots)
+                pure = pure  and  e.pure
+            return StackEntry(expr, pure=pure, slots=slots, value=value)
+
+        # like the control flow graph, only a jump right after a const has a
+        # known target
+        prevConst = None
+        for ins in range(self.blockStarts[n], self.block_end(n)):
+            opc = self.op(ins)
+            parm = self.parm(ins)
+            name = opcodes[opc][OPCODE_NAME]
+
+            if opc == OP_ENTER:
+                # only at the start, handled before the loop
+                pass
+            elif opc in (OP_IGNORE, OP_BREAK):
+                pass
+            elif opc == OP_UNDEF:
+                lines.append("raise VmError('undefined opcode at 0x%x')" % ins)
+                return lines
+            elif opc == OP_CONST:
+                stack.append(StackEntry("%d" % parm, value=parm))
+            elif opc == OP_LOCAL:
+                stack.append(StackEntry("(ps + %d)" % parm))
+            elif opc == OP_PUSH:
+                stack.append(StackEntry("0", value=0))
+            elif opc == OP_POP:
+                stack.pop()
+            elif name in UNARY_EXPRESSIONS:
+                a = stack.pop()
+                stack.append(combine(UNARY_EXPRESSIONS[name](a.expr), [a], pure=opc not in (OP_LOAD1, OP_LOAD2, OP_LOAD4)))
+            elif name in BINARY_EXPRESSIONS:
+                b = stack.pop()
+                a = stack.pop()
+                stack.append(combine(BINARY_EXPRESSIONS[name](a.expr, b.expr), [a, b]))
+            elif opc in (OP_STORE1, OP_STORE2, OP_STORE4):
+                v = stack.pop()
+                a = stack.pop()
+                before_side_effect()
+                if opc == OP_STORE1:
+                    lines.append("image[%s & M] = %s & 255" % (a.expr, v.expr))
+                elif opc == OP_STORE2:
+                    lines.append("P16(image, %s & M, %s & 65535)" % (a.expr, v.expr))
+                else:
+                    lines.append("P32(image, %s & M, %s)" % (a.expr, v.expr))
+            elif opc == OP_ARG:
+                v = stack.pop()
+                before_side_effect()
+                lines.append("P32(image, (ps + %d) & M, %s)" % (parm, v.expr))
+            elif opc == OP_BLOCK_COPY:
+                src = stack.pop()
+                dest = stack.pop()
+                before_side_effect()
+                lines.append("vm.block_copy(%s & 4294967295, %s & 4294967295, %d)" % (dest.expr, src.expr, parm))
+            elif opc == OP_CALL:
+                t = stack.pop()
+                before_side_effect()
+                if t.value != None  and  t.value < 0:
+                    push_statement("vm.syscall_at(%d, ps)" % t.value)
+                elif t.value != None  and  t.value in self.qvm.functionHashes:
+                    push_statement("FN[%d](vm, ps)" % t.value)
+                else:
+                    push_statement("vm.call_address(%s, ps)" % t.expr)
+            elif opcodes[opc][OPCODE_JUMP_PARM]:
+                b = stack.pop()
+                a = stack.pop()
+                flush()
+                lines.append("if %s:" % BRANCH_CONDITIONS[name](a.expr, b.expr))
+                lines.append("    b = %d" % self.block_num(parm, ins))
+                lines.append("    continue")
+            elif opc == OP_JUMP:
+                t = stack.pop()
+                flush()
+                if prevConst != None:
+                    lines.append("b = %d" % self.block_num(prevConst, ins))
+                else:
+                    self.computedJumps.add(ins)
+                    lines.append("b = J%d.get(%s, -1)" % (ins, t.expr))
+                    lines.append("if b < 0:")
+                    lines.append("    raise VmError('jump to invalid instruction 0x%%x' %% %s)" % t.expr)
+                lines.append("continue")
+                return lines
+            elif opc == OP_LEAVE:
+                lines.append("return %s" % stack[-1].expr)
+                return lines
+            else:
+                raise CompileError("can't translate %s at 0x%x" % (name, ins))
+
+            if opc == OP_CONST:
+                prevConst = parm
+            else:
+                prevConst = None
+
+        flush()
+        lines.append("b = %d" % (n + 1))
+        lines.append("continue")
+        return lines
+
+# QvmInterpreter that runs functions translated to python
+class QvmCompiledInterpreter (QvmInterpreter):
+    def __init__ (self, qvm, syscalls=None, stackSize=PROGRAM_STACK_SIZE):
+        QvmInterpreter.__init__(self, qvm, syscalls, stackSize)
+
+        self.compileErrors = {}  # addr:int -> msg:str
+        self.functionEnds = {}  # addr:int -> end:int
+
+        # functions are translated on their first call
+        self.functionTable = [None] * self.instructionCount
+        starts = sorted(qvm.functionHashes.keys())
+        for i in range(len(starts)):
+            addr = starts[i]
+            if i + 1 < len(starts):
+                self.functionEnds[addr] = starts[i + 1]
+            else:
+                self.functionEnds[addr] = self.instructionCount
+            self.functionTable[addr] = self.function_stub(addr)
+
+    def function_stub (self, addr):
+        def stub (vm, ps):
+            return vm.load_function(addr)(vm, ps)
+        return stub
+
+    def interpreted_function (self, addr):
+        def func (vm, ps):
+            return QvmInterpreter.run_function(vm, addr, ps)
+        return func
+
+    # returns the generated python source
+    def function_source (self, addr):
+        return FunctionCompiler(self.qvm, addr, self.functionEnds[addr]).compile()
+
+    def load_function (self, addr):
+        try:
+            compiler = FunctionCompiler(self.qvm, addr, self.functionEnds[addr])
+            key = compiler.cache_key()
+            if key not in CompiledCodeCache:
+                CompiledCodeCache[key] = compile(compiler.compile(), "<qvm function 0x%x>" % addr, "exec")
+            namespace = dict(CODE_GLOBALS)
+            exec(CompiledCodeCache[key], namespace)
+            func = namespace["f"]
+        except CompileError as ex:
+            self.compileErrors[addr] = str(ex)
+            func = self.interpreted_function(addr)
+
+        self.functionTable[addr] = func
+        return func
+
+    def run_function (self, addr, programStack):
+        func = self.functionTable[addr]
+        if func == None:
+            return QvmInterpreter.run_function(self, addr, programStack)
+        return func(self, programStack)
+
+    # call with an address computed at run time
+    def call_address (self, addr, programStack):
+        if addr < 0:
+            return self.syscall_at(addr, programStack)
+        if addr >= self.instructionCount:
+            raise VmError("call to invalid instruction 0x%x" % addr)
+        return self.run_function(addr, programStack)
+
+    def syscall_at (self, num, programStack):
+        # q3 passes the system call index as the first argument
+        self.write_int(programStack + 4, -1 - num)
+        saved = self.programStack
+        self.programStack = programStack
+        try:
+            r = self.syscall(num)
+        finally:
+            self.programStack = saved
+        return to_int32(r)
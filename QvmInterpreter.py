@@ -0,0 +1,651 @@
+####
+# Copyright (C) 2012, 2020 Angelo Cano
+#
+# This file is part of Qvmdis.
+#
+# Qvmdis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Qvmdis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Qvmdis.  If not, see <https://www.gnu.org/licenses/>.
+####
+
+# runs qvm code, following q3 code/qcommon/vm_interpreted.c
+#
+# The data, lit, and bss segments are copied into a memory image rounded up
+# to a power of two and every address is masked with dataMask.  The program
+# stack starts at the end of the image and grows down.  Instructions are
+# decoded once into [handler, parm] pairs and the opStack is an array of 256
+# ints indexed with a wrapping 8-bit offset like the q3 one.
+#
+# System calls are looked up in a SyscallTable.  Handlers are called with
+# the interpreter and the argument list:  args[0] is the system call index
+# (-1 - call number) and args[1:] are the values passed with 'arg'.  The
+# return value is pushed on the opStack, float results need to be converted
+# with float_to_int_bits().
+
+from Qvm import opcodes, read_syscalls, OPCODE_NAME, OPCODE_JUMP_PARM
+import array, math, struct, sys, time
+
+PROGRAM_STACK_SIZE = 0x10000
+MAX_VMMAIN_ARGS = 13
+MAX_VMSYSCALL_ARGS = 16
+
+INT32 = struct.Struct("<i")
+UINT16 = struct.Struct("<H")
+FLOAT32 = struct.Struct("<f")
+SYSCALL_ARGS = struct.Struct("<%di" % MAX_VMSYSCALL_ARGS)
+
+class VmError(Exception):
+    pass
+
+# wraps a python int to a signed 32-bit value
+def to_int32 (v):
+    return ((v + 0x80000000) & 0xffffffff) - 0x80000000
+
+def int_bits_to_float (i):
+    return FLOAT32.unpack(INT32.pack(i))[0]
+
+def float_to_int_bits (f):
+    try:
+        return INT32.unpack(FLOAT32.pack(f))[0]
+    except OverflowError:
+        # too large for a float, C gives infinity
+        return INT32.unpack(FLOAT32.pack(math.copysign(float("inf"), f)))[0]
+
+# C float division, doesn't raise on division by zero
+def float_divide (a, b):
+    if b == 0.0:
+        if a == 0.0  or  a != a:
+            return float("nan")
+        return math.copysign(float("inf"), a) * math.copysign(1.0, b)
+    return a / b
+
+# C integer division and modulo truncate towards zero
+def int_divide (a, b):
+    if b == 0:
+        raise VmError("integer division by zero")
+    q = abs(a) // abs(b)
+    if (a < 0) != (b < 0):
+        q = -q
+    return q
+
+# Q_ftol(), out of range values give 0x80000000 like x86
+def float_to_int (f):
+    if f != f  or  f >= 2147483648.0  or  f < -2147483648.0:
+        return -0x80000000
+    return int(f)
+
+class SyscallTable:
+    # syscalls:{} num:int -> name:str  as returned by Qvm.read_syscalls()
+    def __init__ (self, syscalls={}):
+        self.names = dict(syscalls)
+        self.numbers = {}  # name:str -> num:int
+        for num in syscalls:
+            self.numbers[syscalls[num]] = num
+        self.handlers = {}  # num:int -> handler(interpreter, args)
+
+    # nameOrNum:  name from the syscalls .asm file or negative call number
+    def register (self, nameOrNum, handler):
+        if isinstance(nameOrNum, int):
+            num = nameOrNum
+        elif nameOrNum in self.numbers:
+            num = self.numbers[nameOrNum]
+        else:
+            raise VmError("unknown system call %s" % nameOrNum)
+        self.handlers[num] = handler
+
+    def name (self, num):
+        if num in self.names:
+            return self.names[num]
+        return "syscall %d" % num
+
+    # library functions and printing, registered if the qvm type has them
+    def register_defaults (self):
+        for (name, handler) in DEFAULT_SYSCALL_HANDLERS:
+            if name in self.numbers:
+                self.register(name, handler)
+
+def syscall_print (interp, args):
+    interp.output(interp.read_string(args[1]))
+    return 0
+
+def syscall_error (interp, args):
+    raise VmError("trap_Error: %s" % interp.read_string(args[1]).rstrip("\n"))
+
+def syscall_milliseconds (interp, args):
+    return to_int32(int((time.time() - interp.startTime) * 1000))
+
+def syscall_memset (interp, args):
+    (dest, c, n) = args[1:4]
+    interp.check_range(dest, n)
+    interp.image[dest : dest + n] = bytearray([c & 0xff]) * n
+    return dest
+
+def syscall_memcpy (interp, args):
+    (dest, src, n) = args[1:4]
+    interp.check_range(dest, n)
+    interp.check_range(src, n)
+    interp.image[dest : dest + n] = interp.image[src : src + n]
+    return dest
+
+def syscall_strncpy (interp, args):
+    (dest, src, n) = args[1:4]
+    interp.check_range(dest, n)
+    image = interp.image
+    mask = interp.dataMask
+    i = 0
+    while i < n:
+        c = image[(src + i) & mask]
+        if c == 0:
+            break
+        image[dest + i] = c
+        i += 1
+    # pads with zeros like C
+    image[dest + i : dest + n] = bytearray(n - i)
+    return dest
+
+# handler for a system call with float arguments and result
+def float_syscall (func, argCount):
+    def handler (interp, args):
+        try:
+            result = func(*[int_bits_to_float(a) for a in args[1 : argCount + 1]])
+        except (ValueError, OverflowError):
+            # domain error, C returns nan
+            result = float("nan")
+        return float_to_int_bits(result)
+    return handler
+
+def syscall_test_print_int (interp, args):
+    interp.output("%s%i\n" % (interp.read_string(args[1]), args[2]))
+    return 0
+
+def syscall_test_print_float (interp, args):
+    interp.output("%s%f\n" % (interp.read_string(args[1]), int_bits_to_float(args[2])))
+    return 0
+
+DEFAULT_SYSCALL_HANDLERS = (
+    ("trap_Print", syscall_print),
+    ("trap_Printf", syscall_print),
+    ("trap_Error", syscall_error),
+    ("trap_Milliseconds", syscall_milliseconds),
+    ("memset", syscall_memset),
+    ("memcpy", syscall_memcpy),
+    ("strncpy", syscall_strncpy),
+    ("sin", float_syscall(math.sin, 1)),
+    ("cos", float_syscall(math.cos, 1)),
+    ("atan2", float_syscall(math.atan2, 2)),
+    ("sqrt", float_syscall(math.sqrt, 1)),
+    ("floor", float_syscall(math.floor, 1)),
+    ("ceil", float_syscall(math.ceil, 1)),
+    ("acos", float_syscall(math.acos, 1)),
+    ("testPrintInt", syscall_test_print_int),
+    ("testPrintFloat", syscall_test_print_float),
+    )
+
+# syscalls for the qvm type with the default handlers registered
+def default_syscall_table (qvmType):
+    table = SyscallTable(read_syscalls(qvmType))
+    table.register_defaults()
+    return table
+
+class QvmInterpreter:
+    # qvm:Qvm, syscalls:SyscallTable  defaults to default_syscall_table() for
+    # the qvm type
+    def __init__ (self, qvm, syscalls=None, stackSize=PROGRAM_STACK_SIZE):
+        if syscalls == None:
+            syscalls = default_syscall_table(qvm.qvmType)
+        self.qvm = qvm
+        self.syscalls = syscalls
+        self.output = sys.stdout.write
+        self.startTime = time.time()
+
+        # same as VM_LoadQVM()
+        dataLength = qvm.dataSegLength + qvm.litSegLength + qvm.bssSegLength
+        imageSize = 1
+        while imageSize < dataLength:
+            imageSize <<= 1
+        self.dataMask = imageSize - 1
+        # extra bytes so that 2 and 4 byte accesses at the end of the image
+        # don't need to be split
+        self.image = bytearray(imageSize + 4)
+        self.image[0 : qvm.dataSegLength] = bytes(qvm.dataData)
+        self.image[qvm.dataSegLength : qvm.dataSegLength + qvm.litSegLength] = bytes(qvm.litData)
+
+        self.programStack = imageSize
+        self.stackBottom = imageSize - stackSize
+
+        self.instructionCount = qvm.instructionCount
+        self.decode_program()
+
+        self.opStack = array.array('i', [0] * 256)
+        self.sp = 0
+        self.pc = -1
+
+    # program:[ [handler, parm], ... ] one for each instruction
+    def decode_program (self):
+        dispatch = []
+        for op in opcodes:
+            dispatch.append(getattr(self, "op_" + op[OPCODE_NAME]))
+
+        ops = self.qvm.insOpcodes
+        parms = self.qvm.insParms
+        if hasattr(ops, "tolist"):
+            ops = ops.tolist()
+            parms = parms.tolist()
+
+        self.program = []
+        for ins in range(self.instructionCount):
+            opc = ops[ins]
+            parm = parms[ins]
+            if opcodes[opc][OPCODE_JUMP_PARM]  and  (parm < 0  or  parm >= self.instructionCount):
+                raise VmError("%s at 0x%x jumps to invalid instruction 0x%x" % (opcodes[opc][OPCODE_NAME], ins, parm))
+            self.program.append((dispatch[opc], parm))
+
+    # VM_BlockCopy()
+    def block_copy (self, dest, src, length):
+        self.check_range(dest, length)
+        self.check_range(src, length)
+        self.image[dest : dest + length] = self.image[src : src + length]
+
+    def check_range (self, addr, length):
+        if length < 0  or  (addr & self.dataMask) != addr  or  ((addr + length) & self.dataMask) != addr + length:
+            raise VmError("memory access out of range: 0x%x 0x%x" % (addr, length))
+
+    def read_int (self, addr):
+        return INT32.unpack_from(self.image, addr & self.dataMask)[0]
+
+    def write_int (self, addr, value):
+        INT32.pack_into(self.image, addr & self.dataMask, to_int32(value))
+
+    def read_float (self, addr):
+        return int_bits_to_float(self.read_int(addr))
+
+    def write_float (self, addr, value):
+        self.write_int(addr, float_to_int_bits(value))
+
+    # zero terminated string, returned as a native str
+    def read_string (self, addr, maxLength=0x10000):
+        image = self.image
+        mask = self.dataMask
+        start = addr & mask
+        end = min(start + maxLength, mask + 1)
+        nul = image.find(b"\0", start, end)
+        if nul != -1:
+            chars = image[start : nul]
+        elif end - start == maxLength:
+            chars = image[start : end]
+        else:
+            # runs past the end of the image and wraps around
+            chars = bytearray()
+            for i in range(maxLength):
+                c = image[(start + i) & mask]
+                if c == 0:
+                    break
+                chars.append(c)
+        if str is bytes:
+            return str(chars)
+        return chars.decode("latin-1")
+
+    def write_string (self, addr, s, size):
+        if not isinstance(s, bytes):
+            s = s.encode("latin-1")
+        s = s[: size - 1]
+        self.check_range(addr, len(s) + 1)
+        self.image[addr : addr + len(s)] = s
+        self.image[addr + len(s)] = 0
+
+    def vm_main (self, *args):
+        return self.call(0, *args)
+
+    # Calls the function at instruction addr and returns its result.  Can
+    # also be used by system call handlers.  Same as VM_CallInterpreted().
+    def call (self, addr, *args):
+        if len(args) > MAX_VMMAIN_ARGS:
+            raise VmError("too many arguments: %d" % len(args))
+        if addr < 0  or  addr >= self.instructionCount:
+            raise VmError("invalid function address 0x%x" % addr)
+
+        stackOnEntry = self.programStack
+        programStack = stackOnEntry - (8 + 4 * MAX_VMMAIN_ARGS)
+        for i in range(len(args)):
+            self.write_int(programStack + 8 + 4 * i, args[i])
+        self.write_int(programStack + 4, 0)
+
+        try:
+            return self.run_function(addr, programStack)
+        finally:
+            self.programStack = stackOnEntry
+
+    # Runs the function at addr until it returns.  programStack is the
+    # caller's stack with the arguments already stored.
+    def run_function (self, addr, programStack):
+        saved = (self.opStack, self.sp, self.pc, self.programStack)
+
+        # return address
+        self.write_int(programStack, -1)
+        self.programStack = programStack
+        self.opStack = array.array('i', [0] * 256)
+        self.sp = 0
+        self.pc = addr
+        try:
+            self.run()
+            if self.sp != 1:
+                raise VmError("opStack offset %d after return" % self.sp)
+            result = self.opStack[1]
+        finally:
+            (self.opStack, self.sp, self.pc, self.programStack) = saved
+
+        return result
+
+    def run (self):
+        program = self.program
+        while self.pc != -1:
+            pc = self.pc
+            self.pc = pc + 1
+            (handler, parm) = program[pc]
+            handler(parm)
+
+    def jump_to (self, target):
+        if target < 0  or  target >= self.instructionCount:
+            raise VmError("jump to invalid instruction 0x%x" % target)
+        self.pc = target
+
+    def syscall (self, num):
+        if num not in self.syscalls.handlers:
+            raise VmError("unhandled system call %s" % self.syscalls.name(num))
+        args = list(SYSCALL_ARGS.unpack_from(self.image, (self.programStack + 4) & self.dataMask))
+        return self.syscalls.handlers[num](self, args)
+
+    # the opcode handlers below follow OPCODE_C_CODE, r0 is the top of the
+    # opStack and r1 the value below it
+
+    def op_undef (self, parm):
+        raise VmError("undefined opcode at 0x%x" % (self.pc - 1))
+
+    def op_ignore (self, parm):
+        pass
+
+    def op_break (self, parm):
+        pass
+
+    def op_enter (self, parm):
+        self.programStack -= parm
+        if self.programStack <= self.stackBottom:
+            raise VmError("program stack overflow")
+
+    def op_leave (self, parm):
+        self.programStack += parm
+        # -1 returns from call()
+        self.pc = self.read_int(self.programStack)
+
+    def op_call (self, parm):
+        target = self.opStack[self.sp]
+        self.sp = (self.sp - 1) & 0xff
+        self.write_int(self.programStack, self.pc)
+        if target < 0:
+            # q3 passes the system call index as the first argument
+            self.write_int(self.programStack + 4, -1 - target)
+            r = self.syscall(target)
+            self.sp = (self.sp + 1) & 0xff
+            self.opStack[self.sp] = to_int32(r)
+            self.pc = self.read_int(self.programStack)
+        else:
+            self.jump_to(target)
+
+    def op_push (self, parm):
+        self.sp = (self.sp + 1) & 0xff
+        self.opStack[self.sp] = 0
+
+    def op_pop (self, parm):
+        self.sp = (self.sp - 1) & 0xff
+
+    def op_const (self, parm):
+        self.sp = (self.sp + 1) & 0xff
+        self.opStack[self.sp] = parm
+
+    def op_local (self, parm):
+        self.sp = (self.sp + 1) & 0xff
+        self.opStack[self.sp] = to_int32(parm + self.programStack)
+
+    def op_jump (self, parm):
+        target = self.opStack[self.sp]
+        self.sp = (self.sp - 1) & 0xff
+        self.jump_to(target)
+
+    # returns (r1, r0) and removes them from the opStack
+    def pop2 (self):
+        sp = self.sp
+        self.sp = (sp - 2) & 0xff
+        return (self.opStack[(sp - 1) & 0xff], self.opStack[sp])
+
+    def pop2_unsigned (self):
+        (r1, r0) = self.pop2()
+        return (r1 & 0xffffffff, r0 & 0xffffffff)
+
+    def pop2_float (self):
+        (r1, r0) = self.pop2()
+        return (int_bits_to_float(r1), int_bits_to_float(r0))
+
+    def op_eq (self, parm):
+        (r1, r0) = self.pop2()
+        if r1 == r0:
+            self.pc = parm
+
+    def op_ne (self, parm):
+        (r1, r0) = self.pop2()
+        if r1 != r0:
+            self.pc = parm
+
+    def op_lti (self, parm):
+        (r1, r0) = self.pop2()
+        if r1 < r0:
+            self.pc = parm
+
+    def op_lei (self, parm):
+        (r1, r0) = self.pop2()
+        if r1 <= r0:
+            self.pc = parm
+
+    def op_gti (self, parm):
+        (r1, r0) = self.pop2()
+        if r1 > r0:
+            self.pc = parm
+
+    def op_gei (self, parm):
+        (r1, r0) = self.pop2()
+        if r1 >= r0:
+            self.pc = parm
+
+    def op_ltu (self, parm):
+        (r1, r0) = self.pop2_unsigned()
+        if r1 < r0:
+            self.pc = parm
+
+    def op_leu (self, parm):
+        (r1, r0) = self.pop2_unsigned()
+        if r1 <= r0:
+            self.pc = parm
+
+    def op_gtu (self, parm):
+        (r1, r0) = self.pop2_unsigned()
+        if r1 > r0:
+            self.pc = parm
+
+    def op_geu (self, parm):
+        (r1, r0) = self.pop2_unsigned()
+        if r1 >= r0:
+            self.pc = parm
+
+    def op_eqf (self, parm):
+        (f1, f0) = self.pop2_float()
+        if f1 == f0:
+            self.pc = parm
+
+    def op_nef (self, parm):
+        (f1, f0) = self.pop2_float()
+        if f1 != f0:
+            self.pc = parm
+
+    def op_ltf (self, parm):
+        (f1, f0) = self.pop2_float()
+        if f1 < f0:
+            self.pc = parm
+
+    def op_lef (self, parm):
+        (f1, f0) = self.pop2_float()
+        if f1 <= f0:
+            self.pc = parm
+
+    def op_gtf (self, parm):
+        (f1, f0) = self.pop2_float()
+        if f1 > f0:
+            self.pc = parm
+
+    def op_gef (self, parm):
+        (f1, f0) = self.pop2_float()
+        if f1 >= f0:
+            self.pc = parm
+
+    def op_load1 (self, parm):
+        self.opStack[self.sp] = self.image[self.opStack[self.sp] & self.dataMask]
+
+    def op_load2 (self, parm):
+        self.opStack[self.sp] = UINT16.unpack_from(self.image, self.opStack[self.sp] & self.dataMask)[0]
+
+    def op_load4 (self, parm):
+        self.opStack[self.sp] = INT32.unpack_from(self.image, self.opStack[self.sp] & self.dataMask)[0]
+
+    def op_store1 (self, parm):
+        (r1, r0) = self.pop2()
+        self.image[r1 & self.dataMask] = r0 & 0xff
+
+    def op_store2 (self, parm):
+        (r1, r0) = self.pop2()
+        UINT16.pack_into(self.image, r1 & self.dataMask, r0 & 0xffff)
+
+    def op_store4 (self, parm):
+        (r1, r0) = self.pop2()
+        INT32.pack_into(self.image, r1 & self.dataMask, r0)
+
+    def op_arg (self, parm):
+        INT32.pack_into(self.image, (parm + self.programStack) & self.dataMask, self.opStack[self.sp])
+        self.sp = (self.sp - 1) & 0xff
+
+    def op_block_copy (self, parm):
+        (dest, src) = self.pop2_unsigned()
+        self.block_copy(dest, src, parm)
+
+    def op_sex8 (self, parm):
+        v = self.opStack[self.sp] & 0xff
+        if v > 0x7f:
+            v -= 0x100
+        self.opStack[self.sp] = v
+
+    def op_sex16 (self, parm):
+        v = self.opStack[self.sp] & 0xffff
+        if v > 0x7fff:
+            v -= 0x10000
+        self.opStack[self.sp] = v
+
+    def op_negi (self, parm):
+        self.opStack[self.sp] = to_int32(-self.opStack[self.sp])
+
+    # replaces r1 and r0 with the result
+    def push_result (self, v):
+        self.sp = (self.sp + 1) & 0xff
+        self.opStack[self.sp] = v
+
+    def op_add (self, parm):
+        (r1, r0) = self.pop2()
+        self.push_result(to_int32(r1 + r0))
+
+    def op_sub (self, parm):
+        (r1, r0) = self.pop2()
+        self.push_result(to_int32(r1 - r0))
+
+    def op_divi (self, parm):
+        (r1, r0) = self.pop2()
+        self.push_result(to_int32(int_divide(r1, r0)))
+
+    def op_divu (self, parm):
+        (r1, r0) = self.pop2_unsigned()
+        self.push_result(to_int32(int_divide(r1, r0)))
+
+    def op_modi (self, parm):
+        (r1, r0) = self.pop2()
+        self.push_result(to_int32(r1 - r0 * int_divide(r1, r0)))
+
+    def op_modu (self, parm):
+        (r1, r0) = self.pop2_unsigned()
+        if r0 == 0:
+            raise VmError("integer division by zero")
+        self.push_result(to_int32(r1 % r0))
+
+    def op_muli (self, parm):
+        (r1, r0) = self.pop2()
+        self.push_result(to_int32(r1 * r0))
+
+    def op_mulu (self, parm):
+        (r1, r0) = self.pop2()
+        self.push_result(to_int32(r1 * r0))
+
+    def op_band (self, parm):
+        (r1, r0) = self.pop2()
+        self.push_result(r1 & r0)
+
+    def op_bor (self, parm):
+        (r1, r0) = self.pop2()
+        self.push_result(r1 | r0)
+
+    def op_bxor (self, parm):
+        (r1, r0) = self.pop2()
+        self.push_result(r1 ^ r0)
+
+    def op_bcom (self, parm):
+        self.opStack[self.sp] = ~self.opStack[self.sp]
+
+    # shift counts are masked like x86
+    def op_lsh (self, parm):
+        (r1, r0) = self.pop2()
+        self.push_result(to_int32(r1 << (r0 & 31)))
+
+    def op_rshi (self, parm):
+        (r1, r0) = self.pop2()
+        self.push_result(r1 >> (r0 & 31))
+
+    def op_rshu (self, parm):
+        (r1, r0) = self.pop2()
+        self.push_result(to_int32((r1 & 0xffffffff) >> (r0 & 31)))
+
+    def op_negf (self, parm):
+        self.opStack[self.sp] = self.opStack[self.sp] ^ -0x80000000
+
+    def op_addf (self, parm):
+        (f1, f0) = self.pop2_float()
+        self.push_result(float_to_int_bits(f1 + f0))
+
+    def op_subf (self, parm):
+        (f1, f0) = self.pop2_float()
+        self.push_result(float_to_int_bits(f1 - f0))
+
+    def op_divf (self, parm):
+        (f1, f0) = self.pop2_float()
+        self.push_result(float_to_int_bits(float_divide(f1, f0)))
+
+    def op_mulf (self, parm):
+        (f1, f0) = self.pop2_float()
+        self.push_result(float_to_int_bits(f1 * f0))
+
+    def op_cvif (self, parm):
+        self.opStack[self.sp] = float_to_int_bits(float(self.opStack[self.sp]))
+
+    def op_cvfi (self, parm):
+        self.opStack[self.sp] = float_to_int(int_bits_to_float(self.opStack[self.sp]))
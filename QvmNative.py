@@ -0,0 +1,552 @@
+####
+# Copyright (C) 2012, 2020 Angelo Cano
+#
+# This file is part of Qvmdis.
+#
+# Qvmdis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Qvmdis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Qvmdis.  If not, see <https://www.gnu.org/licenses/>.
+####
+
+# translates a whole qvm to C, builds it with the system C compiler, and
+# runs it through ctypes
+#
+# Every function becomes a C function with a label for each basic block.
+# The opStack depth is known at each instruction (see QvmCompiler), so the
+# opStack entries are the local variables s0, s1, ... and the C compiler
+# keeps them in registers.  The C code works on the interpreter's image, so
+# system call handlers written for QvmInterpreter work without changes.
+#
+# The shared object is cached by the contents of the qvm.  Functions that
+# can't be translated are run by the interpreter through a callback, the
+# same way system calls are.
+#
+# The opcodes follow OPCODE_C_CODE except where it relies on undefined
+# behavior in C: shift counts are masked, integer division by zero is an
+# error, and INT_MIN / -1 wraps.  Like QvmInterpreter, load and store
+# addresses are masked with dataMask and block_copy outside the image is an
+# error.
+#
+# The results are the same as QvmInterpreter's except for computed jumps.
+# A jump whose target isn't right after a const can only go to the cases of
+# its switch or to the jump points of its function in the control flow
+# graph.  Other targets stop with "jump to invalid instruction", where the
+# interpreter accepts any instruction of the qvm.
+
+from Qvm import opcodes, OPCODE_NAME, OPCODE_JUMP_PARM, ANALYSIS_VERSION, \
+    OP_UNDEF, OP_IGNORE, OP_BREAK, OP_ENTER, OP_LEAVE, OP_CALL, OP_PUSH, OP_POP, OP_CONST, OP_LOCAL, OP_JUMP, \
+    OP_STORE1, OP_STORE2, OP_STORE4, OP_ARG, OP_BLOCK_COPY
+from QvmInterpreter import QvmInterpreter, VmError, PROGRAM_STACK_SIZE, to_int32
+from QvmCompiler import FunctionCompiler, CompileError
+from AnalysisCache import content_digest, evict_cache_files, new_temp_file, replace_file, atomic_write
+import ctypes, os, subprocess, sys
+
+NATIVE_VERSION = 1
+
+# the C compiler and flags, -fwrapv makes signed overflow wrap like the
+# qvm interpreters
+CCompiler = "cc"
+CFlags = ["-O2", "-shared", "-fPIC", "-fwrapv", "-fno-strict-aliasing"]
+
+# built shared objects are stored here, None uses ~/.cache/qvmdis
+NativeCacheDir = None
+# least recently used libraries and their sources are deleted when the
+# cache is larger
+NativeCacheMaxSize = 256 * 1024 * 1024
+
+if sys.platform == "win32":
+    LIBRARY_EXTENSION = ".dll"
+else:
+    LIBRARY_EXTENSION = ".so"
+
+# error codes returned by qvm_call()
+ERR_CALLBACK = 1
+ERR_STACK_OVERFLOW = 2
+ERR_DIVIDE = 3
+ERR_JUMP = 4
+ERR_CALL = 5
+ERR_MEMORY = 6
+ERR_UNDEF = 7
+
+ERROR_MESSAGES = {
+    ERR_STACK_OVERFLOW : "program stack overflow",
+    ERR_DIVIDE : "integer division by zero",
+    ERR_JUMP : "jump to invalid instruction 0x%x",
+    ERR_CALL : "call to invalid instruction 0x%x",
+    ERR_MEMORY : "memory access out of range: 0x%x",
+    ERR_UNDEF : "undefined opcode at 0x%x",
+    }
+
+class NativeBuildError(Exception):
+    pass
+
+# (num or addr, programStack, result pointer) returns 1 if an exception was
+# raised
+CALLBACK_TYPE = ctypes.CFUNCTYPE(ctypes.c_int32, ctypes.c_int32, ctypes.c_int32, ctypes.POINTER(ctypes.c_int32))
+
+# same layout as vm_t in the C code
+class VmState (ctypes.Structure):
+    _fields_ = [
+        ("image", ctypes.c_void_p),
+        ("dataMask", ctypes.c_int32),
+        ("stackBottom", ctypes.c_int32),
+        ("syscall", CALLBACK_TYPE),
+        ("interpret", CALLBACK_TYPE),
+        ("errorCode", ctypes.c_int32),
+        ("errorValue", ctypes.c_int32),
+        ("errorJump", ctypes.c_void_p),
+        ]
+
+C_PROLOGUE = """\
+#include <stdint.h>
+#include <string.h>
+#include <setjmp.h>
+
+typedef int32_t (*qvm_callback_t)(int32_t, int32_t, int32_t *);
+
+typedef struct {
+    uint8_t *image;
+    int32_t dataMask;
+    int32_t stackBottom;
+    qvm_callback_t syscall;
+    qvm_callback_t interpret;
+    int32_t errorCode;
+    int32_t errorValue;
+    jmp_buf *errorJump;
+} vm_t;
+
+static void vm_error (vm_t *vm, int32_t code, int32_t value)
+{
+    vm->errorCode = code;
+    vm->errorValue = value;
+    longjmp(*vm->errorJump, 1);
+}
+
+#define LD1(a) (image[(a) & M])
+#define LD2(a) ld2(image + ((a) & M))
+#define LD4(a) ld4(image + ((a) & M))
+#define ST1(a, v) (image[(a) & M] = (uint8_t) (v))
+#define ST2(a, v) st2(image + ((a) & M), (v))
+#define ST4(a, v) st4(image + ((a) & M), (v))
+
+static inline int32_t ld2 (const uint8_t *p) { uint16_t v; memcpy(&v, p, 2); return v; }
+static inline int32_t ld4 (const uint8_t *p) { int32_t v; memcpy(&v, p, 4); return v; }
+static inline void st2 (uint8_t *p, int32_t v) { uint16_t u = (uint16_t) v; memcpy(p, &u, 2); }
+static inline void st4 (uint8_t *p, int32_t v) { memcpy(p, &v, 4); }
+
+static inline float F (int32_t i) { float f; memcpy(&f, &i, 4); return f; }
+static inline int32_t I (float f) { int32_t i; memcpy(&i, &f, 4); return i; }
+
+/* Q_ftol(), out of range values give 0x80000000 like x86 */
+static inline int32_t ftoi (float f)
+{
+    if (f != f  ||  f >= 2147483648.0f  ||  f < -2147483648.0f) {
+        return INT32_MIN;
+    }
+    return (int32_t) f;
+}
+
+static inline int32_t divi (vm_t *vm, int32_t a, int32_t b)
+{
+    if (b == 0) vm_error(vm, %(ERR_DIVIDE)d, 0);
+    if (b == -1) return (int32_t) (0u - (uint32_t) a);
+    return a / b;
+}
+
+static inline int32_t modi (vm_t *vm, int32_t a, int32_t b)
+{
+    if (b == 0) vm_error(vm, %(ERR_DIVIDE)d, 0);
+    if (b == -1) return 0;
+    return a %% b;
+}
+
+static inline int32_t divu (vm_t *vm, uint32_t a, uint32_t b)
+{
+    if (b == 0) vm_error(vm, %(ERR_DIVIDE)d, 0);
+    return (int32_t) (a / b);
+}
+
+static inline int32_t modu (vm_t *vm, uint32_t a, uint32_t b)
+{
+    if (b == 0) vm_error(vm, %(ERR_DIVIDE)d, 0);
+    return (int32_t) (a %% b);
+}
+
+/* VM_BlockCopy() */
+static void block_copy (vm_t *vm, uint32_t dest, uint32_t src, int32_t n)
+{
+    uint32_t M = (uint32_t) vm->dataMask;
+    if ((dest & M) != dest  ||  ((dest + n) & M) != dest + n) vm_error(vm, %(ERR_MEMORY)d, (int32_t) dest);
+    if ((src & M) != src  ||  ((src + n) & M) != src + n) vm_error(vm, %(ERR_MEMORY)d, (int32_t) src);
+    memmove(vm->image + dest, vm->image + src, n);
+}
+
+static int32_t vm_syscall (vm_t *vm, int32_t num, int32_t ps)
+{
+    uint8_t *image = vm->image;
+    int32_t M = vm->dataMask;
+    int32_t r;
+
+    /* q3 passes the system call index as the first argument */
+    ST4(ps + 4, -1 - num);
+    if (vm->syscall(num, ps, &r)) vm_error(vm, %(ERR_CALLBACK)d, num);
+    return r;
+}
+
+static int32_t vm_call (vm_t *vm, int32_t addr, int32_t ps);
+"""
+
+C_EPILOGUE = """
+/* returns 0 or an error code */
+int32_t qvm_call (vm_t *vm, int32_t addr, int32_t ps, int32_t *result)
+{
+    jmp_buf jump;
+    jmp_buf *saved = vm->errorJump;
+
+    vm->errorJump = &jump;
+    if (setjmp(jump)) {
+        vm->errorJump = saved;
+        return vm->errorCode;
+    }
+    *result = vm_call(vm, addr, ps);
+    vm->errorJump = saved;
+    return 0;
+}
+"""
+
+def c_int (v):
+    if v == -0x80000000:
+        return "INT32_MIN"
+    return "%d" % v
+
+# C expression for NIS (a) and TOS (b)
+BINARY_C_EXPRESSIONS = {
+    "add" : "%(a)s + %(b)s",
+    "sub" : "%(a)s - %(b)s",
+    "muli" : "%(a)s * %(b)s",
+    "mulu" : "%(a)s * %(b)s",
+    "divi" : "divi(vm, %(a)s, %(b)s)",
+    "divu" : "divu(vm, %(a)s, %(b)s)",
+    "modi" : "modi(vm, %(a)s, %(b)s)",
+    "modu" : "modu(vm, %(a)s, %(b)s)",
+    "band" : "%(a)s & %(b)s",
+    "bor" : "%(a)s | %(b)s",
+    "bxor" : "%(a)s ^ %(b)s",
+    "lsh" : "(int32_t) ((uint32_t) %(a)s << (%(b)s & 31))",
+    "rshi" : "%(a)s >> (%(b)s & 31)",
+    "rshu" : "(int32_t) ((uint32_t) %(a)s >> (%(b)s & 31))",
+    "addf" : "I(F(%(a)s) + F(%(b)s))",
+    "subf" : "I(F(%(a)s) - F(%(b)s))",
+    "mulf" : "I(F(%(a)s) * F(%(b)s))",
+    "divf" : "I(F(%(a)s) / F(%(b)s))",
+    }
+
+BRANCH_C_CONDITIONS = {
+    "eq" : "%(a)s == %(b)s",
+    "ne" : "%(a)s != %(b)s",
+    "lti" : "%(a)s < %(b)s",
+    "lei" : "%(a)s <= %(b)s",
+    "gti" : "%(a)s > %(b)s",
+    "gei" : "%(a)s >= %(b)s",
+    "ltu" : "(uint32_t) %(a)s < (uint32_t) %(b)s",
+    "leu" : "(uint32_t) %(a)s <= (uint32_t) %(b)s",
+    "gtu" : "(uint32_t) %(a)s > (uint32_t) %(b)s",
+    "geu" : "(uint32_t) %(a)s >= (uint32_t) %(b)s",
+    "eqf" : "F(%(a)s) == F(%(b)s)",
+    "nef" : "F(%(a)s) != F(%(b)s)",
+    "ltf" : "F(%(a)s) < F(%(b)s)",
+    "lef" : "F(%(a)s) <= F(%(b)s)",
+    "gtf" : "F(%(a)s) > F(%(b)s)",
+    "gef" : "F(%(a)s) >= F(%(b)s)",
+    }
+
+UNARY_C_EXPRESSIONS = {
+    "sex8" : "(int8_t) %(a)s",
+    "sex16" : "(int16_t) %(a)s",
+    "negi" : "-%(a)s",
+    "bcom" : "~%(a)s",
+    "negf" : "%(a)s ^ INT32_MIN",
+    "cvif" : "I((float) %(a)s)",
+    "cvfi" : "ftoi(F(%(a)s))",
+    "load1" : "LD1(%(a)s)",
+    "load2" : "LD2(%(a)s)",
+    "load4" : "LD4(%(a)s)",
+    }
+
+class CTranslator:
+    def __init__ (self, qvm):
+        self.qvm = qvm
+        self.starts = sorted(qvm.functionHashes.keys())
+        self.compiled = set()  # function start addresses translated to C
+        self.translateErrors = {}  # addr:int -> msg:str
+
+    def function_end (self, n):
+        if n + 1 < len(self.starts):
+            return self.starts[n + 1]
+        return self.qvm.instructionCount
+
+    # returns the C source for the whole qvm
+    def translate (self):
+        functions = []
+        for n in range(len(self.starts)):
+            addr = self.starts[n]
+            try:
+                compiler = FunctionCompiler(self.qvm, addr, self.function_end(n))
+                depths = compiler.block_depths()
+            except CompileError as ex:
+                self.translateErrors[addr] = str(ex)
+                continue
+            self.compiled.add(addr)
+            functions.append((compiler, depths))
+
+        out = [C_PROLOGUE % globals()]
+        for (compiler, depths) in functions:
+            out.append("static int32_t f_%x (vm_t *vm, int32_t ps);\n" % compiler.start)
+        for (compiler, depths) in functions:
+            out.append(self.translate_function(compiler, depths))
+        out.append(self.translate_dispatch())
+        out.append(C_EPILOGUE)
+        return "".join(out)
+
+    # call with an address computed at run time
+    def translate_dispatch (self):
+        lines = ["", "static int32_t vm_call (vm_t *vm, int32_t addr, int32_t ps)", "{", "    int32_t r;", "", "    switch (addr) {"]
+        for addr in sorted(self.compiled):
+            lines.append("    case %d: return f_%x(vm, ps);" % (addr, addr))
+        lines.append("    }")
+        lines.append("    if (addr < 0) return vm_syscall(vm, addr, ps);")
+        lines.append("    if (addr >= %d) vm_error(vm, %d, addr);" % (self.qvm.instructionCount, ERR_CALL))
+        lines.append("    if (vm->interpret(addr, ps, &r)) vm_error(vm, %d, addr);" % ERR_CALLBACK)
+        lines.append("    return r;")
+        lines.append("}")
+        return "\n".join(lines) + "\n"
+
+    def translate_function (self, compiler, depths):
+        start = compiler.start
+        body = []
+        maxDepth = 1
+        for n in range(len(compiler.blockStarts)):
+            if depths[n] == None:
+                continue
+            maxDepth = max(maxDepth, self.translate_block(compiler, n, depths[n], body))
+
+        lines = ["", "static int32_t f_%x (vm_t *vm, int32_t ps)" % start, "{"]
+        lines.append("    uint8_t *image = vm->image;")
+        lines.append("    int32_t M = vm->dataMask;")
+        lines.append("    int32_t %s;" % ", ".join("s%d" % i for i in range(maxDepth)))
+        lines.append("")
+        lines.append("    ps -= %d;" % compiler.parm(start))
+        lines.append("    if (ps <= vm->stackBottom) vm_error(vm, %d, ps);" % ERR_STACK_OVERFLOW)
+        lines.extend(body)
+        lines.append("}")
+        return "\n".join(lines) + "\n"
+
+    # appends to lines and returns the largest opStack depth
+    def translate_block (self, compiler, n, depth, lines):
+        qvm = self.qvm
+        lines.append("L%d:  /* 0x%x */" % (n, compiler.blockStarts[n]))
+        maxDepth = depth
+        prevConst = None
+        for ins in range(compiler.blockStarts[n], compiler.block_end(n)):
+            opc = compiler.op(ins)
+            parm = compiler.parm(ins)
+            name = opcodes[opc][OPCODE_NAME]
+            v = { "a" : "s%d" % (depth - 2), "b" : "s%d" % (depth - 1) }
+            tos = "s%d" % (depth - 1)
+            nis = "s%d" % (depth - 2)
+            push = "s%d" % depth
+
+            if opc in (OP_ENTER, OP_IGNORE, OP_BREAK):
+                pass
+            elif opc == OP_UNDEF:
+                lines.append("    vm_error(vm, %d, %d);" % (ERR_UNDEF, ins))
+            elif opc == OP_CONST:
+                lines.append("    %s = %s;" % (push, c_int(parm)))
+                depth += 1
+            elif opc == OP_LOCAL:
+                lines.append("    %s = ps + %s;" % (push, c_int(parm)))
+                depth += 1
+            elif opc == OP_PUSH:
+                lines.append("    %s = 0;" % push)
+                depth += 1
+            elif opc == OP_POP:
+                depth -= 1
+            elif name in UNARY_C_EXPRESSIONS:
+                lines.append("    %s = %s;" % (tos, UNARY_C_EXPRESSIONS[name] % { "a" : tos }))
+            elif name in BINARY_C_EXPRESSIONS:
+                lines.append("    %s = %s;" % (nis, BINARY_C_EXPRESSIONS[name] % v))
+                depth -= 1
+            elif opc == OP_STORE1:
+                lines.append("    ST1(%s, %s);" % (nis, tos))
+                depth -= 2
+            elif opc == OP_STORE2:
+                lines.append("    ST2(%s, %s);" % (nis, tos))
+                depth -= 2
+            elif opc == OP_STORE4:
+                lines.append("    ST4(%s, %s);" % (nis, tos))
+                depth -= 2
+            elif opc == OP_ARG:
+                lines.append("    ST4(ps + %s, %s);" % (c_int(parm), tos))
+                depth -= 1
+            elif opc == OP_BLOCK_COPY:
+                lines.append("    block_copy(vm, %s, %s, %s);" % (nis, tos, c_int(parm)))
+                depth -= 2
+            elif opc == OP_CALL:
+                if prevConst != None  and  prevConst < 0:
+                    lines.append("    %s = vm_syscall(vm, %d, ps);" % (tos, prevConst))
+                elif prevConst != None  and  prevConst in self.compiled:
+                    lines.append("    %s = f_%x(vm, ps);" % (tos, prevConst))
+                else:
+                    lines.append("    %s = vm_call(vm, %s, ps);" % (tos, tos))
+            elif opcodes[opc][OPCODE_JUMP_PARM]:
+                lines.append("    if (%s) goto L%d;" % (BRANCH_C_CONDITIONS[name] % v, compiler.blockNums[parm]))
+                depth -= 2
+            elif opc == OP_JUMP:
+                if prevConst != None:
+                    lines.append("    goto L%d;" % compiler.blockNums[prevConst])
+                else:
+                    lines.append("    switch (%s) {" % tos)
+                    for b in compiler.computed_jump_blocks(ins):
+                        lines.append("    case %d: goto L%d;" % (compiler.blockStarts[b], b))
+                    lines.append("    }")
+                    lines.append("    vm_error(vm, %d, %s);" % (ERR_JUMP, tos))
+                depth -= 1
+            elif opc == OP_LEAVE:
+                lines.append("    return %s;" % tos)
+            else:
+                raise CompileError("can't translate %s at 0x%x" % (name, ins))
+
+            maxDepth = max(maxDepth, depth)
+            if opc == OP_CONST:
+                prevConst = parm
+            else:
+                prevConst = None
+
+        return maxDepth
+
+def native_cache_key (qvm):
+    header = ("qvm native %d %d %s %s\n" % (NATIVE_VERSION, ANALYSIS_VERSION, CCompiler, " ".join(CFlags))).encode("utf-8")
+    # VER2 jump table targets are jump points, they change the blocks
+    return content_digest([header, qvm.codeData, qvm.dataData, qvm.litData, qvm.jumpTableData])
+
+def native_cache_dir ():
+    if NativeCacheDir != None:
+        return NativeCacheDir
+    return os.path.join(os.path.expanduser("~"), ".cache", "qvmdis")
+
+# returns the file name of the shared object for the qvm, building it if
+# it isn't in the cache
+def build_native_library (qvm):
+    cacheDir = native_cache_dir()
+    key = native_cache_key(qvm)
+    libName = os.path.join(cacheDir, "qvm-" + key + LIBRARY_EXTENSION)
+    if os.path.exists(libName):
+        # least recently used libraries are evicted first
+        try:
+            os.utime(libName, None)
+        except OSError:
+            pass
+        return libName
+
+    if not os.path.isdir(cacheDir):
+        os.makedirs(cacheDir)
+
+    source = CTranslator(qvm).translate()
+    # the source is kept next to the library for debugging, the compiler
+    # never reads a partial one
+    sourceName = os.path.join(cacheDir, "qvm-" + key + ".c")
+    atomic_write(sourceName, source.encode("utf-8"))
+
+    # build to a temporary file first so other processes never load a
+    # partial library
+    (fd, tmpName) = new_temp_file(libName)
+    os.close(fd)
+    cmd = [CCompiler] + CFlags + ["-o", tmpName, sourceName]
+    try:
+        try:
+            p = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        except OSError as ex:
+            raise NativeBuildError("couldn't run %s: %s" % (CCompiler, ex))
+        (pout, perr) = p.communicate()
+        if p.returncode != 0:
+            raise NativeBuildError("%s failed for %s:\n%s" % (CCompiler, sourceName, perr.decode("utf-8", "replace")))
+    except BaseException:
+        try:
+            os.remove(tmpName)
+        except OSError:
+            pass
+        raise
+    replace_file(tmpName, libName, 0o777)
+
+    evict_cache_files(cacheDir, "qvm-", (LIBRARY_EXTENSION, ".c"), NativeCacheMaxSize, libName)
+
+    return libName
+
+# QvmInterpreter that runs the qvm translated to C
+class QvmNativeInterpreter (QvmInterpreter):
+    def __init__ (self, qvm, syscalls=None, stackSize=PROGRAM_STACK_SIZE):
+        QvmInterpreter.__init__(self, qvm, syscalls, stackSize)
+
+        self.library = ctypes.CDLL(os.path.abspath(build_native_library(qvm)))
+        self.library.qvm_call.restype = ctypes.c_int32
+        self.library.qvm_call.argtypes = [ctypes.POINTER(VmState), ctypes.c_int32, ctypes.c_int32, ctypes.POINTER(ctypes.c_int32)]
+
+        # exception raised inside a callback, raised again once the C code
+        # returns
+        self.callbackError = None
+
+        # references need to be kept while the C code can use them
+        self.imageBuffer = (ctypes.c_char * len(self.image)).from_buffer(self.image)
+        self.syscallCallback = CALLBACK_TYPE(self.syscall_callback)
+        self.interpretCallback = CALLBACK_TYPE(self.interpret_callback)
+
+        self.state = VmState()
+        self.state.image = ctypes.addressof(self.imageBuffer)
+        self.state.dataMask = self.dataMask
+        self.state.stackBottom = self.stackBottom
+        self.state.syscall = self.syscallCallback
+        self.state.interpret = self.interpretCallback
+
+    def syscall_callback (self, num, programStack, result):
+        saved = self.programStack
+        self.programStack = programStack
+        try:
+            result[0] = to_int32(self.syscall(num))
+        except BaseException as ex:
+            self.callbackError = ex
+            return 1
+        finally:
+            self.programStack = saved
+        return 0
+
+    # functions that weren't translated
+    def interpret_callback (self, addr, programStack, result):
+        try:
+            result[0] = QvmInterpreter.run_function(self, addr, programStack)
+        except BaseException as ex:
+            self.callbackError = ex
+            return 1
+        return 0
+
+    def run_function (self, addr, programStack):
+        result = ctypes.c_int32(0)
+        err = self.library.qvm_call(ctypes.byref(self.state), addr, programStack, ctypes.byref(result))
+        if err == ERR_CALLBACK:
+            ex = self.callbackError
+            self.callbackError = None
+            raise ex
+        if err != 0:
+            msg = ERROR_MESSAGES.get(err, "error %d" % err)
+            if "%" in msg:
+                msg = msg % (self.state.errorValue & 0xffffffff)
+            raise VmError(msg)
+        return result.value
@@ -0,0 +1,202 @@
+####
+# Copyright (C) 2012, 2020 Angelo Cano
+#
+# This file is part of Qvmdis.
+#
+# Qvmdis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Qvmdis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Qvmdis.  If not, see <https://www.gnu.org/licenses/>.
+####
+
+# counts executed qvm instructions
+#
+# Every instruction has a counter in a list indexed by instruction number,
+# the opcode histogram and the exclusive count of each function are sums
+# over it.  The call stack is only looked at by 'enter' and 'leave':  the
+# instructions run since the last one are added to the current stack, which
+# gives the collapsed stacks for flame graphs, and a function's inclusive
+# count is added when its outermost call returns.
+
+from Qvm import opcodes, OPCODE_NAME
+from QvmInterpreter import QvmInterpreter, PROGRAM_STACK_SIZE
+import bisect
+
+class QvmProfilingInterpreter(QvmInterpreter):
+    def __init__ (self, qvm, syscalls=None, stackSize=PROGRAM_STACK_SIZE):
+        QvmInterpreter.__init__(self, qvm, syscalls, stackSize)
+        self.functionStarts = sorted(qvm.functionHashes.keys())
+        self.reset_profile()
+
+        # run() counts in a local and only stores it in self.executed before
+        # the handlers that need it:  'enter' and 'leave' record it and
+        # 'call' can run nested code from a system call
+        syncHandlers = (self.op_enter, self.op_leave, self.op_call)
+        self.profileProgram = [(handler, parm, handler in syncHandlers) for (handler, parm) in self.program]
+
+    def reset_profile (self):
+        self.insCounts = [0] * self.instructionCount
+        self.executed = 0
+        self.syscallCounts = {}  # num:int -> calls:int
+        self.callCounts = {}  # funcAddr:int -> calls:int
+        self.inclusiveCounts = {}  # funcAddr:int -> instructions:int
+        self.stackCounts = {}  # (outerFuncAddr:int, ..., funcAddr:int) -> instructions:int
+
+        self.frames = []  # [ [funcAddr:int, executedOnEntry:int], ... ]
+        self.stackKey = ()
+        self.activeCalls = {}  # funcAddr:int -> calls on the stack:int
+        self.lastFlush = 0
+
+    def run (self):
+        program = self.profileProgram
+        counts = self.insCounts
+        executed = self.executed
+        try:
+            while self.pc != -1:
+                pc = self.pc
+                self.pc = pc + 1
+                counts[pc] += 1
+                executed += 1
+                (handler, parm, sync) = program[pc]
+                if sync:
+                    self.executed = executed
+                    handler(parm)
+                    executed = self.executed
+                else:
+                    handler(parm)
+        finally:
+            # a nested run may have counted past the local one if it raised
+            if executed > self.executed:
+                self.executed = executed
+
+    def run_function (self, addr, programStack):
+        (depth, stackKey) = (len(self.frames), self.stackKey)
+        try:
+            return QvmInterpreter.run_function(self, addr, programStack)
+        finally:
+            # left by errors
+            for (func, executedOnEntry) in self.frames[depth:]:
+                self.activeCalls[func] -= 1
+            del self.frames[depth:]
+            self.stackKey = stackKey
+
+    def syscall (self, num):
+        self.syscallCounts[num] = self.syscallCounts.get(num, 0) + 1
+        return QvmInterpreter.syscall(self, num)
+
+    def flush_stack_count (self, executed):
+        n = executed - self.lastFlush
+        if n > 0:
+            self.stackCounts[self.stackKey] = self.stackCounts.get(self.stackKey, 0) + n
+        self.lastFlush = executed
+
+    def op_enter (self, parm):
+        QvmInterpreter.op_enter(self, parm)
+        func = self.pc - 1
+        # the 'enter' belongs to the new function
+        executed = self.executed - 1
+        self.flush_stack_count(executed)
+        self.frames.append([func, executed])
+        self.stackKey = self.stackKey + (func,)
+        self.callCounts[func] = self.callCounts.get(func, 0) + 1
+        self.activeCalls[func] = self.activeCalls.get(func, 0) + 1
+
+    def op_leave (self, parm):
+        self.flush_stack_count(self.executed)
+        QvmInterpreter.op_leave(self, parm)
+        if len(self.frames) == 0:
+            return
+        (func, executedOnEntry) = self.frames.pop()
+        self.stackKey = self.stackKey[:-1]
+        # recursive calls are already part of the outermost one
+        self.activeCalls[func] -= 1
+        if self.activeCalls[func] == 0:
+            self.inclusiveCounts[func] = self.inclusiveCounts.get(func, 0) + self.executed - executedOnEntry
+
+    # returns funcAddr:int of the function containing instruction ins
+    def function_at (self, ins):
+        i = bisect.bisect_right(self.functionStarts, ins) - 1
+        if i < 0:
+            return 0
+        return self.functionStarts[i]
+
+    # returns { funcAddr:int -> [calls:int, exclusive:int, inclusive:int] }
+    def function_counts (self):
+        result = {}
+        starts = self.functionStarts
+        for i in range(len(starts)):
+            if i + 1 < len(starts):
+                end = starts[i + 1]
+            else:
+                end = self.instructionCount
+            exclusive = sum(self.insCounts[starts[i] : end])
+            calls = self.callCounts.get(starts[i], 0)
+            if exclusive == 0  and  calls == 0:
+                continue
+            result[starts[i]] = [calls, exclusive, self.inclusiveCounts.get(starts[i], exclusive)]
+        return result
+
+    # returns { opcodeName:str -> count:int }
+    def opcode_counts (self):
+        totals = [0] * len(opcodes)
+        ops = self.qvm.insOpcodes
+        counts = self.insCounts
+        for ins in range(self.instructionCount):
+            if counts[ins] != 0:
+                totals[ops[ins]] += counts[ins]
+        result = {}
+        for opc in range(len(opcodes)):
+            if totals[opc] != 0:
+                result[opcodes[opc][OPCODE_NAME]] = totals[opc]
+        return result
+
+    def function_name (self, addr):
+        q = self.qvm
+        if addr in q.functions:
+            return q.functions[addr]
+        if addr in q.functionHashes  and  q.functionHashes[addr] in q.baseQ3FunctionRevHashes:
+            return "?" + q.baseQ3FunctionRevHashes[q.functionHashes[addr]][0]
+        return "0x%x" % addr
+
+    # one line per call stack, "vmMain;CG_DrawActiveFrame;CG_Draw2D 1234", as
+    # read by flamegraph.pl and speedscope
+    def write_collapsed_stacks (self, out):
+        lines = []
+        for key in self.stackCounts:
+            if len(key) == 0:
+                continue
+            lines.append("%s %d\n" % (";".join([self.function_name(addr) for addr in key]), self.stackCounts[key]))
+        for line in sorted(lines):
+            out.write(line)
+
+    def write_report (self, out, top=20):
+        out.write("%d instructions executed\n\n" % self.executed)
+
+        functionCounts = self.function_counts()
+        out.write("%-40s %10s %14s %14s\n" % ("function", "calls", "exclusive", "inclusive"))
+        addrs = sorted(functionCounts.keys(), key=lambda addr: (-functionCounts[addr][1], addr))
+        for addr in addrs[:top]:
+            (calls, exclusive, inclusive) = functionCounts[addr]
+            out.write("%-40s %10d %14d %14d\n" % (self.function_name(addr), calls, exclusive, inclusive))
+
+        opcodeCounts = self.opcode_counts()
+        out.write("\n%-40s %10s\n" % ("opcode", "count"))
+        for name in sorted(opcodeCounts.keys(), key=lambda n: (-opcodeCounts[n], n)):
+            out.write("%-40s %10d\n" % (name, opcodeCounts[name]))
+
+        if len(self.syscallCounts) > 0:
+            out.write("\n%-40s %10s\n" % ("system call", "calls"))
+            for num in sorted(self.syscallCounts.keys(), key=lambda n: (-self.syscallCounts[n], -n)):
+                out.write("%-40s %10d\n" % (self.syscalls.name(num), self.syscallCounts[num]))
+
+    # counts are printed in the qvm's code disassembly
+    def annotate (self):
+        self.qvm.set_execution_counts(self.insCounts, self.function_counts())
@@ -0,0 +1,530 @@
+####
+# Copyright (C) 2012, 2020 Angelo Cano
+#
+# This file is part of Qvmdis.
+#
+# Qvmdis is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Qvmdis is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Qvmdis.  If not, see <https://www.gnu.org/licenses/>.
+####
+
+# generates qvm files of any size for benchmarks and scaling tests
+#
+# The code looks like q3lcc output: functions with a frame for locals and
+# outgoing arguments, assignments, conditionals, counted loops, switch
+# statements using q3asm jump tables in the data segment, calls, and system
+# calls with lit string arguments.  The same parameters and seed always give
+# the same file.
+#
+# The generated qvm can also be run.  Functions only call functions after
+# them and the first argument is a call depth budget:  calls are skipped
+# when it's 0 and the callee gets one less.  vmMain(0, depth) runs the code
+# with that call depth.
+#
+# Matching symbols.dat, functions.dat, and templates.dat files can be
+# written with write_dat_files().  They are generated with their own random
+# sequence so their sizes don't change the qvm, except for the bss segment
+# growing to fit the symbols.
+
+from Qvm import opcodes, OPCODE_NAME, OPCODE_PARM_SIZE, QVM_MAGIC_VER1, QVM_MAGIC_VER2, SYMBOLS_FILE, FUNCTIONS_FILE, TEMPLATES_FILE
+import os, random, struct
+
+DEFAULT_SEED = 0x51564d
+
+# increase when the same parameters and seed give a different file, so old
+# benchmark results for generated qvms aren't compared with new ones
+GENERATOR_VERSION = 2
+
+OPCODE_NUMBERS = dict((opcodes[i][OPCODE_NAME], i) for i in range(len(opcodes)))
+
+# system call used for lit string arguments, trap_Print() in all qvm types
+PRINT_SYSCALL = -1
+
+BINARY_OPS = ("add", "sub", "muli", "band", "bor", "bxor", "lsh", "rshi")
+BRANCH_OPS = ("eq", "ne", "lti", "lei", "gti", "gei")
+
+LIT_WORDS = ("player", "score", "weapon", "item", "health", "armor", "team", "frag", "spawn", "map", "vote", "chat")
+
+# template member types:  name -> [size, alignment]
+BASIC_TYPES = {
+    "char" : [1, 1],
+    "short" : [2, 2],
+    "int" : [4, 4],
+    "float" : [4, 4],
+    }
+
+# python 2 and 3 random.Random() give the same random() sequence for a seed,
+# but randint(), choice(), shuffle(), and sample() are implemented differently
+class PortableRandom(random.Random):
+    def randint (self, a, b):
+        return a + int(self.random() * (b - a + 1))
+
+    def choice (self, seq):
+        return seq[self.randint(0, len(seq) - 1)]
+
+    def shuffle (self, x):
+        for i in range(len(x) - 1, 0, -1):
+            j = self.randint(0, i)
+            (x[i], x[j]) = (x[j], x[i])
+
+    def sample (self, population, k):
+        pool = list(population)
+        self.shuffle(pool)
+        return pool[:k]
+
+class SyntheticQvm:
+    # functionCount:  including vmMain
+    # callCount:  average calls to other functions per function
+    # statementCount:  average statements per function
+    # switchCount:  average switch statements per function
+    # version:  1 or 2, only version 2 files have a jump table
+    # jumpTableCount:  jump table entries, None for the addresses in the
+    #                  switch tables like q3asm
+    # symbolCount, templateCount:  entries in symbols.dat and templates.dat
+    # datFunctionCount:  functions in functions.dat, None for all of them
+    def __init__ (self, functionCount=100, callCount=3, statementCount=20, switchCount=1, litStringCount=200, dataWordCount=1000, bssLength=0x10000, version=1, jumpTableCount=None, symbolCount=100, templateCount=10, datFunctionCount=None, seed=DEFAULT_SEED):
+        if version not in (1, 2):
+            raise ValueError("invalid qvm version %d" % version)
+        self.functionCount = max(1, functionCount)
+        self.callCount = callCount
+        self.statementCount = statementCount
+        self.switchCount = switchCount
+        self.litStringCount = litStringCount
+        self.dataWordCount = dataWordCount
+        self.bssLength = bssLength
+        self.version = version
+        self.jumpTableCount = jumpTableCount
+        self.symbolCount = symbolCount
+        self.templateCount = templateCount
+        if datFunctionCount == None:
+            self.datFunctionCount = self.functionCount
+        else:
+            self.datFunctionCount = min(datFunctionCount, self.functionCount)
+        self.seed = seed
+        self.rand = PortableRandom(seed)
+        self.datRand = PortableRandom(seed + 1)
+
+        self.code = []  # [ [opcodeName:str, parm], ... ]  parm can be a label or address tuple
+        self.labels = {}  # label:tuple -> ins:int
+        self.functionStarts = []  # [ ins1:int, ... ]
+        self.functionNames = []  # [ name1:str, ... ]
+        self.functionFrames = []  # [ [argCount1:int, localCount1:int, outArgCount1:int], ... ]
+        self.switchTables = []  # [ [label1:tuple, label2:tuple, ...], ... ]
+
+        self.build_data()
+        self.build_code()
+        self.build_templates()
+        self.build_symbols()
+        self.layout()
+
+    def build_data (self):
+        self.dataWords = [self.rand.randint(0, 0x7fffffff) for i in range(self.dataWordCount)]
+
+        self.litStrings = []  # [ [offset:int, s:str], ... ]  offset is relative to the lit segment
+        lit = []
+        offset = 0
+        for n in range(self.litStringCount):
+            words = [self.rand.choice(LIT_WORDS) for i in range(self.rand.randint(1, 4))]
+            s = "%s %d\n" % (" ".join(words), n)
+            self.litStrings.append([offset, s])
+            lit.append(s.encode("ascii") + b"\0")
+            offset += len(s) + 1
+        self.litData = b"".join(lit)
+        # bss starts after the lit segment, keep it word aligned
+        while len(self.litData) % 4 != 0:
+            self.litData += b"\0"
+
+    def emit (self, name, parm=0):
+        self.code.append([name, parm])
+
+    def label (self, label):
+        self.labels[label] = len(self.code)
+
+    def build_code (self):
+        for n in range(self.functionCount):
+            if n == 0:
+                self.functionNames.append("vmMain")
+            else:
+                self.functionNames.append("func_%d" % n)
+            self.functionStarts.append(len(self.code))
+            self.build_function(n)
+
+    # places the switch tables after the data words and resolves labels and
+    # addresses, the segment sizes are known after the .dat files are built
+    def layout (self):
+        self.switchTableAddrs = []
+        words = list(self.dataWords)
+        for table in self.switchTables:
+            self.switchTableAddrs.append(4 * len(words))
+            words.extend([self.labels[label] for label in table])
+        self.dataWords = words
+        self.dataLength = 4 * len(words)
+        self.litStart = self.dataLength
+        self.bssStart = self.dataLength + len(self.litData)
+
+        for ins in self.code:
+            if isinstance(ins[1], tuple):
+                ins[1] = self.resolve(ins[1])
+
+        self.jumpTable = []
+        if self.version == 2:
+            targets = []
+            for table in self.switchTables:
+                targets.extend([self.labels[label] for label in table])
+            if self.jumpTableCount == None:
+                self.jumpTable = targets
+            else:
+                # q3asm also lists function addresses stored in data
+                targets.extend(self.functionStarts)
+                while len(self.jumpTable) < self.jumpTableCount:
+                    self.jumpTable.extend(targets[:self.jumpTableCount - len(self.jumpTable)])
+
+    def resolve (self, ref):
+        if ref[0] == "function":
+            return self.functionStarts[ref[1]]
+        elif ref[0] == "lit":
+            return self.litStart + ref[1]
+        elif ref[0] == "bss":
+            return self.bssStart + ref[1]
+        elif ref[0] == "switch":
+            # table address minus the min case value, see the q3asm switch
+            # pattern in Qvm.compute_function_info()
+            return self.switchTableAddrs[ref[1]] - 4 * ref[2]
+        else:
+            return self.labels[ref]
+
+    # one random statement count per function, averaging statementCount
+    def random_count (self, average):
+        if average <= 0:
+            return 0
+        return self.rand.randint(0, 2 * average)
+
+    def build_function (self, n):
+        self.argCount = self.rand.randint(1, 4)
+        self.localCount = self.rand.randint(1, 8)
+        self.outArgCount = 4
+        # return address, syscall number slot, outgoing arguments, locals
+        self.frameSize = 8 + 4 * self.outArgCount + 4 * self.localCount
+        self.function = n
+        self.labelCount = 0
+        self.functionFrames.append([self.argCount, self.localCount, self.outArgCount])
+
+        self.emit("enter", self.frameSize)
+
+        statements = ["assign", "global", "if", "loop", "print"]
+        calls = self.random_count(self.callCount)
+        if n + 1 >= self.functionCount:
+            calls = 0
+        body = ["call"] * calls + ["switch"] * self.random_count(self.switchCount)
+        body += [self.rand.choice(statements) for i in range(self.random_count(self.statementCount))]
+        self.rand.shuffle(body)
+        for s in body:
+            getattr(self, "statement_" + s)()
+
+        self.push_expression(2)
+        self.emit("leave", self.frameSize)
+
+    def new_label (self):
+        self.labelCount += 1
+        return ("label", self.function, self.labelCount)
+
+    def local_addr (self):
+        return 8 + 4 * self.outArgCount + 4 * self.rand.randint(0, self.localCount - 1)
+
+    def arg_addr (self):
+        return self.frameSize + 8 + 4 * self.rand.randint(0, max(0, self.argCount - 1))
+
+    def data_addr (self):
+        if self.dataWordCount > 0  and  self.rand.randint(0, 1) == 0:
+            return 4 * self.rand.randint(0, self.dataWordCount - 1)
+        return ("bss", 4 * self.rand.randint(0, self.bssLength // 4 - 1))
+
+    # leaves one value on the opStack
+    def push_expression (self, depth):
+        c = self.rand.randint(0, 4)
+        if depth <= 0  or  c == 0:
+            self.emit("const", self.rand.randint(-16, 1024))
+        elif c == 1:
+            self.emit("local", self.local_addr())
+            self.emit("load4")
+        elif c == 2:
+            self.emit("local", self.arg_addr())
+            self.emit("load4")
+        elif c == 3:
+            self.emit("const", self.data_addr())
+            self.emit("load4")
+        else:
+            self.push_expression(depth - 1)
+            self.push_expression(depth - 1)
+            self.emit(self.rand.choice(BINARY_OPS))
+
+    def statement_assign (self):
+        self.emit("local", self.local_addr())
+        self.push_expression(2)
+        self.emit("store4")
+
+    def statement_global (self):
+        self.emit("const", self.data_addr())
+        self.push_expression(1)
+        self.emit("store4")
+
+    def statement_if (self):
+        skip = self.new_label()
+        self.push_expression(1)
+        self.push_expression(1)
+        self.emit(self.rand.choice(BRANCH_OPS), skip)
+        self.statement_assign()
+        self.label(skip)
+
+    # for (i = 0; i < count; i++)
+    def statement_loop (self):
+        counter = self.local_addr()
+        top = self.new_label()
+        done = self.new_label()
+        self.emit("local", counter)
+        self.emit("const", 0)
+        self.emit("store4")
+        self.label(top)
+        self.emit("local", counter)
+        self.emit("load4")
+        self.emit("const", self.rand.randint(1, 8))
+        self.emit("gei", done)
+        self.statement_global()
+        self.emit("local", counter)
+        self.emit("local", counter)
+        self.emit("load4")
+        self.emit("const", 1)
+        self.emit("add")
+        self.emit("store4")
+        self.emit("const", top)
+        self.emit("jump")
+        self.label(done)
+
+    # switch (value) { case ...: ...; break; ... }, the 16 op jump through a
+    # table of code addresses in the data segment
+    def statement_switch (self):
+        value = self.local_addr()
+        done = self.new_label()
+        tmin = self.rand.randint(0, 4)
+        tmax = tmin + self.rand.randint(1, 7)
+        cases = [self.new_label() for i in range(tmin, tmax + 1)]
+        # values without a case go to the end like a missing default
+        table = []
+        for label in cases:
+            if self.rand.randint(0, 3) == 0:
+                table.append(done)
+            else:
+                table.append(label)
+        self.switchTables.append(table)
+
+        self.emit("local", value)
+        self.push_expression(1)
+        self.emit("store4")
+
+        self.emit("local", value)
+        self.emit("load4")
+        self.emit("const", tmin)
+        self.emit("lti", done)
+        self.emit("local", value)
+        self.emit("load4")
+        self.emit("const", tmax)
+        self.emit("gti", done)
+        self.emit("local", value)
+        self.emit("load4")
+        self.emit("const", 2)
+        self.emit("lsh")
+        self.emit("const", ("switch", len(self.switchTables) - 1, tmin))
+        self.emit("add")
+        self.emit("load4")
+        self.emit("jump")
+
+        for label in cases:
+            self.label(label)
+            self.statement_assign()
+            self.emit("const", done)
+            self.emit("jump")
+        self.label(done)
+
+    def statement_call (self):
+        target = self.rand.randint(self.function + 1, self.functionCount - 1)
+        budget = self.frameSize + 8
+        if self.function == 0:
+            # vmMain(command, depth)
+            budget += 4
+        skip = self.new_label()
+        self.emit("local", budget)
+        self.emit("load4")
+        self.emit("const", 0)
+        self.emit("lei", skip)
+
+        storeResult = self.rand.randint(0, 1) == 0
+        if storeResult:
+            self.emit("local", self.local_addr())
+        self.emit("local", budget)
+        self.emit("load4")
+        self.emit("const", 1)
+        self.emit("sub")
+        self.emit("arg", 8)
+        for i in range(1, self.rand.randint(1, self.outArgCount)):
+            self.push_expression(1)
+            self.emit("arg", 8 + 4 * i)
+        self.emit("const", ("function", target))
+        self.emit("call")
+        if storeResult:
+            self.emit("store4")
+        else:
+            self.emit("pop")
+        self.label(skip)
+
+    def statement_print (self):
+        if len(self.litStrings) == 0:
+            return
+        offset = self.rand.choice(self.litStrings)[0]
+        self.emit("const", ("lit", offset))
+        self.emit("arg", 8)
+        self.emit("const", PRINT_SYSCALL)
+        self.emit("call")
+        self.emit("pop")
+
+    # templates.dat:  structures made of basic types, arrays, pointers, and
+    # previously defined templates, with C style padding
+    def build_templates (self):
+        rand = self.datRand
+        self.templates = []  # [ [name:str, size:int, align:int, members:[ [type:str, name:str], ... ]], ... ]
+        for n in range(self.templateCount):
+            members = []
+            offset = 0
+            align = 1
+            for m in range(rand.randint(2, 12)):
+                c = rand.randint(0, 5)
+                if c == 0  and  n > 0:
+                    (t, tsize, talign) = self.templates[rand.randint(0, n - 1)][:3]
+                    if rand.randint(0, 1) == 0:
+                        count = rand.randint(2, 4)
+                        (t, tsize) = ("%s[%d]" % (t, count), tsize * count)
+                elif c == 1  and  n > 0:
+                    (t, tsize, talign) = ("*" + self.templates[rand.randint(0, n - 1)][0], 4, 4)
+                elif c == 2:
+                    count = rand.choice((16, 32, 64))
+                    (t, tsize, talign) = ("char[%d]" % count, count, 1)
+                else:
+                    t = rand.choice(sorted(BASIC_TYPES.keys()))
+                    (tsize, talign) = BASIC_TYPES[t]
+                offset = (offset + talign - 1) // talign * talign
+                offset += tsize
+                align = max(align, talign)
+                members.append([t, "m%d" % m])
+            size = (offset + align - 1) // align * align
+            self.templates.append(["struct%d_t" % n, size, align, members])
+
+    # symbols.dat:  simple symbols for data words, typed and sized symbols in
+    # the bss segment
+    def build_symbols (self):
+        rand = self.datRand
+        self.symbols = []  # [ [addr:int, type:str or None, name:str], ... ]  addr is a ("bss", offset) tuple for the bss segment
+        dataCount = min(self.symbolCount // 3, self.dataWordCount)
+        for i in sorted(rand.sample(range(self.dataWordCount), dataCount)):
+            self.symbols.append([4 * i, None, "data_%d" % i])
+
+        offset = 0
+        for n in range(self.symbolCount - dataCount):
+            c = rand.randint(0, 4)
+            if c == 0  and  len(self.templates) > 0:
+                (t, size) = self.templates[rand.randint(0, len(self.templates) - 1)][:2]
+                if rand.randint(0, 1) == 0:
+                    count = rand.randint(2, 64)
+                    (t, size) = ("%s[%d]" % (t, count), size * count)
+            elif c == 1  and  len(self.templates) > 0:
+                (t, size) = ("*" + rand.choice(self.templates)[0], 4)
+            elif c == 2:
+                size = 4 * rand.randint(2, 256)
+                t = "0x%x" % size
+            else:
+                (t, size) = (rand.choice(("int", "float")), 4)
+            self.symbols.append([("bss", offset), t, "bss_%d" % n])
+            offset += (size + 3) // 4 * 4
+        self.bssLength = max(self.bssLength, offset)
+
+    def code_bytes (self):
+        out = []
+        for (name, parm) in self.code:
+            opc = OPCODE_NUMBERS[name]
+            out.append(struct.pack("<B", opc))
+            size = opcodes[opc][OPCODE_PARM_SIZE]
+            if size == 4:
+                out.append(struct.pack("<i", parm))
+            elif size == 1:
+                out.append(struct.pack("<B", parm))
+        code = b"".join(out)
+        while len(code) % 4 != 0:
+            code += b"\0"
+        return code
+
+    def write (self, fname):
+        code = self.code_bytes()
+        data = struct.pack("<%dL" % len(self.dataWords), *self.dataWords)
+
+        f = open(fname, "wb")
+        if self.version == 1:
+            headerSize = 32
+            f.write(struct.pack("<8L", QVM_MAGIC_VER1, len(self.code), headerSize, len(code), headerSize + len(code), len(data), len(self.litData), self.bssLength))
+        else:
+            headerSize = 36
+            f.write(struct.pack("<9L", QVM_MAGIC_VER2, len(self.code), headerSize, len(code), headerSize + len(code), len(data), len(self.litData), self.bssLength, 4 * len(self.jumpTable)))
+        f.write(code)
+        f.write(data)
+        f.write(self.litData)
+        if self.version == 2:
+            f.write(struct.pack("<%dL" % len(self.jumpTable), *self.jumpTable))
+        f.close()
+
+    def write_dat_files (self, directory="."):
+        f = open(os.path.join(directory, TEMPLATES_FILE), "w")
+        f.write("; synthetic templates\n")
+        for (name, size, align, members) in self.templates:
+            f.write("\n%s {\n" % name)
+            for (t, m) in members:
+                f.write("    %s %s\n" % (t, m))
+            f.write("}\n")
+        f.close()
+
+        f = open(os.path.join(directory, SYMBOLS_FILE), "w")
+        f.write("; synthetic symbols\n")
+        for (addr, t, name) in self.symbols:
+            if isinstance(addr, tuple):
+                addr = self.resolve(addr)
+            if t == None:
+                f.write("0x%x %s\n" % (addr, name))
+            else:
+                f.write("0x%x %s %s\n" % (addr, t, name))
+        f.close()
+
+        rand = PortableRandom(self.seed + 2)
+        f = open(os.path.join(directory, FUNCTIONS_FILE), "w")
+        f.write("; synthetic functions\n")
+        for n in range(self.datFunctionCount):
+            (argCount, localCount, outArgCount) = self.functionFrames[n]
+            f.write("\n0x%x %s\n" % (self.functionStarts[n], self.functionNames[n]))
+            for i in range(argCount):
+                if rand.randint(0, 2) == 0:
+                    f.write("  arg%d int arg_%d\n" % (i, i))
+                elif rand.randint(0, 1) == 0  and  len(self.templates) > 0:
+                    f.write("  arg%d *%s arg_%d\n" % (i, rand.choice(self.templates)[0], i))
+                else:
+                    f.write("  arg%d arg_%d\n" % (i, i))
+            for i in range(localCount):
+                localAddr = 8 + 4 * outArgCount + 4 * i
+                if rand.randint(0, 1) == 0:
+                    f.write("  local 0x%x local_%d\n" % (localAddr, i))
+                else:
+                    f.write("  local 0x%x %s local_%d\n" % (localAddr, rand.choice(("int", "float")), i))
+        f.close()